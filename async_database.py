@@ -0,0 +1,129 @@
+"""
+Асинхронная обертка над Database.
+
+Все обращения к SQLite выполняются в отдельных потоках БД, поэтому
+обработчики бота никогда не блокируют цикл событий asyncio.
+
+Базу можно открывать отложенно (AsyncDatabase.deferred): соединения и
+проверка схемы выполняются в фоновом потоке (start_opening() или первое
+обращение), а запуск бота в это время продолжается.
+"""
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from database import Database
+
+
+class AsyncDatabase:
+    """
+    Тот же API, что и у Database, только методы нужно await-ить:
+
+        db = AsyncDatabase(Database())
+        expense_id = await db.add_expense(user_id, username, amount, category, description)
+    """
+
+    def __init__(self, db: Optional[Database] = None,
+                 opener: Optional[Callable[[], Database]] = None):
+        self.db = None
+        self._executor = None
+        self._opener = opener
+        self._opening: Optional[Future] = None
+        self._opening_lock = threading.Lock()
+        if db is not None:
+            self._attach(db)
+
+    @classmethod
+    def deferred(cls, opener: Callable[[], Database]) -> 'AsyncDatabase':
+        """Обертка, которая откроет базу вызовом opener() в фоне"""
+        return cls(opener=opener)
+
+    def _attach(self, db: Database):
+        self.db = db
+        # Потоков столько же, сколько соединений в пуле: писатель + читатели
+        self._executor = ThreadPoolExecutor(
+            max_workers=db._max_readers + 1,
+            thread_name_prefix='db'
+        )
+
+    @property
+    def is_open(self) -> bool:
+        return self.db is not None
+
+    def start_opening(self) -> Future:
+        """Начать открывать отложенную базу в фоновом потоке (можно и без цикла событий)"""
+        with self._opening_lock:
+            if self._opening is None:
+                self._opening = Future()
+                threading.Thread(target=self._open_in_thread, name='db-open', daemon=True).start()
+            return self._opening
+
+    def _open_in_thread(self):
+        try:
+            self._opening.set_result(self._opener())
+        except BaseException as error:
+            self._opening.set_exception(error)
+
+    async def open(self):
+        """Дождаться открытия отложенной базы; повторные вызовы ждут того же открытия"""
+        if self.db is not None:
+            return
+        db = await asyncio.wrap_future(self.start_opening())
+        if self.db is None:
+            self._attach(db)
+
+    async def run_sync(self, func: Callable, *args, **kwargs) -> Any:
+        """Выполнить синхронную функцию в потоке БД"""
+        if self._executor is None:
+            await self.open()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    def __getattr__(self, name: str):
+        if self.db is None:
+            if name.startswith('_'):
+                raise AttributeError(name)
+
+            # База еще открывается: метод дождется открытия и вызовет настоящий
+            async def pending(*args, **kwargs):
+                await self.open()
+                return await getattr(self, name)(*args, **kwargs)
+            return pending
+
+        attr = getattr(self.db, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        if name in getattr(self.db, 'queued_methods', ()):
+            # Групповой коммит: ждем Future писателя, не занимая поток БД,
+            # чтобы в одну транзакцию попало столько записей, сколько пришло
+            async def method(*args, **kwargs):
+                return await asyncio.wrap_future(self.db.submit(name, *args, **kwargs))
+        else:
+            @functools.wraps(attr)
+            async def method(*args, **kwargs):
+                return await self.run_sync(attr, *args, **kwargs)
+
+        # Кэшируем обертку, чтобы не создавать ее при каждом вызове
+        setattr(self, name, method)
+        return method
+
+    async def close(self):
+        """Дождаться завершения запросов и закрыть соединения"""
+        if self.db is None:
+            if self._opening is None:
+                return
+            await self.open()
+        await self.run_sync(self.db.close)
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
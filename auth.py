@@ -0,0 +1,186 @@
+"""
+Проверка доступа и ограничение частоты запросов до обработчиков
+
+AccessControl.check регистрируется в группе обработчиков с наивысшим
+приоритетом (group=-1) и видит каждое обновление первым. Пользователь без
+семьи и пользователь, который шлет запросы слишком часто, отсекаются через
+ApplicationHandlerStop - остальные обработчики и запросы к БД для них
+не выполняются.
+
+Список участников хранится в БД (household_members), в памяти лежит его
+копия-словарь для проверки за O(1). Копия перечитывается раз в
+reload_seconds, а после /newfamily и /join обновляется сразу. Рядом
+лежат дни зарплаты семей: они нужны каждому отчету за период, меняются
+только через /payday и сбрасываются вместе со списком участников.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+from metrics import REJECTED_UPDATES
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Ведро на пользователя: пополнение в секунду и максимальный запас
+RATE_PER_SECOND = 1.0
+RATE_BURST = 10.0
+
+# Сколько последних пользователей помнить для лимитов
+MAX_TRACKED_USERS = 10000
+
+ALLOWLIST_RELOAD_SECONDS = 60.0
+
+# Команды, доступные без семьи
+PUBLIC_COMMANDS = frozenset({'start', 'help', 'myid', 'newfamily', 'join', 'categories'})
+
+# Стоимость запросов в токенах: тяжелые запросы к БД дороже
+COMMAND_COSTS = {
+    'stats': 3,
+    'balance': 3,
+    'history': 2,
+    'periods': 3,
+    'trends': 5,
+    'search': 3,
+    'export': 10,
+    'import': 10,
+}
+CALLBACK_COSTS = {
+    'stats': 3,
+    'hist': 2,
+    'trends': 5,
+    'srch': 3,
+}
+DEFAULT_COST = 1
+
+RATE_LIMITED_TEXT = "⏳ Слишком много запросов. Подождите {seconds:.0f} с."
+
+
+class AccessControl:
+    """
+    Проверка доступа и лимиты для всех обновлений.
+
+    loader() возвращает всех участников семей парами (user_id, household_id);
+    menu_commands сопоставляет тексты кнопок меню с командами.
+    """
+
+    def __init__(self, loader: Callable[[], Awaitable[Iterable[Tuple[int, int]]]],
+                 denied_text: str,
+                 menu_commands: Dict[str, str] = None,
+                 rate: float = RATE_PER_SECOND,
+                 burst: float = RATE_BURST,
+                 reload_seconds: float = ALLOWLIST_RELOAD_SECONDS):
+        self.loader = loader
+        self.denied_text = denied_text
+        self.menu_commands = menu_commands or {}
+        self.rate = rate
+        self.burst = burst
+        self.reload_seconds = reload_seconds
+
+        self._members: Dict[int, int] = {}
+        self._pay_days: Dict[int, int] = {}
+        self._loaded_at = float('-inf')
+        self._buckets: 'OrderedDict[int, TokenBucket]' = OrderedDict()
+        # Кому уже сказали о лимите - повторно не пишем, пока не отпустит.
+        # Ограничен так же, как ведра: забытый пользователь получит
+        # предупреждение еще раз, не больше
+        self._warned: 'OrderedDict[int, None]' = OrderedDict()
+
+    def load(self, members: Iterable[Tuple[int, int]]):
+        """Заменить список участников целиком"""
+        self._members = dict(members)
+        self._pay_days.clear()
+        self._loaded_at = time.monotonic()
+
+    async def reload(self):
+        """Перечитать участников из БД"""
+        self.load(await self.loader())
+
+    def set_member(self, user_id: int, household_id: int):
+        """Учесть вступление в семью сразу, не дожидаясь перечитывания"""
+        self._members[user_id] = household_id
+
+    def household_id(self, user_id: int) -> Optional[int]:
+        """Семья пользователя или None"""
+        return self._members.get(user_id)
+
+    def pay_day(self, household_id: int) -> Optional[int]:
+        """Запомненный день зарплаты семьи или None, если его надо прочитать из БД"""
+        return self._pay_days.get(household_id)
+
+    def set_pay_day(self, household_id: int, pay_day: int):
+        """Запомнить день зарплаты семьи (после чтения из БД или /payday)"""
+        self._pay_days[household_id] = pay_day
+
+    def command(self, update: Update) -> Optional[str]:
+        """Команда, к которой относится сообщение (с учетом кнопок меню и документов)"""
+        message = update.message
+        if message is None:
+            return None
+        if getattr(message, 'document', None) is not None:
+            return 'import'
+
+        text = message.text or ''
+        if text.startswith('/'):
+            return text[1:].split(maxsplit=1)[0].split('@')[0].lower() if len(text) > 1 else None
+        return self.menu_commands.get(text)
+
+    def cost(self, update: Update, command: Optional[str]) -> float:
+        if update.callback_query is not None:
+            prefix = (update.callback_query.data or '').split('_', 1)[0]
+            return CALLBACK_COSTS.get(prefix, DEFAULT_COST)
+        return COMMAND_COSTS.get(command, DEFAULT_COST)
+
+    def _bucket(self, user_id: int) -> TokenBucket:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets[user_id] = bucket
+            while len(self._buckets) > MAX_TRACKED_USERS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+        return bucket
+
+    async def _reject(self, update: Update, text: str):
+        if update.callback_query is not None:
+            await update.callback_query.answer(text, show_alert=True)
+        elif update.message is not None:
+            await update.message.reply_text(text)
+
+    async def check(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик группы -1: пропускает обновление дальше или останавливает его"""
+        user = update.effective_user
+        if user is None:
+            REJECTED_UPDATES.inc('no_user')
+            raise ApplicationHandlerStop
+
+        command = self.command(update)
+        bucket = self._bucket(user.id)
+        cost = self.cost(update, command)
+        if not bucket.try_acquire(cost):
+            REJECTED_UPDATES.inc('rate_limited')
+            if user.id not in self._warned:
+                self._warned[user.id] = None
+                while len(self._warned) > MAX_TRACKED_USERS:
+                    self._warned.popitem(last=False)
+                logger.warning(f"Лимит запросов: пользователь {user.id}")
+                await self._reject(update, RATE_LIMITED_TEXT.format(seconds=bucket.delay(cost)))
+            raise ApplicationHandlerStop
+        self._warned.pop(user.id, None)
+
+        if command in PUBLIC_COMMANDS:
+            return
+
+        if time.monotonic() - self._loaded_at > self.reload_seconds:
+            await self.reload()
+
+        if user.id not in self._members:
+            REJECTED_UPDATES.inc('no_household')
+            await self._reject(update, self.denied_text)
+            raise ApplicationHandlerStop
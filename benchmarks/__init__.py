@@ -0,0 +1,9 @@
+"""
+Бенчмарки бота. Запускаются из корня репозитория:
+
+    python -m benchmarks.run --rows 10000 100000 --output results.json
+    python -m benchmarks.bench_categories
+
+datagen - генератор синтетической истории расходов,
+fakes - заменители Update/Context для вызова обработчиков без Telegram.
+"""
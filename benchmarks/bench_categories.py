@@ -0,0 +1,98 @@
+"""
+Сравнение определения категории: старый вложенный цикл против KeywordMatcher
+
+    python -m benchmarks.bench_categories --keywords 5000 --categories 20
+"""
+
+import argparse
+import random
+import string
+import timeit
+
+from categories import CATEGORIES, KeywordMatcher, normalize_text
+
+
+def legacy_determine_category(categories, description: str):
+    """Прежняя реализация: проверка каждого ключевого слова по очереди"""
+    description_lower = description.lower()
+    for category, keywords in categories.items():
+        for keyword in keywords:
+            if keyword in description_lower:
+                return category
+    return None
+
+
+def make_categories(keyword_count: int, category_count: int, seed: int = 1):
+    """Синтетический словарь: реальные ключевые слова + случайные названия магазинов"""
+    rng = random.Random(seed)
+    categories = {f'Категория {i}': [] for i in range(category_count)}
+    names = list(categories)
+
+    categories[names[0]].extend(CATEGORIES['Еда'])
+    seen = {normalize_text(keyword) for keyword in CATEGORIES['Еда']}
+    while len(seen) < keyword_count:
+        word = ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 12)))
+        if word not in seen:
+            seen.add(word)
+            categories[rng.choice(names)].append(word)
+    return categories
+
+
+def make_descriptions(categories, count: int, seed: int = 2):
+    """Описания расходов: половина с известным магазином, половина без"""
+    rng = random.Random(seed)
+    keywords = [keyword for words in categories.values() for keyword in words]
+    descriptions = []
+    for i in range(count):
+        if i % 2:
+            descriptions.append(f'zakup {rng.choice(keywords)} nr {rng.randint(1, 999)}')
+        else:
+            descriptions.append(f'przelew {rng.randint(1, 99999)} opłata')
+    return descriptions
+
+
+def run(keyword_count: int, category_count: int, samples: int, repeat: int) -> dict:
+    categories = make_categories(keyword_count, category_count)
+    descriptions = make_descriptions(categories, samples)
+
+    build_seconds = timeit.timeit(lambda: KeywordMatcher(categories), number=1)
+    matcher = KeywordMatcher(categories)
+
+    legacy = min(timeit.repeat(
+        lambda: [legacy_determine_category(categories, d) for d in descriptions],
+        number=1, repeat=repeat
+    ))
+    compiled = min(timeit.repeat(
+        lambda: [matcher.match(d) for d in descriptions],
+        number=1, repeat=repeat
+    ))
+
+    return {
+        'keywords': keyword_count,
+        'categories': category_count,
+        'samples': samples,
+        'build_ms': build_seconds * 1000,
+        'legacy_us_per_call': legacy / samples * 1e6,
+        'matcher_us_per_call': compiled / samples * 1e6,
+        'speedup': legacy / compiled if compiled else float('inf'),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--keywords', type=int, nargs='+', default=[60, 1000, 5000])
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--samples', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    print(f"{'ключей':>8} {'сборка, мс':>11} {'цикл, мкс':>10} {'matcher, мкс':>13} {'ускорение':>10}")
+    for keyword_count in args.keywords:
+        result = run(keyword_count, args.categories, args.samples, args.repeat)
+        print(f"{result['keywords']:>8} {result['build_ms']:>11.1f} "
+              f"{result['legacy_us_per_call']:>10.1f} {result['matcher_us_per_call']:>13.2f} "
+              f"{result['speedup']:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
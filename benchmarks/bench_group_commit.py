@@ -0,0 +1,76 @@
+"""
+Записей в секунду с групповым коммитом и без него
+
+    python -m benchmarks.bench_group_commit --inserts 5000 --concurrency 1 16 64
+
+Записи идут через AsyncDatabase, как из обработчиков бота: concurrency
+корутин одновременно вызывают add_expense. Без группового коммита
+сравниваются оба режима синхронизации: NORMAL (по умолчанию, fsync только
+при checkpoint) и FULL (fsync на каждый COMMIT, как у группового коммита).
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from async_database import AsyncDatabase
+from database import DEFAULT_HOUSEHOLD_ID, Database
+from group_commit import DEFAULT_MAX_BATCH, DEFAULT_MAX_DELAY, GroupCommitDatabase
+
+MODES = ('normal', 'full', 'group')
+
+
+def open_database(path: str, mode: str, max_batch: int, max_delay: float):
+    db = Database(path, cache_size=0)
+    if mode == 'full':
+        db._writer.execute('PRAGMA synchronous = FULL')
+    if mode == 'group':
+        return GroupCommitDatabase(db, max_batch=max_batch, max_delay=max_delay)
+    return db
+
+
+async def insert_all(db: AsyncDatabase, inserts: int, concurrency: int):
+    async def worker(index: int):
+        for number in range(index, inserts, concurrency):
+            await db.add_expense(DEFAULT_HOUSEHOLD_ID, 1, 'Bench', 10.0 + number % 100,
+                                 'Еда', f'biedronka {number}')
+
+    await asyncio.gather(*(worker(index) for index in range(concurrency)))
+
+
+def run(mode: str, inserts: int, concurrency: int, max_batch: int, max_delay: float) -> float:
+    """Записей в секунду"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, f'bench_{mode}.db')
+        db = AsyncDatabase(open_database(path, mode, max_batch, max_delay))
+
+        async def main():
+            started = time.perf_counter()
+            await insert_all(db, inserts, concurrency)
+            elapsed = time.perf_counter() - started
+            await db.close()
+            return inserts / elapsed
+
+        return asyncio.run(main())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--inserts', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--max-batch', type=int, default=DEFAULT_MAX_BATCH)
+    parser.add_argument('--delay-ms', type=float, default=DEFAULT_MAX_DELAY * 1000)
+    args = parser.parse_args(argv)
+
+    print(f"{'вызовов':>8} " + ' '.join(f"{mode + ', зап/с':>14}" for mode in args.modes))
+    for concurrency in args.concurrency:
+        rates = [run(mode, args.inserts, concurrency, args.max_batch, args.delay_ms / 1000)
+                 for mode in args.modes]
+        print(f"{concurrency:>8} " + ' '.join(f"{rate:>14.0f}" for rate in rates))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Генератор синтетической истории расходов для бенчмарков
+
+    python -m benchmarks.datagen --rows 100000 --db /tmp/bench.db
+"""
+
+import argparse
+import math
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Iterator, List, Tuple
+
+from categories import determine_category
+from database import DEFAULT_HOUSEHOLD_ID, Database, to_timestamp
+
+USERS = [(1001, 'Anna'), (1002, 'Piotr'), (1003, 'Olga')]
+
+# (магазин, средняя сумма в zł)
+MERCHANTS = [
+    ('biedronka', 60), ('lidl', 70), ('żabka', 18), ('kaufland', 120), ('auchan', 150),
+    ('carrefour express', 40), ('dino', 55), ('netto', 50), ('stokrotka', 45),
+    ('rossmann', 45), ('hebe', 40), ('apteka gemini', 35), ('apteka dr.max', 30),
+    ('orlen stacja', 250), ('bp stacja', 230), ('shell', 240), ('circle k', 200),
+    ('pkp intercity bilet', 90), ('jakdojade bilet', 5), ('uber', 30), ('bolt', 28),
+    ('allegro zamówienie', 110), ('empik', 60), ('media expert', 400), ('ikea', 350),
+    ('castorama', 180), ('leroy merlin', 200), ('pepco', 50), ('sinsay', 70),
+    ('kino helios', 55), ('cinema city', 60), ('spotify', 24), ('netflix', 43),
+    ('mcdonald', 35), ('kfc', 38), ('pizza hut', 80), ('pyszne.pl zamówienie', 65),
+    ('glovo', 55), ('kebab u aliego', 30), ('kawiarnia costa', 22), ('restauracja stary młyn', 160),
+    ('czynsz', 1800), ('prąd tauron', 220), ('internet orange', 70), ('fryzjer', 90),
+]
+
+BRANCHES = ['', '', '', ' warszawa', ' kraków', ' wrocław', ' gdańsk', ' poznań', ' nr 12', ' 0451']
+
+
+def generate_rows(rows: int, days: int = 3 * 365, seed: int = 42,
+                  end: datetime = None) -> Iterator[Tuple]:
+    """Строки (user_id, username, amount, category, description, date, ts) по возрастанию даты"""
+    rng = random.Random(seed)
+    end = end or datetime.now()
+    start = end - timedelta(days=days)
+    step = days * 86400 / max(rows, 1)
+    categories = {merchant: determine_category(merchant) for merchant, _ in MERCHANTS}
+
+    for i in range(rows):
+        user_id, username = rng.choice(USERS)
+        merchant, mean = rng.choice(MERCHANTS)
+        amount = round(rng.lognormvariate(math.log(mean), 0.5), 2)
+        date = start + timedelta(seconds=i * step + rng.random() * step)
+        yield (user_id, username, amount, categories[merchant],
+               merchant + rng.choice(BRANCHES), date.isoformat(), to_timestamp(date))
+
+
+def populate(db: Database, rows: int, chunk_size: int = 20000,
+             household_id: int = DEFAULT_HOUSEHOLD_ID, **kwargs) -> float:
+    """Заполнить БД синтетическими расходами семьи, вернуть время в секундах"""
+    started = time.perf_counter()
+    chunk: List[Tuple] = []
+
+    def flush():
+        with db._write() as conn:
+            conn.executemany('''
+                INSERT INTO expenses
+                    (household_id, user_id, username, amount, category, description, date, ts)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', chunk)
+        chunk.clear()
+
+    for row in generate_rows(rows, **kwargs):
+        chunk.append((household_id,) + row)
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+
+    return time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Заполнить БД синтетическими расходами")
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--days', type=int, default=3 * 365)
+    parser.add_argument('--db', required=True, help="путь к файлу БД")
+    args = parser.parse_args(argv)
+
+    with Database(args.db) as db:
+        seconds = populate(db, args.rows, days=args.days)
+    print(f"✅ {args.rows} строк за {seconds:.1f} с -> {args.db}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Минимальные заменители Update и Context для вызова обработчиков бота без Telegram
+"""
+
+from types import SimpleNamespace
+from typing import List
+
+
+class FakeMessage:
+    """Сообщение, которое запоминает ответы бота вместо отправки"""
+
+    def __init__(self, text: str = ''):
+        self.text = text
+        self.replies: List[str] = []
+
+    async def reply_text(self, text: str, **kwargs):
+        self.replies.append(text)
+        return self
+
+    async def reply_document(self, document, **kwargs):
+        self.replies.append(kwargs.get('filename', 'document'))
+        return self
+
+    async def edit_text(self, text: str, **kwargs):
+        self.replies.append(text)
+        return self
+
+
+class FakeBot:
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        return SimpleNamespace(chat_id=chat_id, text=text)
+
+
+def make_update(user_id: int, first_name: str, text: str = '') -> SimpleNamespace:
+    user = SimpleNamespace(id=user_id, first_name=first_name)
+    return SimpleNamespace(
+        effective_user=user,
+        effective_chat=SimpleNamespace(id=user_id),
+        message=FakeMessage(text),
+        callback_query=None
+    )
+
+
+def make_context(*args: str) -> SimpleNamespace:
+    return SimpleNamespace(args=list(args), bot=FakeBot(),
+                           user_data={}, chat_data={}, bot_data={})
@@ -0,0 +1,256 @@
+"""
+Бенчмарки запросов Database, определения категорий и обработчиков бота
+
+    python -m benchmarks.run --rows 10000 100000 --output results.json
+    python -m benchmarks.run --rows 10000 --compare results.json
+
+Результат - JSON, который можно сравнить с прошлой версией через --compare:
+при замедлении больше порога команда завершается с кодом 1.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List
+
+from benchmarks.datagen import USERS, generate_rows, populate
+from benchmarks.fakes import make_context, make_update
+from database import DEFAULT_HOUSEHOLD_ID, Database, to_timestamp
+
+
+def measure(func: Callable, iterations: int, warmup: int = 2) -> Dict[str, float]:
+    """Время вызова func: среднее, медиана, p95, минимум и максимум в миллисекундах"""
+    for _ in range(warmup):
+        func()
+
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+
+    samples.sort()
+    return {
+        'iterations': iterations,
+        'mean_ms': statistics.fmean(samples),
+        'p50_ms': samples[len(samples) // 2],
+        'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'min_ms': samples[0],
+        'max_ms': samples[-1],
+    }
+
+
+def database_cases(db: Database, rows: int) -> Dict[str, Callable]:
+    """Запросы Database на разных периодах"""
+    now = datetime.now()
+    periods = {
+        'week': now - timedelta(days=7),
+        'month': now.replace(day=1, hour=0, minute=0, second=0, microsecond=0),
+        'year': now - timedelta(days=365),
+        'all': None,
+    }
+    middle_id = max(1, rows // 2)
+
+    household = DEFAULT_HOUSEHOLD_ID
+    # Курсор из середины истории: страница в глубине, а не самые свежие записи
+    middle = db.get_expense_by_id(household, middle_id)
+    middle_cursor = (to_timestamp(datetime.fromisoformat(middle[6])), middle[0]) if middle else None
+
+    cases = {}
+    for period, start in periods.items():
+        cases[f'db.get_stats_snapshot[{period}]'] = \
+            lambda start=start: db.get_stats_snapshot(household, start)
+        cases[f'db.get_total[{period}]'] = lambda start=start: db.get_total(household, start)
+    cases['db.get_by_category[month]'] = lambda: db.get_by_category(household, periods['month'])
+    cases['db.get_by_user[month]'] = lambda: db.get_by_user(household, periods['month'])
+    cases['db.get_by_user_and_category[all]'] = lambda: db.get_by_user_and_category(household)
+    cases['db.get_recent_expenses[10]'] = lambda: db.get_recent_expenses(household, 10)
+    cases['db.get_recent_expenses[100]'] = lambda: db.get_recent_expenses(household, 100)
+    cases['db.get_expense_by_id'] = lambda: db.get_expense_by_id(household, middle_id)
+    cases['db.get_positions'] = lambda: db.get_positions(household)
+    cases['db.get_history_page[first]'] = lambda: db.get_history_page(household, 10)
+    cases['db.get_history_page[middle]'] = \
+        lambda: db.get_history_page(household, 10, before=middle_cursor)
+    cases['db.search_expenses[lidl]'] = lambda: db.search_expenses(household, 'lidl', limit=10)
+    cases['db.search_expenses[pkp bil]'] = \
+        lambda: db.search_expenses(household, 'pkp bil', limit=10)
+    cases['db.search_expenses[lidl middle]'] = \
+        lambda: db.search_expenses(household, 'lidl', limit=10, before=middle_cursor)
+    cases['db.get_search_summary[lidl]'] = lambda: db.get_search_summary(household, 'lidl')
+    cases['db.get_salary_period_totals[24]'] = lambda: db.get_salary_period_totals(household)
+    cases['db.iter_expenses[month]'] = \
+        lambda: sum(1 for _ in db.iter_expenses(household, periods['month']))
+    return cases
+
+
+@contextmanager
+def handler_cases(db_path: str) -> Iterator[Dict[str, Callable]]:
+    """
+    Обработчики бота целиком, с поддельными Update и Context. После выхода
+    из блока цикл событий и база закрыты, а bot.db - прежний.
+    """
+    import bot
+    from async_database import AsyncDatabase
+
+    previous_db = bot.db
+    bot.db = AsyncDatabase(Database(db_path, cache_size=0))
+    loop = asyncio.new_event_loop()
+    try:
+        user_id, name = bot.ALLOWED_USERS[0], USERS[0][1]
+        bot.db.db.add_household_members(DEFAULT_HOUSEHOLD_ID, [(user_id, name)])
+        bot.access.load(bot.db.db.get_member_households())
+
+        def run(handler, *args):
+            return lambda: loop.run_until_complete(handler(make_update(user_id, name), make_context(*args)))
+
+        yield {
+            'handler.stats[salary]': run(bot.stats),
+            'handler.stats[month]': run(bot.stats, 'month'),
+            'handler.stats[all]': run(bot.stats, 'all'),
+            'handler.balance': run(bot.balance),
+            'handler.history[10]': run(bot.history),
+            'handler.search[lidl]': run(bot.search, 'lidl'),
+            'handler.periods[12]': run(bot.periods, '12'),
+            'handler.export[month csv]': run(bot.export, 'month', 'csv'),
+        }
+    finally:
+        loop.run_until_complete(bot.db.close())
+        loop.close()
+        bot.db = previous_db
+
+
+def function_cases() -> Dict[str, Callable]:
+    """Чистые функции, не зависящие от размера БД"""
+    from salary_calendar import get_salary_period
+    from categories import determine_category
+
+    descriptions = [row[4] for row in generate_rows(1000, seed=7)]
+
+    return {
+        'determine_category[x1000]': lambda: [determine_category(d) for d in descriptions],
+        'get_salary_period': get_salary_period,
+    }
+
+
+def run_benchmarks(row_counts: List[int], iterations: int, include_handlers: bool) -> dict:
+    results = []
+
+    def record(name: str, rows, func: Callable):
+        result = {'name': name, 'rows': rows, **measure(func, iterations)}
+        results.append(result)
+        print(f"  {name:<40} p50 {result['p50_ms']:9.3f} мс   p95 {result['p95_ms']:9.3f} мс",
+              file=sys.stderr)
+
+    print("Функции:", file=sys.stderr)
+    for name, func in function_cases().items():
+        record(name, None, func)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for rows in row_counts:
+            db_path = os.path.join(tmpdir, f'bench_{rows}.db')
+            with Database(db_path, cache_size=0) as db:
+                seconds = populate(db, rows)
+                print(f"{rows} строк (генерация {seconds:.1f} с):", file=sys.stderr)
+                results.append({'name': 'datagen.populate', 'rows': rows, 'iterations': 1,
+                                'mean_ms': seconds * 1000, 'p50_ms': seconds * 1000,
+                                'p95_ms': seconds * 1000, 'min_ms': seconds * 1000,
+                                'max_ms': seconds * 1000})
+
+                for name, func in database_cases(db, rows).items():
+                    record(name, rows, func)
+
+            with Database(db_path) as cached_db:
+                record('db.get_stats_snapshot[cached]', rows,
+                       lambda: cached_db.get_stats_snapshot(DEFAULT_HOUSEHOLD_ID, None))
+
+            if include_handlers:
+                with handler_cases(db_path) as cases:
+                    for name, func in cases.items():
+                        record(name, rows, func)
+
+    return {'meta': environment(), 'results': results}
+
+
+def environment() -> dict:
+    """Описание окружения, чтобы сравнивать сопоставимые запуски"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+    }
+
+
+# Быстрее этого время слишком шумное, чтобы считать замедление регрессией
+MIN_COMPARABLE_MS = 0.05
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> int:
+    """Сравнить медианы с прошлым запуском, вернуть число регрессий"""
+    previous = {(r['name'], r['rows']): r for r in baseline['results']}
+    regressions = 0
+
+    print(f"\n{'тест':<40} {'строк':>8} {'было':>10} {'стало':>10} {'x':>6}")
+    for result in current['results']:
+        old = previous.get((result['name'], result['rows']))
+        if old is None or old['p50_ms'] <= 0:
+            continue
+        ratio = result['p50_ms'] / old['p50_ms']
+        mark = ''
+        if ratio > threshold and result['p50_ms'] >= MIN_COMPARABLE_MS:
+            regressions += 1
+            mark = '  ❌'
+        print(f"{result['name']:<40} {str(result['rows'] or '-'):>8} "
+              f"{old['p50_ms']:>10.3f} {result['p50_ms']:>10.3f} {ratio:>6.2f}{mark}")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарки бота")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000],
+                        help="размеры БД (от 10k до 5M строк)")
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--no-handlers', action='store_true',
+                        help="не запускать обработчики (не нужен python-telegram-bot)")
+    parser.add_argument('--output', help="куда сохранить JSON (по умолчанию stdout)")
+    parser.add_argument('--compare', help="JSON прошлого запуска для сравнения")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="во сколько раз медиана может вырасти без ошибки")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.rows, args.iterations, not args.no_handlers)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    elif not args.compare:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
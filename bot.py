@@ -1,49 +1,56 @@
 """
 Telegram бот для учета семейного бюджета
-Для двух пользователей с автоматическим определением категорий
+Для нескольких семей с автоматическим определением категорий
 """
-from aiohttp import web
-import asyncio
-
-# Функция-обработчик для проверки, что бот жив
-async def handle(request):
-    return web.Response(text="Bot is running!")
-
-async def main():
-    # Создаем веб-приложение
-    app = web.Application()
-    app.router.add_get("/", handle)
-    runner = web.AppRunner(app)
-    await runner.setup()
-    
-    # Render передает порт в переменную окружения PORT
-    import os
-    port = int(os.environ.get("PORT", 8080))
-    site = web.TCPSite(runner, "0.0.0.0", port)
-    
-    # Запускаем веб-сервер фоном
-    await site.start()
-    
-    # Далее ваш привычный запуск бота
-    # await dp.start_polling(bot)
-
-import logging
-from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    MessageHandler,
-    CallbackQueryHandler,
-    ContextTypes,
-    filters
-)
-import re
-from database import Database
-from categories import determine_category
 import os
-from threading import Thread
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from startup import report_requested, start_early_health, startup_timer
+
+# При запуске программой порт здоровья открывается раньше тяжелых импортов:
+# хостинг видит живой сервис, пока грузятся telegram и база (см. startup.py).
+# Для --startup-report берется любой свободный порт.
+early_health = None
+if __name__ == '__main__':
+    early_health = start_early_health(0 if report_requested() else int(os.environ.get('PORT', 10000)))
+
+with startup_timer.phase('import telegram'):
+    from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+    from telegram.helpers import escape_markdown
+    from telegram.ext import (
+        Application,
+        CommandHandler,
+        MessageHandler,
+        CallbackQueryHandler,
+        ContextTypes,
+        TypeHandler,
+        filters
+    )
+
+with startup_timer.phase('import modules'):
+    import logging
+    from datetime import datetime, timedelta
+    import re
+    from database import DEFAULT_HOUSEHOLD_ID, HISTORY_PAGE_MAX, Database, search_terms
+    from export import EXPORT_FORMATS, EXPORT_MAX_SIZE, SPOOL_MAX_SIZE, export_expenses, file_size, xlsx_available
+    from importer import ImportFormatError, run_import
+    from async_database import AsyncDatabase
+    from auth import AccessControl
+    from sharding import open_storage
+    from notifications import DEFAULT_DEBOUNCE_SECONDS, NotificationDispatcher
+    from categories import (
+        LEARNED_CACHE_SIZE,
+        determine_category,
+        get_all_categories,
+        learn_category,
+        load_learned_categories
+    )
+    import signal
+    import asyncio
+    import importlib
+    import tempfile
+    from salary_calendar import DEFAULT_PAY_DAY, get_salary_period
+    from settlements import compute_positions, find_transfer, minimal_transfers
+    from trends import DEFAULT_TREND_PERIOD, TREND_PERIODS, TrendCharts, trends_available
+    from metrics import REGISTRY, GaugeFunction, instrument_application
 
 # Настройка логирования
 logging.basicConfig(
@@ -52,67 +59,351 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# ID разрешенных пользователей (замените на ваши Telegram ID)
-ALLOWED_USERS = [399447361,416881967]  # Оставьте пустым, заполнится автоматически при первом /start
+# Участники первой семьи с тех времен, когда бот был на двоих (замените на ваши Telegram ID).
+# При запуске добавляются в семью DEFAULT_HOUSEHOLD_ID, если еще ни в какой не состоят.
+# Остальные пользователи создают семью через /newfamily или вступают по коду через /join.
+ALLOWED_USERS = [399447361,416881967]
+
+# Общая база или файл на каждую семью (STORAGE_MODE).
+# Соединения и проверка схемы - в фоне при запуске (run_bot), а не при импорте.
+db = AsyncDatabase.deferred(lambda: startup_timer.timed('db open', open_storage))
+
+REGISTRY.register(GaugeFunction(
+    'db_cache', 'Состояние кэша запросов Database', ['stat'],
+    lambda: [((stat,), value) for stat, value in db.cache.stats().items()] if db.is_open else []
+))
+
+
+# Сумма: 500, 35.50, 35,50
+AMOUNT_PATTERN = r'(\d+(?:[.,]\d+)?)'
+CURRENCY_PATTERN = r'(?:\s*(?:zł|zl|pln))?'
+
+# "500 biedronka" - сумма в начале строки
+AMOUNT_FIRST_RE = re.compile(rf'^{AMOUNT_PATTERN}{CURRENCY_PATTERN}\s+(.+)$', re.IGNORECASE)
+# "biedronka 12,50 zł" / "хлеб - 4.50" - сумма в конце, как в чеке
+AMOUNT_LAST_RE = re.compile(rf'^(.+?)\s*[:=—–-]?\s+{AMOUNT_PATTERN}{CURRENCY_PATTERN}$', re.IGNORECASE)
+# Маркеры списков: "- ", "• ", "1. ", "2) "
+LIST_MARKER_RE = re.compile(r'^(?:[-•*]|\d+[.)])\s+')
+
+# Строки итогов в чеке не являются отдельными расходами
+TOTAL_WORDS = {'итого', 'всего', 'suma', 'razem', 'total'}
+
+# Сколько строк можно прислать одним сообщением
+MAX_BATCH_LINES = 50
 
-db = Database()
+# История: записей на странице по умолчанию и длина описания в списке
+HISTORY_PAGE_SIZE = 10
+HISTORY_DESCRIPTION_MAX = 100
+
+# Telegram принимает callback_data не длиннее 64 байт
+CALLBACK_DATA_MAX = 64
+
+# Telegram Bot API не отдает боту файлы больше 20 МБ
+MAX_IMPORT_FILE_SIZE = 20 * 1024 * 1024
+
+# Сколько зарплатных периодов показывает /periods по умолчанию и максимум
+SALARY_PERIODS_DEFAULT = 12
+SALARY_PERIODS_MAX = 24
+
+# Максимальная длина названия семьи
+HOUSEHOLD_NAME_MAX = 64
+
+NO_HOUSEHOLD_TEXT = (
+    "👪 Вы пока не состоите в семье.\n"
+    "Создайте свою: /newfamily [название]\n"
+    "или присоединитесь по коду: /join КОД"
+)
+
+# Кнопки меню и команды, которым они соответствуют
+MENU_COMMANDS = {
+    "📊 Статистика": 'stats',
+    "💰 Баланс": 'balance',
+    "📝 История": 'history',
+    "🔍 Мой ID": 'myid',
+    "📂 Категории": 'categories',
+    "ℹ️ Помощь": 'help',
+}
+
+# Доступ и лимиты проверяются до обработчиков (группа -1).
+# Обработчики, кроме публичных команд, получают только участников семей.
+access = AccessControl(db.get_member_households, NO_HOUSEHOLD_TEXT, MENU_COMMANDS)
+
+
+def parse_expense_line(line: str):
+    """Разобрать строку 'сумма описание' или 'описание сумма' -> (сумма, описание)"""
+    line = LIST_MARKER_RE.sub('', line.strip())
+    
+    match = AMOUNT_FIRST_RE.match(line)
+    if match:
+        amount_str, description = match.groups()
+    else:
+        match = AMOUNT_LAST_RE.match(line)
+        if not match:
+            return None
+        description, amount_str = match.groups()
+    
+    description = description.strip()
+    if not description or description.lower().rstrip(':') in TOTAL_WORDS:
+        return None
+    
+    return float(amount_str.replace(',', '.')), description
 
 
-# HTTP сервер для Render (чтобы не падал Web Service)
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b'Bot is running!')
+def parse_expenses(text: str):
+    """
+    Разобрать сообщение из одной или нескольких строк.
+    
+    Returns:
+        (расходы [(сумма, описание)], ошибки [(номер строки, строка)])
+    """
+    items = []
+    errors = []
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        
+        parsed = parse_expense_line(line)
+        if parsed:
+            items.append(parsed)
+        elif line.lower().split()[0].rstrip(':') not in TOTAL_WORDS:
+            errors.append((line_number, line))
     
-    def log_message(self, format, *args):
-        pass  # Отключаем логи HTTP
+    return items, errors
 
 
-def start_health_check_server():
-    """Запускает HTTP-сервер для Render"""
-    port = int(os.environ.get('PORT', 10000))
-    server = HTTPServer(('0.0.0.0', port), HealthCheckHandler)
-    thread = Thread(target=server.serve_forever, daemon=True)
-    thread.start()
-    logger.info(f"✅ Health check server started on port {port}")
+def format_notification(username: str, expenses) -> str:
+    """Текст уведомления о расходах (сумма, категория, описание) одного пользователя"""
+    if len(expenses) == 1:
+        amount, category, description = expenses[0]
+        notification = f"🔔 Новый расход:\n"
+        notification += f"👤 {username}\n"
+        notification += f"💰 {amount:.2f} zł\n"
+        notification += f"📂 {category}\n"
+        notification += f"📝 {description}"
+        return notification
+    
+    total = sum(amount for amount, _, _ in expenses)
+    notification = f"🔔 Новые расходы ({len(expenses)}):\n"
+    notification += f"👤 {username}\n"
+    for amount, category, description in expenses:
+        notification += f"• {amount:.2f} zł | {category} | {description}\n"
+    notification += f"💰 Всего: {total:.2f} zł"
+    return notification
 
 
-def get_salary_period():
+# Записи одного пользователя за это окно приходят второму одним сообщением
+notifier = NotificationDispatcher(
+    format_notification,
+    debounce_seconds=float(os.getenv('NOTIFY_DEBOUNCE_SECONDS', DEFAULT_DEBOUNCE_SECONDS))
+)
+
+# Графики /trends рисуются в отдельных процессах и кэшируются до новых записей
+trend_charts = TrendCharts(db)
+
+
+def escape_md(text) -> str:
     """
-    Вычисляет начало текущего зарплатного периода.
-    ЗП 10 числа (или раньше если выходной/праздник)
-    Рабочие дни: Ср-Сб (воскресенье начало недели)
+    Пользовательский текст для сообщений с parse_mode='Markdown': описания
+    из выписок вроде "PAYPAL *STEAM" или "Zabka_Z123" иначе ломают разметку,
+    и Telegram отклоняет сообщение
     """
-    now = datetime.now()
+    return escape_markdown(str(text))
+
+
+def get_period_range(period: str, pay_day: int = DEFAULT_PAY_DAY):
+    """Начало периода статистики и его название"""
+    # Округляем до минуты, чтобы повторные нажатия попадали в кэш запросов
+    now = datetime.now().replace(second=0, microsecond=0)
+    today = now.replace(hour=0, minute=0)
+    if period == 'week':
+        return now - timedelta(days=7), "Последние 7 дней"
+    elif period == 'month':
+        return today.replace(day=1), "Текущий месяц"
+    elif period == 'year':
+        return today.replace(month=1, day=1), "Текущий год"
+    elif period == 'salary':
+        start_date = get_salary_period(pay_day)
+        return start_date, f"С {start_date.strftime('%d.%m.%Y')} (зарплатный период)"
+    else:  # all
+        return None, "За все время"
+
+
+def format_stats(snapshot, period_name: str) -> str:
+    """Текст сообщения со статистикой"""
+    total = snapshot.total
+    
+    response = f"📊 **Статистика: {period_name}**\n\n"
+    response += f"💰 **Общая сумма:** {total:.2f} zł\n\n"
     
-    # Функция для проверки является ли день выходным (Сб=5, Вс=6)
-    def is_weekend(date):
-        return date.weekday() >= 5
+    # По категориям
+    if snapshot.by_category:
+        response += "📂 **По категориям:**\n"
+        for category, amount in snapshot.by_category:
+            percentage = (amount / total * 100) if total > 0 else 0
+            response += f"  • {escape_md(category)}: {amount:.2f} zł ({percentage:.1f}%)\n"
+        response += "\n"
     
-    # Функция для нахождения рабочего дня назад от 10 числа
-    def get_salary_day(year, month):
-        salary_date = datetime(year, month, 10)
+    # По пользователям
+    if snapshot.by_user:
+        response += "👥 **По пользователям:**\n"
+        for user, amount in snapshot.by_user:
+            percentage = (amount / total * 100) if total > 0 else 0
+            response += f"  • {escape_md(user)}: {amount:.2f} zł ({percentage:.1f}%)\n"
+    
+    return response
+
+
+def stats_keyboard() -> InlineKeyboardMarkup:
+    """Кнопки для выбора периода статистики"""
+    keyboard = [
+        [
+            InlineKeyboardButton("ЗП период", callback_data="stats_salary"),
+            InlineKeyboardButton("Неделя", callback_data="stats_week"),
+        ],
+        [
+            InlineKeyboardButton("Месяц", callback_data="stats_month"),
+            InlineKeyboardButton("Все время", callback_data="stats_all"),
+        ]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def trends_keyboard() -> InlineKeyboardMarkup:
+    """Кнопки для выбора интервала тренда"""
+    keyboard = [[
+        InlineKeyboardButton("По ЗП периодам", callback_data="trends_salary"),
+        InlineKeyboardButton("По неделям", callback_data="trends_week"),
+    ]]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def format_expense(amount: float, category: str, description: str, username: str) -> str:
+    """Описание расхода для подтверждения"""
+    response = f"💰 {amount:.2f} zł\n"
+    response += f"📂 {category}\n"
+    response += f"📝 {description}\n"
+    response += f"👤 {username}"
+    return response
+
+
+def expense_keyboard(expense_id: int) -> InlineKeyboardMarkup:
+    """Кнопки редактирования и удаления расхода"""
+    keyboard = [
+        [
+            InlineKeyboardButton("✏️ Изменить", callback_data=f"edit_{expense_id}"),
+            InlineKeyboardButton("🗑 Удалить", callback_data=f"delete_{expense_id}")
+        ]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def format_expense_entries(expenses) -> str:
+    """Записи истории или поиска: дата, сумма, категория, описание, ID"""
+    response = ""
+    for exp in expenses:
+        exp_id, user_id, username, amount, category, description, date, _ = exp
+        date_obj = datetime.fromisoformat(date)
+        date_str = date_obj.strftime("%d.%m %H:%M")
         
-        # Если 10 число - выходной, идем назад до рабочего дня
-        while is_weekend(salary_date):
-            salary_date = salary_date - timedelta(days=1)
+        # Длинные описания обрезаем, чтобы страница влезла в одно сообщение
+        if len(description) > HISTORY_DESCRIPTION_MAX:
+            description = description[:HISTORY_DESCRIPTION_MAX - 1] + "…"
         
-        return salary_date
+        response += f"🕐 {date_str}\n"
+        response += f"💰 {amount:.2f} zł | 📂 {escape_md(category)}\n"
+        response += f"📝 {escape_md(description)} | 👤 {escape_md(username)}\n"
+        response += f"ID: {exp_id}\n\n"
+    return response
+
+
+def format_history_page(expenses, limit: int, has_newer: bool, has_older: bool):
+    """Текст страницы истории и кнопки перехода между страницами"""
+    response = f"📝 **Траты ({len(expenses)}):**\n\n"
+    response += format_expense_entries(expenses)
     
-    # Получаем день ЗП текущего месяца
-    current_salary_day = get_salary_day(now.year, now.month)
+    response += "\nДля удаления используйте:\n"
+    response += "/delete [ID] - удалить"
     
-    # Если сегодня до дня ЗП, то период начался в прошлом месяце
-    if now.date() < current_salary_day.date():
-        if now.month == 1:
-            prev_salary_day = get_salary_day(now.year - 1, 12)
-        else:
-            prev_salary_day = get_salary_day(now.year, now.month - 1)
-        return prev_salary_day
-    else:
-        return current_salary_day
+    # В кнопках - позиция первой и последней записи страницы (ts, id)
+    newest, oldest = expenses[0], expenses[-1]
+    buttons = []
+    if has_newer:
+        buttons.append(InlineKeyboardButton(
+            "◀ Новее", callback_data=f"hist_n_{limit}_{newest[7]}_{newest[0]}"))
+    if has_older:
+        buttons.append(InlineKeyboardButton(
+            "Старше ▶", callback_data=f"hist_o_{limit}_{oldest[7]}_{oldest[0]}"))
+    
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return response, reply_markup
+
+
+def search_button(text: str, direction: str, period: str, expense, query: str):
+    """
+    Кнопка страницы поиска. Запрос и период передаются в callback_data,
+    поэтому кнопки работают и после перезапуска бота; если они не
+    помещаются в 64 байта - кнопки нет.
+    """
+    callback_data = f"srch_{direction}_{period}_{expense[7]}_{expense[0]}_{query}"
+    if len(callback_data.encode()) > CALLBACK_DATA_MAX:
+        return None
+    return InlineKeyboardButton(text, callback_data=callback_data)
+
+
+def format_search_page(expenses, query: str, period: str, period_name: str,
+                       count: int, total: float, has_newer: bool, has_older: bool):
+    """Текст страницы поиска с итогом по всем найденным и кнопки перехода"""
+    response = f"🔍 **{escape_md(query)}** · {period_name}\n"
+    response += f"Найдено: {count}, всего {total:.2f} zł\n\n"
+    response += format_expense_entries(expenses)
+    
+    newest, oldest = expenses[0], expenses[-1]
+    buttons = []
+    if has_newer:
+        buttons.append(search_button("◀ Новее", 'n', period, newest, query))
+    if has_older:
+        buttons.append(search_button("Старше ▶", 'o', period, oldest, query))
+    
+    if None in buttons:
+        response += "Запрос слишком длинный для листания - сократите его."
+        buttons = [button for button in buttons if button is not None]
+    
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return response, reply_markup
+
+
+async def get_search_page(household_id: int, query: str, period: str,
+                          before=None, after=None):
+    """Страница результатов поиска от позиции курсора (ts, id): текст и кнопки"""
+    start_date, period_name = get_period_range(period, await get_pay_day(household_id))
+    
+    expenses, has_more = await db.search_expenses(
+        household_id, query, start_date, HISTORY_PAGE_SIZE, before=before, after=after
+    )
+    if not expenses and (before or after):
+        # Записи удалили, пока листали - показываем самые свежие
+        before = after = None
+        expenses, has_more = await db.search_expenses(household_id, query, start_date, HISTORY_PAGE_SIZE)
+    
+    if not expenses:
+        return f"🔍 По запросу «{escape_md(query)}» ничего не найдено ({period_name}).", None
+    
+    # Итог считается по всем совпадениям, а не по странице
+    count, total = await db.get_search_summary(household_id, query, start_date)
+    has_newer = has_more if after else before is not None
+    has_older = True if after else has_more
+    return format_search_page(expenses, query, period, period_name, count, total, has_newer, has_older)
+
+
+async def get_pay_day(household_id: int) -> int:
+    """День зарплаты семьи; из БД читается только при первом обращении"""
+    pay_day = access.pay_day(household_id)
+    if pay_day is None:
+        household = await db.get_household(household_id)
+        pay_day = household[3] if household else DEFAULT_PAY_DAY
+        access.set_pay_day(household_id, pay_day)
+    return pay_day
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -120,13 +411,16 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     username = update.effective_user.first_name or "Пользователь"
     
-    # Добавляем пользователя в разрешенные, если список пуст или меньше 2
-    if len(ALLOWED_USERS) < 2 and user_id not in ALLOWED_USERS:
-        ALLOWED_USERS.append(user_id)
-        logger.info(f"Добавлен пользователь: {user_id} ({username})")
+    household_id = access.household_id(user_id)
+    if household_id is None:
+        family_text = NO_HOUSEHOLD_TEXT
+    else:
+        _, name, _, _ = await db.get_household(household_id)
+        members = await db.get_household_members(household_id)
+        family_text = f"👪 Семья: {escape_md(name)} (участников: {len(members)})"
     
     welcome_text = f"""
-👋 Привет, {username}!
+👋 Привет, {escape_md(username)}!
 
 Я бот для учета семейного бюджета. Вот что я умею:
 
@@ -141,20 +435,75 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📊 **Используйте кнопки ниже** для управления ботом
 
 Ваш ID: `{user_id}`
-Зарегистрированные: {len(ALLOWED_USERS)}/2
 """
     
-    # Создаем кнопочное меню
-    from telegram import KeyboardButton, ReplyKeyboardMarkup
-    
-    keyboard = [
-        [KeyboardButton("📊 Статистика"), KeyboardButton("💰 Баланс")],
-        [KeyboardButton("📝 История"), KeyboardButton("🔍 Мой ID")],
-        [KeyboardButton("📂 Категории"), KeyboardButton("ℹ️ Помощь")]
-    ]
+    # Кнопочное меню: по две кнопки из MENU_COMMANDS в ряд
+    buttons = [KeyboardButton(text) for text in MENU_COMMANDS]
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
     await update.message.reply_text(welcome_text, reply_markup=reply_markup, parse_mode='Markdown')
+    # Название семьи задают пользователи - отправляем без Markdown
+    await update.message.reply_text(family_text)
+
+
+async def new_family(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Создать семью: /newfamily [название]"""
+    user_id = update.effective_user.id
+    username = update.effective_user.first_name or "Пользователь"
+    
+    name = ' '.join(context.args or []).strip() or f"Семья {username}"
+    name = name[:HOUSEHOLD_NAME_MAX]
+    
+    previous = access.household_id(user_id)
+    household_id, join_code = await db.create_household(name, user_id, username)
+    access.set_member(user_id, household_id)
+    logger.info(f"Создана семья {household_id} пользователем {user_id} ({username})")
+    
+    response = f"👪 Семья «{name}» создана!\n\n"
+    response += f"🔑 Код приглашения: {join_code}\n"
+    response += f"Остальные участники отправляют боту: /join {join_code}"
+    if previous is not None:
+        response += "\n\nℹ️ Вы вышли из прежней семьи, ее записи остались у нее."
+    
+    await update.message.reply_text(response)
+
+
+async def join_family(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Вступить в семью по коду: /join КОД"""
+    user_id = update.effective_user.id
+    username = update.effective_user.first_name or "Пользователь"
+    
+    if not context.args:
+        await update.message.reply_text("❓ Используйте: /join КОД\nКод покажет /family у участника семьи.")
+        return
+    
+    household_id = await db.join_household(context.args[0], user_id, username)
+    if household_id is None:
+        await update.message.reply_text("❌ Неверный код приглашения.")
+        return
+    
+    access.set_member(user_id, household_id)
+    logger.info(f"Пользователь {user_id} ({username}) вступил в семью {household_id}")
+    _, name, _, _ = await db.get_household(household_id)
+    members = await db.get_household_members(household_id)
+    await update.message.reply_text(f"✅ Вы в семье «{name}»! Участников: {len(members)}")
+
+
+async def family(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать семью, код приглашения и участников"""
+    household_id = access.household_id(update.effective_user.id)
+    
+    _, name, join_code, _ = await db.get_household(household_id)
+    members = await db.get_household_members(household_id)
+    
+    response = f"👪 Семья «{name}»\n\n"
+    for _, member_name in members:
+        response += f"👤 {member_name}\n"
+    response += f"\n🔑 Код приглашения: {join_code}\n"
+    response += f"Пригласить: /join {join_code}"
+    
+    await update.message.reply_text(response)
 
 
 async def add_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -163,266 +512,405 @@ async def add_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.first_name or "Пользователь"
     
     # Проверка доступа
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
-        await update.message.reply_text("❌ У вас нет доступа к этому боту.")
-        return
+    household_id = access.household_id(update.effective_user.id)
     
     text = update.message.text.strip()
     
-    # Парсим сумму и описание
-    match = re.match(r'^(\d+(?:[.,]\d+)?)\s+(.+)$', text)
+    # Парсим все строки сообщения
+    items, errors = parse_expenses(text)
+    
+    if not items and not errors:
+        return
+    
+    if len(items) + len(errors) > MAX_BATCH_LINES:
+        await update.message.reply_text(
+            f"❌ Слишком много строк: не больше {MAX_BATCH_LINES} за одно сообщение."
+        )
+        return
     
-    if not match:
+    if not items:
         await update.message.reply_text(
             "❓ Не могу распознать формат.\n"
             "Используйте: сумма описание\n"
-            "Например: 500 продукты"
+            "Например: 500 продукты\n"
+            "Можно несколько строк сразу - по одному расходу на строку."
         )
         return
     
-    amount_str, description = match.groups()
-    amount = float(amount_str.replace(',', '.'))
-    
-    # Определяем категорию
-    category = determine_category(description)
-    
-    # Сохраняем в БД
-    expense_id = db.add_expense(user_id, username, amount, category, description)
+    # Определяем категории в потоке БД: исправления семьи, которых нет
+    # в памяти, читаются из category_overrides
+    expenses = await db.run_sync(lambda: [
+        (amount, determine_category(description, household_id), description)
+        for amount, description in items
+    ])
     
-    # Формируем ответ
-    response = f"✅ Добавлено:\n"
-    response += f"💰 {amount:.2f} zł\n"
-    response += f"📂 {category}\n"
-    response += f"📝 {description}\n"
-    response += f"👤 {username}"
+    # Сохраняем все строки одной транзакцией
+    expense_ids = await db.add_expenses(household_id, user_id, username, expenses)
     
-    # Кнопки для редактирования
-    keyboard = [
-        [
-            InlineKeyboardButton("✏️ Изменить", callback_data=f"edit_{expense_id}"),
-            InlineKeyboardButton("🗑 Удалить", callback_data=f"delete_{expense_id}")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(response, reply_markup=reply_markup)
-    
-    # Отправляем уведомление второму пользователю
-    other_user_id = None
-    for uid in ALLOWED_USERS:
-        if uid != user_id:
-            other_user_id = uid
-            break
-    
-    if other_user_id:
-        notification = f"🔔 Новый расход:\n"
-        notification += f"👤 {username}\n"
-        notification += f"💰 {amount:.2f} zł\n"
-        notification += f"📂 {category}\n"
-        notification += f"📝 {description}"
+    if len(expenses) == 1 and not errors:
+        amount, category, description = expenses[0]
         
-        try:
-            await context.bot.send_message(chat_id=other_user_id, text=notification)
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомление: {e}")
+        # Формируем ответ
+        response = "✅ Добавлено:\n" + format_expense(amount, category, description, username)
+        
+        # Кнопки для редактирования
+        reply_markup = expense_keyboard(expense_ids[0])
+        
+        await update.message.reply_text(response, reply_markup=reply_markup)
+    else:
+        total = sum(amount for amount, _, _ in expenses)
+        response = f"✅ Добавлено расходов: {len(expenses)} на {total:.2f} zł\n\n"
+        for expense_id, (amount, category, description) in zip(expense_ids, expenses):
+            response += f"• {amount:.2f} zł | {category} | {description} (ID: {expense_id})\n"
+        
+        if errors:
+            response += "\n❓ Не распознаны строки:\n"
+            for line_number, line in errors:
+                response += f"• {line_number}: {line}\n"
+        
+        response += f"\n👤 {username}"
+        await update.message.reply_text(response)
+    
+    # Уведомления остальным участникам семьи уходят в фоне,
+    # пользователь не ждет запросов к Telegram
+    for member_id, _ in await db.get_household_members(household_id):
+        if member_id != user_id:
+            notifier.notify(member_id, user_id, username, expenses)
 
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать статистику"""
-    user_id = update.effective_user.id
-    
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
-        await update.message.reply_text("❌ У вас нет доступа к этому боту.")
-        return
+    household_id = access.household_id(update.effective_user.id)
     
     # Получаем период (по умолчанию зарплатный период)
     period = 'salary'
     if context.args and context.args[0] in ['week', 'month', 'year', 'all', 'salary']:
         period = context.args[0]
     
-    # Определяем даты
-    now = datetime.now()
-    if period == 'week':
-        start_date = now - timedelta(days=7)
-        period_name = "Последние 7 дней"
-    elif period == 'month':
-        start_date = now.replace(day=1)
-        period_name = "Текущий месяц"
-    elif period == 'year':
-        start_date = now.replace(month=1, day=1)
-        period_name = "Текущий год"
-    elif period == 'salary':
-        start_date = get_salary_period()
-        period_name = f"С {start_date.strftime('%d.%m.%Y')} (зарплатный период)"
-    else:  # all
-        start_date = None
-        period_name = "За все время"
+    start_date, period_name = get_period_range(period, await get_pay_day(household_id))
     
-    # Получаем статистику
-    total = db.get_total(start_date)
-    by_category = db.get_by_category(start_date)
-    by_user = db.get_by_user(start_date)
+    # Получаем статистику одним запросом
+    snapshot = await db.get_stats_snapshot(household_id, start_date)
     
-    # Формируем ответ
-    response = f"📊 **Статистика: {period_name}**\n\n"
-    response += f"💰 **Общая сумма:** {total:.2f} zł\n\n"
+    response = format_stats(snapshot, period_name)
+    reply_markup = stats_keyboard()
     
-    # По категориям
-    if by_category:
-        response += "📂 **По категориям:**\n"
-        for category, amount in by_category:
-            percentage = (amount / total * 100) if total > 0 else 0
-            response += f"  • {category}: {amount:.2f} zł ({percentage:.1f}%)\n"
-        response += "\n"
+    await update.message.reply_text(response, reply_markup=reply_markup, parse_mode='Markdown')
+
+
+BALANCE_ERROR_TEXT = "❌ Не удалось посчитать баланс: суммы участников не сходятся. Попробуйте позже."
+
+
+def format_balance(positions, transfers, by_user_category):
+    """Текст баланса с разбивкой по категориям и кнопки для отметки переводов"""
+    total = sum(position.paid for position in positions)
     
-    # По пользователям
-    if by_user:
-        response += "👥 **По пользователям:**\n"
-        for user, amount in by_user:
-            percentage = (amount / total * 100) if total > 0 else 0
-            response += f"  • {user}: {amount:.2f} zł ({percentage:.1f}%)\n"
+    response = f"💰 **Баланс**\n\n"
     
-    # Кнопки для выбора периода
-    keyboard = [
-        [
-            InlineKeyboardButton("ЗП период", callback_data="stats_salary"),
-            InlineKeyboardButton("Неделя", callback_data="stats_week"),
-        ],
-        [
-            InlineKeyboardButton("Месяц", callback_data="stats_month"),
-            InlineKeyboardButton("Все время", callback_data="stats_all"),
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Кто сколько оплатил в каждой категории
+    categories = {}
+    for username, category, amount in by_user_category:
+        categories.setdefault(category, []).append((username, amount))
+    for category, amounts in categories.items():
+        response += f"📂 **{escape_md(category)}:**\n"
+        for username, amount in amounts:
+            response += f"  👤 {escape_md(username)}: {amount:.2f} zł\n"
+        response += f"  📊 Всего: {sum(amount for _, amount in amounts):.2f} zł\n\n"
+    
+    response += f"💵 **Оплачено:**\n"
+    for position in sorted(positions, key=lambda position: position.paid, reverse=True):
+        percentage = (position.paid / total * 100) if total > 0 else 0
+        response += f"  👤 {escape_md(position.username)}: {position.paid:.2f} zł ({percentage:.1f}%)\n"
     
-    await update.message.reply_text(response, reply_markup=reply_markup, parse_mode='Markdown')
+    response += f"\n📊 Всего потрачено: {total:.2f} zł\n"
+    if len(positions) > 1:
+        response += f"⚖️ **Доля каждого:** {positions[0].share:.2f} zł\n"
+    
+    if not transfers:
+        response += "\n✅ Вы квиты! 🎉"
+        return response, None
+    
+    response += f"\n💸 **Кто кому должен:**\n"
+    keyboard = []
+    for transfer in transfers:
+        response += (f"  **{escape_md(transfer.from_username)}** → **{escape_md(transfer.to_username)}**: "
+                     f"{transfer.amount:.2f} zł\n")
+        keyboard.append([InlineKeyboardButton(
+            f"✅ {transfer.from_username} → {transfer.to_username}: {transfer.amount:.2f} zł",
+            callback_data=f"settle_{transfer.from_user_id}_{transfer.to_user_id}_{round(transfer.amount * 100)}"
+        )])
+    response += "\nНажмите на перевод, когда он сделан."
+    return response, InlineKeyboardMarkup(keyboard)
+
+
+async def get_balance(household_id: int):
+    """
+    Текст баланса и кнопки, позиции участников и переводы, которые гасят долги.
+    Если позиции не сходятся, они пересчитываются по расходам и переводам;
+    не помогло - вместо текста BALANCE_ERROR_TEXT, позиций нет (None).
+    """
+    members = await db.get_household_members(household_id)
+    try:
+        positions = compute_positions(await db.get_positions(household_id), members)
+    except ValueError as error:
+        logger.warning(f"Семья {household_id}: {error}, пересчитываю позиции")
+        await db.rebuild_positions(household_id)
+        try:
+            positions = compute_positions(await db.get_positions(household_id), members)
+        except ValueError as error:
+            logger.error(f"Семья {household_id}: {error} и после пересчета")
+            return BALANCE_ERROR_TEXT, None, None, []
+    
+    transfers = minimal_transfers(positions)
+    by_user_category = await db.get_by_user_and_category(household_id)
+    response, reply_markup = format_balance(positions, transfers, by_user_category)
+    return response, reply_markup, positions, transfers
 
 
 async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показать баланс между пользователями с разбивкой по категориям"""
-    user_id = update.effective_user.id
+    """Показать, сколько оплатил каждый и кто кому должен"""
+    household_id = access.household_id(update.effective_user.id)
+    
+    # Позиции поддерживаются триггерами - чтение не зависит от длины истории
+    response, reply_markup, positions, _ = await get_balance(household_id)
     
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
-        await update.message.reply_text("❌ У вас нет доступа к этому боту.")
+    if positions is not None and not any(position.paid for position in positions):
+        await update.message.reply_text("📊 Пока нет данных для расчета баланса.")
         return
     
-    # Получаем детальную статистику по пользователям и категориям
-    by_user_category = db.get_by_user_and_category()
+    await update.message.reply_text(response, reply_markup=reply_markup, parse_mode='Markdown')
+
+
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать последние траты"""
+    household_id = access.household_id(update.effective_user.id)
     
-    if not by_user_category:
-        await update.message.reply_text("📊 Пока нет данных для расчета баланса.")
+    limit = HISTORY_PAGE_SIZE
+    if context.args and context.args[0].isdigit():
+        limit = min(int(context.args[0]), HISTORY_PAGE_MAX)
+    
+    expenses, has_older = await db.get_history_page(household_id, limit)
+    
+    if not expenses:
+        await update.message.reply_text("📝 История трат пуста.")
         return
     
-    # Группируем данные
-    user_totals = {}
-    category_totals = {'Еда': 0, 'Прочее': 0}
-    user_category_amounts = {}
+    response, reply_markup = format_history_page(expenses, limit, has_newer=False, has_older=has_older)
     
-    for username, category, amount in by_user_category:
-        # Общие суммы по пользователям
-        if username not in user_totals:
-            user_totals[username] = 0
-        user_totals[username] += amount
-        
-        # Суммы по категориям
-        category_totals[category] += amount
-        
-        # Суммы по пользователям и категориям
-        key = (username, category)
-        user_category_amounts[key] = amount
+    await update.message.reply_text(response, reply_markup=reply_markup, parse_mode='Markdown')
+
+
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Найти траты по описанию: /search запрос [период]"""
+    household_id = access.household_id(update.effective_user.id)
     
-    # Формируем ответ
-    response = f"💰 **Баланс**\n\n"
+    args = list(context.args or [])
+    period = 'all'
+    if len(args) > 1 and args[-1].lower() in ['week', 'month', 'year', 'all', 'salary']:
+        period = args.pop().lower()
     
-    # Показываем разбивку по категориям для каждого пользователя
-    users = list(user_totals.keys())
+    query = ' '.join(search_terms(' '.join(args)))
+    if not query:
+        await update.message.reply_text(
+            "❓ Используйте: /search запрос [week|month|year|salary|all]\n"
+            "Например: /search lidl month"
+        )
+        return
     
-    for category in ['Еда', 'Прочее']:
-        response += f"📂 **{category}:**\n"
-        for user in users:
-            amount = user_category_amounts.get((user, category), 0)
-            response += f"  👤 {user}: {amount:.2f} zł\n"
-        response += f"  📊 Всего: {category_totals[category]:.2f} zł\n\n"
+    response, reply_markup = await get_search_page(household_id, query, period)
+    await update.message.reply_text(response, reply_markup=reply_markup, parse_mode='Markdown')
+
+
+async def periods(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Траты по зарплатным периодам: /periods [количество]"""
+    household_id = access.household_id(update.effective_user.id)
     
-    # Общие итоги
-    total = sum(user_totals.values())
-    response += f"💵 **Итого:**\n"
-    for user, amount in user_totals.items():
-        percentage = (amount / total * 100) if total > 0 else 0
-        response += f"  👤 {user}: {amount:.2f} zł ({percentage:.1f}%)\n"
+    count = SALARY_PERIODS_DEFAULT
+    if context.args and context.args[0].isdigit():
+        count = max(1, min(int(context.args[0]), SALARY_PERIODS_MAX))
     
-    response += f"\n📊 Всего потрачено: {total:.2f} zł\n"
+    pay_day = await get_pay_day(household_id)
+    totals = await db.get_salary_period_totals(household_id, pay_day, count, datetime.now().date())
     
-    # Расчет кто кому должен
-    if len(users) == 2:
-        half = total / 2
-        user1, user2 = users[0], users[1]
-        amount1, amount2 = user_totals[user1], user_totals[user2]
-        
-        difference = abs(amount1 - amount2)
-        
-        if difference > 1:
-            who_owes = user1 if amount1 < amount2 else user2
-            who_paid_more = user2 if amount1 < amount2 else user1
-            response += f"\n💸 **{who_owes}** должен **{who_paid_more}**: {difference/2:.2f} zł"
-        else:
-            response += "\n✅ Вы квиты! 🎉"
+    response = f"🗓 **Зарплатные периоды** (ЗП {pay_day} числа)\n\n"
+    for index, (start_date, end_date, amount, records) in enumerate(totals):
+        last_day = end_date - timedelta(days=1)
+        response += f"{start_date.strftime('%d.%m.%Y')} – {last_day.strftime('%d.%m.%Y')}: "
+        response += f"**{amount:.2f} zł** ({records})"
+        response += " ← текущий\n" if index == 0 else "\n"
+    
+    if len(totals) > 1:
+        closed = [amount for _, _, amount, _ in totals[1:]]
+        response += f"\n📊 В среднем за прошлые периоды: {sum(closed) / len(closed):.2f} zł"
     
     await update.message.reply_text(response, parse_mode='Markdown')
 
 
-async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показать последние траты"""
-    user_id = update.effective_user.id
-    
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
-        await update.message.reply_text("❌ У вас нет доступа к этому боту.")
+async def send_trends(message, household_id: int, period: str):
+    """Отправить график тренда с подписью"""
+    if not trends_available():
+        await message.reply_text("❌ Графики недоступны на сервере (нет numpy/matplotlib).")
         return
     
-    limit = 10
-    if context.args and context.args[0].isdigit():
-        limit = int(context.args[0])
+    png, caption = await trend_charts.build(household_id, period, await get_pay_day(household_id))
+    await message.reply_photo(png, caption=caption, reply_markup=trends_keyboard())
+
+
+async def trends(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """График трат по категориям за год: /trends [salary|week]"""
+    household_id = access.household_id(update.effective_user.id)
     
-    expenses = db.get_recent_expenses(limit)
+    period = DEFAULT_TREND_PERIOD
+    if context.args and context.args[0] in TREND_PERIODS:
+        period = context.args[0]
     
-    if not expenses:
-        await update.message.reply_text("📝 История трат пуста.")
+    await send_trends(update.message, household_id, period)
+
+
+async def pay_day_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Изменить день зарплаты семьи: /payday ЧИСЛО"""
+    household_id = access.household_id(update.effective_user.id)
+    
+    if not context.args or not context.args[0].isdigit() or not 1 <= int(context.args[0]) <= 31:
+        pay_day = await get_pay_day(household_id)
+        await update.message.reply_text(
+            f"🗓 Сейчас зарплата {pay_day} числа.\nИзменить: /payday ЧИСЛО (1-31)"
+        )
         return
     
-    response = f"📝 **Последние {len(expenses)} трат:**\n\n"
+    pay_day = int(context.args[0])
+    await db.set_pay_day(household_id, pay_day)
+    access.set_pay_day(household_id, pay_day)
+    start_date = get_salary_period(pay_day)
+    await update.message.reply_text(
+        f"✅ День зарплаты: {pay_day} число (если выходной или праздник - ближайший рабочий день раньше)\n"
+        f"Текущий период начался {start_date.strftime('%d.%m.%Y')}"
+    )
+
+
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выгрузить расходы файлом: /export [период] [csv|xlsx]"""
+    household_id = access.household_id(update.effective_user.id)
+    
+    period = 'all'
+    fmt = 'csv'
+    for arg in context.args or []:
+        arg = arg.lower()
+        if arg in EXPORT_FORMATS:
+            fmt = arg
+        elif arg in ['week', 'month', 'year', 'all', 'salary']:
+            period = arg
+        else:
+            await update.message.reply_text(
+                "❓ Используйте: /export [week|month|year|salary|all] [csv|xlsx]"
+            )
+            return
+    
+    if fmt == 'xlsx' and not xlsx_available():
+        await update.message.reply_text("❌ XLSX недоступен на сервере (нет openpyxl), используйте csv.")
+        return
     
-    for exp in expenses:
-        exp_id, user_id, username, amount, category, description, date = exp
-        date_obj = datetime.fromisoformat(date)
-        date_str = date_obj.strftime("%d.%m %H:%M")
-        
-        response += f"🕐 {date_str}\n"
-        response += f"💰 {amount:.2f} zł | 📂 {category}\n"
-        response += f"📝 {description} | 👤 {username}\n"
-        response += f"ID: {exp_id}\n\n"
+    start_date, period_name = get_period_range(period, await get_pay_day(household_id))
     
-    response += "\nДля редактирования используйте:\n"
-    response += "/edit [ID] - изменить\n"
-    response += "/delete [ID] - удалить"
+    # Файл собирается в потоке БД, цикл событий не блокируется
+    fileobj, count = await db.run_sync(export_expenses, db.db, household_id, fmt, start_date)
     
-    await update.message.reply_text(response, parse_mode='Markdown')
+    with fileobj:
+        if not count:
+            await update.message.reply_text(f"📭 Нет расходов: {period_name}.")
+            return
+        
+        # При отправке python-telegram-bot читает файл в память целиком
+        size = file_size(fileobj)
+        if size > EXPORT_MAX_SIZE:
+            await update.message.reply_text(
+                f"❌ Файл получился {size / 1024 / 1024:.0f} МБ - больше "
+                f"{EXPORT_MAX_SIZE // 1024 // 1024} МБ. Выберите период короче."
+            )
+            return
+        
+        filename = f"expenses_{period}_{datetime.now().strftime('%Y%m%d')}.{fmt}"
+        await update.message.reply_document(
+            document=fileobj,
+            filename=filename,
+            caption=f"📤 {period_name}: {count} записей"
+        )
 
 
-async def delete_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Удалить расход"""
+def format_import_progress(result) -> str:
+    return (f"⏳ Импорт {result.bank}: обработано строк {result.rows}, "
+            f"добавлено {result.inserted}")
+
+
+async def wait_progress_edits(edits):
+    """
+    Дождаться промежуточных правок сообщения о прогрессе: иначе запоздавшая
+    правка может лечь поверх итогового сообщения
+    """
+    results = await asyncio.gather(*(asyncio.wrap_future(edit) for edit in edits),
+                                   return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning(f"Не удалось показать прогресс импорта: {result}")
+
+
+async def import_statement(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Импорт CSV-выписки банка, присланной документом"""
     user_id = update.effective_user.id
+    username = update.effective_user.first_name or "Пользователь"
+    
+    household_id = access.household_id(update.effective_user.id)
     
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
-        await update.message.reply_text("❌ У вас нет доступа к этому боту.")
+    document = update.message.document
+    if document.file_size and document.file_size > MAX_IMPORT_FILE_SIZE:
+        await update.message.reply_text("❌ Файл больше 20 МБ - Telegram не даст боту его скачать.")
         return
     
+    status = await update.message.reply_text("⏳ Загружаю выписку...")
+    loop = asyncio.get_running_loop()
+    progress_edits = []
+    
+    def progress(result):
+        # Вызывается из потока БД - передаем редактирование в цикл событий
+        progress_edits.append(asyncio.run_coroutine_threadsafe(
+            status.edit_text(format_import_progress(result)), loop
+        ))
+    
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as fileobj:
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_memory(out=fileobj)
+        fileobj.seek(0)
+        
+        try:
+            result = await db.run_sync(
+                run_import, db.db, fileobj, household_id, user_id, username, progress
+            )
+        except ImportFormatError as e:
+            await wait_progress_edits(progress_edits)
+            await status.edit_text(f"❌ {e}")
+            return
+    
+    await wait_progress_edits(progress_edits)
+    await status.edit_text(
+        f"✅ Импорт {result.bank} завершен\n\n"
+        f"📄 Строк в выписке: {result.rows}\n"
+        f"➕ Добавлено расходов: {result.inserted}\n"
+        f"🔁 Уже были в базе: {result.duplicates}\n"
+        f"⏭ Пропущено (поступления и прочее): {result.skipped}"
+    )
+
+
+async def delete_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Удалить расход"""
+    household_id = access.household_id(update.effective_user.id)
+    
     if not context.args or not context.args[0].isdigit():
         await update.message.reply_text("❓ Используйте: /delete [ID]")
         return
     
     expense_id = int(context.args[0])
     
-    if db.delete_expense(expense_id):
+    if await db.delete_expense(household_id, expense_id):
         await update.message.reply_text("✅ Расход удален!")
     else:
         await update.message.reply_text("❌ Расход не найден.")
@@ -448,14 +936,13 @@ async def my_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.first_name or "Пользователь"
     
     response = f"🆔 **Ваша информация:**\n\n"
-    response += f"👤 Имя: {username}\n"
+    response += f"👤 Имя: {escape_md(username)}\n"
     response += f"🔢 Telegram ID: `{user_id}`\n\n"
     
-    if ALLOWED_USERS:
-        if user_id in ALLOWED_USERS:
-            response += "✅ У вас есть доступ к боту"
-        else:
-            response += "❌ У вас нет доступа к боту"
+    if access.household_id(user_id) is not None:
+        response += "✅ Вы состоите в семье - /family"
+    else:
+        response += "❌ Вы пока не в семье - /newfamily или /join КОД"
     
     await update.message.reply_text(response, parse_mode='Markdown')
 
@@ -472,18 +959,47 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • 120 taxi
 • 35.50 кафе
 
+🧾 **Несколько расходов сразу:**
+По одному на строку, сумма в начале или в конце:
+```
+biedronka 45,20
+- кафе 30
+120 taxi
+```
+
 📊 **Кнопки:**
 • Статистика - траты за зарплатный период
-• Баланс - кто сколько потратил
+• Баланс - кто сколько оплатил и кто кому должен; кнопкой под переводом отметьте, что долг отдан
 • История - последние траты
 • Мой ID - ваш Telegram ID
 • Категории - список категорий
 
+📤 **Выгрузка:**
+/export [week|month|year|salary|all] [csv|xlsx] - файл со всеми тратами
+
+📥 **Импорт:**
+Пришлите CSV-выписку mBank, PKO BP или ING документом - списания добавятся как расходы, повторы пропускаются
+
 🗓 **Зарплатный период:**
-Считается с 10 числа (или ближайшего рабочего дня)
+Считается с дня зарплаты (по умолчанию 10 число; если выходной или праздник - ближайший рабочий день раньше)
+/payday ЧИСЛО - изменить день зарплаты
+/periods [N] - траты по последним периодам
+
+🔍 **Поиск:**
+/search lidl - траты по описанию и их сумма
+/search lidl month - то же за период (week|month|year|salary|all)
+
+📈 **Тренды:**
+/trends - график трат по категориям за год по ЗП периодам
+/trends week - то же по неделям
+
+👪 **Семья:**
+/newfamily [название] - создать семью
+/join КОД - вступить по коду приглашения
+/family - участники и код приглашения
 
 💡 **Уведомления:**
-Когда один добавляет расход, второй получает уведомление!
+Когда один добавляет расход, остальные участники семьи получают уведомление!
 """
     await update.message.reply_text(response, parse_mode='Markdown')
 
@@ -493,122 +1009,340 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
+    household_id = access.household_id(update.effective_user.id)
+    
     data = query.data
     
     # Обработка статистики
     if data.startswith('stats_'):
         period = data.replace('stats_', '')
         
-        # Определяем даты
-        now = datetime.now()
-        if period == 'week':
-            start_date = now - timedelta(days=7)
-            period_name = "Последние 7 дней"
-        elif period == 'month':
-            start_date = now.replace(day=1)
-            period_name = "Текущий месяц"
-        elif period == 'year':
-            start_date = now.replace(month=1, day=1)
-            period_name = "Текущий год"
-        elif period == 'salary':
-            start_date = get_salary_period()
-            period_name = f"С {start_date.strftime('%d.%m.%Y')} (зарплатный период)"
-        else:  # all
-            start_date = None
-            period_name = "За все время"
+        start_date, period_name = get_period_range(period, await get_pay_day(household_id))
         
-        # Получаем статистику
-        total = db.get_total(start_date)
-        by_category = db.get_by_category(start_date)
-        by_user = db.get_by_user(start_date)
+        snapshot = await db.get_stats_snapshot(household_id, start_date)
         
-        # Формируем ответ
-        response = f"📊 **Статистика: {period_name}**\n\n"
-        response += f"💰 **Общая сумма:** {total:.2f} zł\n\n"
+        response = format_stats(snapshot, period_name)
+        reply_markup = stats_keyboard()
         
-        if by_category:
-            response += "📂 **По категориям:**\n"
-            for category, amount in by_category:
-                percentage = (amount / total * 100) if total > 0 else 0
-                response += f"  • {category}: {amount:.2f} zł ({percentage:.1f}%)\n"
-            response += "\n"
+        await query.edit_message_text(response, reply_markup=reply_markup, parse_mode='Markdown')
+    
+    # График тренда с другим интервалом - новым сообщением
+    elif data.startswith('trends_'):
+        period = data.replace('trends_', '')
+        if period in TREND_PERIODS:
+            await send_trends(query.message, household_id, period)
+    
+    # Отметка перевода в счет долга
+    elif data.startswith('settle_'):
+        from_user_id, to_user_id, cents = map(int, data.replace('settle_', '').split('_'))
+        response, reply_markup, positions, transfers = await get_balance(household_id)
+        if positions is None:
+            await query.edit_message_text(response)
+            return
         
-        if by_user:
-            response += "👥 **По пользователям:**\n"
-            for user, amount in by_user:
-                percentage = (amount / total * 100) if total > 0 else 0
-                response += f"  • {user}: {amount:.2f} zł ({percentage:.1f}%)\n"
+        # Повторное нажатие или устаревшие кнопки: такого перевода в плане уже нет
+        transfer = find_transfer(transfers, from_user_id, to_user_id, cents / 100)
+        if transfer is None:
+            await query.edit_message_text(
+                "ℹ️ Баланс уже изменился.\n\n" + response,
+                reply_markup=reply_markup, parse_mode='Markdown'
+            )
+            return
         
-        # Те же кнопки
-        keyboard = [
-            [
-                InlineKeyboardButton("ЗП период", callback_data="stats_salary"),
-                InlineKeyboardButton("Неделя", callback_data="stats_week"),
-            ],
-            [
-                InlineKeyboardButton("Месяц", callback_data="stats_month"),
-                InlineKeyboardButton("Все время", callback_data="stats_all"),
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        settlement_id = await db.add_settlement(
+            household_id, transfer.from_user_id, transfer.from_username,
+            transfer.to_user_id, transfer.to_username, transfer.amount,
+            update.effective_user.id
+        )
+        response, reply_markup, _, _ = await get_balance(household_id)
         
-        await query.edit_message_text(response, reply_markup=reply_markup, parse_mode='Markdown')
+        keyboard = list(reply_markup.inline_keyboard) if reply_markup else []
+        keyboard.append([InlineKeyboardButton("↩️ Отменить перевод", callback_data=f"unsettle_{settlement_id}")])
+        await query.edit_message_text(
+            f"✅ Записан перевод: {escape_md(transfer.from_username)} → {escape_md(transfer.to_username)}, "
+            f"{transfer.amount:.2f} zł\n\n" + response,
+            reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown'
+        )
+    
+    # Отмена ошибочно отмеченного перевода
+    elif data.startswith('unsettle_'):
+        settlement_id = int(data.replace('unsettle_', ''))
+        deleted = await db.delete_settlement(household_id, settlement_id)
+        response, reply_markup, _, _ = await get_balance(household_id)
+        prefix = "↩️ Перевод отменен.\n\n" if deleted else ""
+        await query.edit_message_text(prefix + response, reply_markup=reply_markup, parse_mode='Markdown')
     
     # Удаление расхода
     elif data.startswith('delete_'):
         expense_id = int(data.replace('delete_', ''))
-        if db.delete_expense(expense_id):
+        if await db.delete_expense(household_id, expense_id):
             await query.edit_message_text("✅ Расход удален!")
         else:
             await query.edit_message_text("❌ Ошибка при удалении.")
+    
+    # Переход по страницам истории
+    elif data.startswith('hist_'):
+        _, direction, limit, ts, expense_id = data.split('_')
+        position = (int(ts), int(expense_id))
+        
+        if direction == 'n':
+            expenses, has_newer = await db.get_history_page(household_id, int(limit), after=position)
+            has_older = True
+        else:
+            expenses, has_older = await db.get_history_page(household_id, int(limit), before=position)
+            has_newer = True
+        
+        if not expenses:
+            # Записи удалили, пока листали - показываем самые свежие
+            expenses, has_older = await db.get_history_page(household_id, int(limit))
+            has_newer = False
+        
+        if not expenses:
+            await query.edit_message_text("📝 История трат пуста.")
+            return
+        
+        response, reply_markup = format_history_page(expenses, int(limit), has_newer, has_older)
+        await query.edit_message_text(response, reply_markup=reply_markup, parse_mode='Markdown')
+    
+    # Переход по страницам поиска
+    elif data.startswith('srch_'):
+        _, direction, period, ts, expense_id, search_query = data.split('_', 5)
+        position = (int(ts), int(expense_id))
+        
+        if direction == 'n':
+            response, reply_markup = await get_search_page(household_id, search_query, period, after=position)
+        else:
+            response, reply_markup = await get_search_page(household_id, search_query, period, before=position)
+        await query.edit_message_text(response, reply_markup=reply_markup, parse_mode='Markdown')
+    
+    # Выбор новой категории
+    elif data.startswith('edit_'):
+        expense_id = int(data.replace('edit_', ''))
+        expense = await db.get_expense_by_id(household_id, expense_id)
+        if not expense:
+            await query.edit_message_text("❌ Расход не найден.")
+            return
+        
+        _, _, username, amount, category, description, _ = expense
+        
+        # В callback_data передаем номер категории - так короче
+        keyboard = [
+            [InlineKeyboardButton(
+                f"{'✅ ' if name == category else ''}{name}",
+                callback_data=f"setcat_{expense_id}_{index}"
+            )]
+            for index, name in enumerate(get_all_categories())
+        ]
+        keyboard.append([InlineKeyboardButton("🗑 Удалить", callback_data=f"delete_{expense_id}")])
+        
+        await query.edit_message_text(
+            "✏️ Выберите категорию:\n" + format_expense(amount, category, description, username),
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    
+    # Сохранение новой категории и запоминание магазина
+    elif data.startswith('setcat_'):
+        expense_id, index = map(int, data.replace('setcat_', '').split('_'))
+        all_categories = get_all_categories()
+        expense = await db.get_expense_by_id(household_id, expense_id)
+        if not expense or index >= len(all_categories):
+            await query.edit_message_text("❌ Расход не найден.")
+            return
+        
+        _, _, username, amount, _, description, _ = expense
+        category = all_categories[index]
+        
+        await db.update_expense(household_id, expense_id, category=category)
+        
+        # В следующий раз этот магазин сразу попадет в выбранную категорию
+        merchant = learn_category(household_id, description, category)
+        if merchant:
+            await db.set_category_override(household_id, merchant, category)
+        
+        response = "✅ Категория изменена:\n" + format_expense(amount, category, description, username)
+        if merchant:
+            response += f"\n\n🧠 Запомнил: «{merchant}» → {category}"
+        
+        await query.edit_message_text(response, reply_markup=expense_keyboard(expense_id))
+
+
+async def post_init(application: Application):
+    """Подготовка при запуске бота"""
+    # Выученные категории магазинов
+    load_learned_categories(await db.get_category_overrides(LEARNED_CACHE_SIZE),
+                            loader=db.db.get_category_override)
+    # Участники из старого списка остаются в первой семье
+    await db.add_household_members(
+        DEFAULT_HOUSEHOLD_ID, [(user_id, f"ID {user_id}") for user_id in ALLOWED_USERS]
+    )
+    await access.reload()
+    await notifier.start(application.bot)
+
+
+async def post_shutdown(application: Application):
+    """Дослать уведомления и закрыть соединения с БД при остановке бота"""
+    await notifier.stop()
+    trend_charts.close()
+    await db.close()
+
+
+def get_webhook_url(path: str):
+    """
+    Публичный адрес бота для webhook. На Render он задается автоматически
+    (RENDER_EXTERNAL_URL); если адреса нет, бот работает через polling.
+    """
+    base_url = os.getenv('WEBHOOK_URL') or os.getenv('RENDER_EXTERNAL_URL')
+    if not base_url:
+        return None
+    return base_url.rstrip('/') + path
+
+
+async def load_webserver():
+    """HTTP-сервер на aiohttp импортируется в потоке, пока цикл событий занят другим"""
+    return await asyncio.to_thread(startup_timer.timed, 'import aiohttp', importlib.import_module, 'webserver')
+
+
+async def start_http(application: Application, webserver, port: int, secret_token=None):
+    """Запустить HTTP-сервер; если порт здоровья уже открыт - на том же сокете"""
+    web_app = webserver.create_web_app(application, secret_token)
+    sock = early_health.handover() if early_health else None
+    return await webserver.start_web_server(web_app, port, sock=sock)
+
+
+async def run_bot(application: Application, token: str):
+    """Запустить HTTP-сервер и бота в одном цикле событий и ждать сигнала остановки"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass  # Windows: остановка через KeyboardInterrupt
+    
+    # База (уже открывается с main) и aiohttp загружаются в фоне, пока бот
+    # подключается к Telegram. Health check все это время отвечает с раннего порта
+    db_opening = asyncio.ensure_future(db.open())
+    webserver_loading = asyncio.ensure_future(load_webserver())
+    
+    runner = None
+    try:
+        with startup_timer.phase('telegram connect'):
+            await application.initialize()
+        try:
+            webserver = await webserver_loading
+            webhook_url = get_webhook_url(webserver.WEBHOOK_PATH)
+            secret_token = os.getenv('WEBHOOK_SECRET') or webserver.derive_secret_token(token)
+            port = int(os.environ.get('PORT', 10000))
+            runner = await start_http(application, webserver, port, secret_token if webhook_url else None)
+            
+            await db_opening
+            with startup_timer.phase('post init'):
+                await post_init(application)
+            await application.start()
+            
+            if webhook_url:
+                await application.bot.set_webhook(
+                    url=webhook_url,
+                    secret_token=secret_token,
+                    allowed_updates=Update.ALL_TYPES
+                )
+                logger.info(f"🤖 Бот запущен (webhook: {webhook_url})")
+            else:
+                await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+                logger.info("🤖 Бот запущен (polling)")
+            
+            startup_timer.mark('ready')
+            logger.info(f"Запуск по фазам:\n{startup_timer.report()}")
+            
+            await stop_event.wait()
+            
+            if application.updater.running:
+                await application.updater.stop()
+            await application.stop()
+            await post_shutdown(application)
+        finally:
+            await application.shutdown()
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+
+async def startup_report(application: Application):
+    """
+    Все фазы запуска, кроме подключения к Telegram: импорты, открытие базы
+    и HTTP-сервер. Печатает время по фазам и завершается.
+    """
+    db_opening = asyncio.ensure_future(db.open())
+    webserver = await load_webserver()
+    runner = await start_http(application, webserver, 0)
+    await db_opening
+    startup_timer.mark('ready')
+    
+    await runner.cleanup()
+    await db.close()
+    print(startup_timer.report())
 
 
 def main():
     """Запуск бота"""
-    # Запускаем HTTP-сервер для Render (чтобы не падал)
-    start_health_check_server()
+    import argparse
+    parser = argparse.ArgumentParser(description="Telegram бот для учета семейного бюджета")
+    parser.add_argument('--startup-report', action='store_true',
+                        help="напечатать время импортов и инициализации по фазам и выйти")
+    args = parser.parse_args()
     
     # Получаем токен из переменных окружения
     token = os.getenv('TELEGRAM_BOT_TOKEN')
     
-    if not token:
+    if not token and not args.startup_report:
         raise ValueError("Не найден TELEGRAM_BOT_TOKEN в переменных окружения!")
     
+    # База открывается в фоне, пока создается приложение и идет подключение к Telegram
+    db.start_opening()
+    
     # Создаем приложение
-    application = Application.builder().token(token).build()
-    
-    # Регистрируем обработчики команд
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("stats", stats))
-    application.add_handler(CommandHandler("balance", balance))
-    application.add_handler(CommandHandler("history", history))
-    application.add_handler(CommandHandler("delete", delete_expense))
-    application.add_handler(CommandHandler("categories", show_categories))
-    application.add_handler(CommandHandler("myid", my_id))
-    application.add_handler(CommandHandler("help", help_command))
+    with startup_timer.phase('build application'):
+        application = Application.builder().token(token or 'startup-report').build()
+    
+    # Проверка доступа и лимитов раньше всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, access.check), group=-1)
+    
+    # Регистрируем обработчики команд; кнопки меню вызывают те же обработчики
+    command_handlers = {
+        "start": start,
+        "stats": stats,
+        "balance": balance,
+        "history": history,
+        "search": search,
+        "periods": periods,
+        "payday": pay_day_command,
+        "trends": trends,
+        "export": export,
+        "delete": delete_expense,
+        "categories": show_categories,
+        "myid": my_id,
+        "newfamily": new_family,
+        "join": join_family,
+        "family": family,
+        "help": help_command,
+    }
+    for command, callback in command_handlers.items():
+        application.add_handler(CommandHandler(command, callback))
     
     # Обработчик кнопок
     application.add_handler(CallbackQueryHandler(button_callback))
     
+    # Выписки банков; block=False - долгий импорт не задерживает другие сообщения
+    application.add_handler(MessageHandler(filters.Document.ALL, import_statement, block=False))
+    
     # Обработчик кнопок меню (текстовые сообщения)
     async def menu_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        text = update.message.text
-        
-        if text == "📊 Статистика":
-            await stats(update, context)
-        elif text == "💰 Баланс":
-            await balance(update, context)
-        elif text == "📝 История":
-            await history(update, context)
-        elif text == "🔍 Мой ID":
-            await my_id(update, context)
-        elif text == "📂 Категории":
-            await show_categories(update, context)
-        elif text == "ℹ️ Помощь":
-            await help_command(update, context)
-        else:
+        command = MENU_COMMANDS.get(update.message.text)
+        if command is None:
             # Если не кнопка меню, обрабатываем как добавление расхода
             await add_expense(update, context)
+            return
+        await command_handlers[command](update, context)
     
     # Обработчик текстовых сообщений
     application.add_handler(MessageHandler(
@@ -616,9 +1350,19 @@ def main():
         menu_button_handler
     ))
     
+    # Метрики задержки и ошибок для всех обработчиков
+    instrument_application(application)
+    startup_timer.mark('handlers registered')
+    
+    if args.startup_report:
+        asyncio.run(startup_report(application))
+        return
+    
     # Запускаем бота
-    logger.info("🤖 Бот запущен!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        asyncio.run(run_bot(application, token))
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == '__main__':
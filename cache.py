@@ -0,0 +1,100 @@
+"""
+Кэш результатов запросов к базе данных
+
+Каждая запись помнит версию данных, при которой была посчитана.
+Любая запись в БД увеличивает версию, и старые результаты
+перестают считаться актуальными без явной очистки кэша.
+"""
+
+import functools
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Tuple
+
+DEFAULT_CACHE_SIZE = 256
+
+
+class QueryCache:
+    """LRU-кэш с ограниченным размером и счетчиками попаданий"""
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, version: int) -> Tuple[bool, Any]:
+        """Вернуть (найдено, значение) для ключа при текущей версии данных"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+
+            if entry is not None:
+                # Данные изменились - запись устарела
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key: Hashable, version: int, value: Any):
+        """Сохранить значение, вытеснив самые старые записи при переполнении"""
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Очистить кэш"""
+        with self._lock:
+            self._entries.clear()
+
+    def discard(self, first_arg: Hashable) -> int:
+        """
+        Удалить записи cached_query, у которых первый аргумент запроса равен
+        first_arg (например, все запросы одной семьи). Возвращает число удаленных.
+        """
+        with self._lock:
+            keys = [key for key in self._entries if key[1][:1] == (first_arg,)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики кэша"""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+def cached_query(method):
+    """
+    Декоратор для методов Database: результат кэшируется по имени метода
+    и аргументам и действителен, пока не изменится self.data_version.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        # Версию берем до запроса: если запись случится во время запроса,
+        # результат сохранится со старой версией и не будет использован
+        version = self.data_version
+
+        found, value = self.cache.get(key, version)
+        if found:
+            return value
+
+        value = method(self, *args, **kwargs)
+        self.cache.put(key, version, value)
+        return value
+
+    return wrapper
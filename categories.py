@@ -2,6 +2,11 @@
 Модуль для автоматического определения категории по описанию
 """
 
+import re
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
 # Словарь категорий и ключевых слов
 CATEGORIES = {
     'Еда': [
@@ -24,27 +29,213 @@ CATEGORIES = {
 
 DEFAULT_CATEGORY = 'Прочее'
 
+# Основы слов: находятся и как начало более длинного слова ("ресторан" в
+# "ресторане", "sklep" в "sklepie"). Остальные ключевые слова ищутся только
+# целым словом, чтобы "dino" не находилось в "dinozaur".
+STEM_KEYWORDS = frozenset({
+    'ресторан', 'супермаркет', 'ашан', 'хлеб', 'sklep', 'kebab', 'mcdonald',
+})
+
+# Сколько выученных исправлений категорий держим в памяти
+LEARNED_CACHE_SIZE = 5000
+
+
+# Сравниваем без учета польских диакритиков и буквы "ё": "żabka" == "zabka"
+_FOLD_TABLE = str.maketrans('ąćęłńóśźżё', 'acelnoszzе')
+
+
+def normalize_text(text: str) -> str:
+    """Привести текст к виду для сравнения с ключевыми словами"""
+    return text.lower().translate(_FOLD_TABLE)
+
+
+def normalize_merchant(description: str) -> str:
+    """
+    Ключ магазина для запоминания категории: без цифр, знаков
+    препинания и лишних пробелов ("Żabka #123!" -> "zabka").
+    """
+    words = re.findall(r'[^\W\d_]+', normalize_text(description))
+    return ' '.join(words)
+
+
+# Отметка в LRU: исправления для магазина в БД нет
+_NO_OVERRIDE = object()
+
+
+class LearnedCategories:
+    """
+    Ограниченный LRU-словарь "(семья, магазин) -> категория" из исправлений
+    пользователей. Исправления одной семьи не влияют на другие.
+    
+    LRU - только кэш: при промахе исправление читается через loader
+    (семья, магазин) -> категория или None. Результат, в том числе
+    "исправления нет", запоминается, поэтому повторный промах в БД не идет.
+    """
+    
+    def __init__(self, max_size: int = LEARNED_CACHE_SIZE,
+                 loader: Callable[[int, str], Optional[str]] = None):
+        self.max_size = max_size
+        self.loader = loader
+        self._items = OrderedDict()
+        # Импорт выписок определяет категории из потока БД
+        self._lock = threading.Lock()
+    
+    def get(self, household_id: int, merchant: str) -> Optional[str]:
+        key = (household_id, merchant)
+        with self._lock:
+            category = self._items.get(key)
+            if category is not None:
+                self._items.move_to_end(key)
+                return None if category is _NO_OVERRIDE else category
+        
+        if self.loader is None:
+            return None
+        # Запрос к БД - без блокировки, чтобы не задерживать другие потоки
+        category = self.loader(household_id, merchant)
+        with self._lock:
+            # Пока читали, исправление могло появиться - его не перезаписываем
+            if key not in self._items:
+                self._store(key, _NO_OVERRIDE if category is None else category)
+        return category
+    
+    def put(self, household_id: int, merchant: str, category: str):
+        with self._lock:
+            self._store((household_id, merchant), category)
+    
+    def _store(self, key: Tuple[int, str], category):
+        self._items[key] = category
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+    
+    def __len__(self):
+        return len(self._items)
+
+
+def _trie_pattern(words: List[str], stems: Iterable[str] = ()) -> str:
+    """
+    Собрать регулярное выражение-префиксное дерево из слов.
+    
+    Общие префиксы проверяются один раз, поэтому время поиска почти
+    не зависит от количества слов. Хвосты пробуются раньше конца слова,
+    так что из слов с общим началом всегда выбирается самое длинное.
+    Слово совпадает, только если за ним не идет буква или цифра;
+    основы из stems могут продолжаться дальше.
+    """
+    stems = set(stems)
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = word in stems  # конец слова: True - основа
+    
+    def build(node) -> str:
+        branches = [re.escape(char) + build(child)
+                    for char, child in sorted(node.items()) if char]
+        body = ''
+        if branches:
+            body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if '' not in node:
+            return body
+        # Слово может закончиться здесь, но сначала пробуем более длинное
+        end = '' if node[''] else r'(?!\w)'
+        if not body:
+            return end
+        return '(?:' + body + ')?' if node[''] else '(?:' + body + '|' + end + ')'
+    
+    return build(trie)
+
 
-def determine_category(description: str) -> str:
+class KeywordMatcher:
+    """
+    Поиск ключевых слов всех категорий одним проходом по тексту.
+    
+    Ключевое слово должно совпасть с целым словом: "бар" не найдется
+    ни в "кофебар", ни в "барбершоп". Только основы из stems могут быть
+    началом более длинного слова ("ресторан" найдется в "ресторане").
+    Если подходят несколько
+    ключевых слов, побеждает самое левое, а из них - самое длинное.
+    При совпадении ключевого слова в нескольких категориях
+    используется первая по порядку категория.
+    """
+    
+    def __init__(self, categories: Dict[str, List[str]], stems: Iterable[str] = STEM_KEYWORDS):
+        self.keyword_categories = {}
+        for category, keywords in categories.items():
+            for keyword in keywords:
+                self.keyword_categories.setdefault(normalize_text(keyword), category)
+        
+        if self.keyword_categories:
+            stems = {normalize_text(stem) for stem in stems}
+            self.pattern = re.compile(r'(?<!\w)' + _trie_pattern(list(self.keyword_categories), stems))
+        else:
+            self.pattern = None
+    
+    def match(self, description: str) -> Optional[str]:
+        """Категория по первому найденному ключевому слову или None"""
+        if self.pattern is None:
+            return None
+        
+        found = self.pattern.search(normalize_text(description))
+        if found is None:
+            return None
+        return self.keyword_categories[found.group(0)]
+
+
+# Строится один раз при импорте модуля
+_matcher = KeywordMatcher(CATEGORIES)
+
+
+_learned = LearnedCategories()
+
+
+def learn_category(household_id: int, description: str, category: str) -> str:
+    """Запомнить категорию для магазина в семье, вернуть ключ магазина"""
+    merchant = normalize_merchant(description)
+    if merchant:
+        _learned.put(household_id, merchant, category)
+    return merchant
+
+
+def load_learned_categories(items: Iterable[Tuple[int, str, str]],
+                            loader: Callable[[int, str], Optional[str]] = None):
+    """
+    Загрузить сохраненные исправления (household_id, merchant, category).
+    Первыми должны идти самые свежие - они останутся в LRU.
+    loader читает исправление из БД, если его нет в LRU (синхронно -
+    determine_category с семьей вызывается из потока БД).
+    """
+    _learned.loader = loader
+    for household_id, merchant, category in reversed(list(items)):
+        _learned.put(household_id, merchant, category)
+
+
+def rebuild_matcher():
+    """Пересобрать поиск после изменения CATEGORIES"""
+    global _matcher
+    _matcher = KeywordMatcher(CATEGORIES)
+
+
+def determine_category(description: str, household_id: int = None) -> str:
     """
     Определить категорию по описанию
     
     Args:
         description: Описание расхода
+        household_id: Семья, чьи исправления учитывать (None - только ключевые слова)
     
     Returns:
         Название категории
     """
-    description_lower = description.lower()
-    
-    # Проходим по всем категориям и ищем совпадения
-    for category, keywords in CATEGORIES.items():
-        for keyword in keywords:
-            if keyword in description_lower:
-                return category
+    # Исправления пользователей семьи важнее ключевых слов
+    if household_id is not None:
+        learned = _learned.get(household_id, normalize_merchant(description))
+        if learned is not None:
+            return learned
     
     # Если не нашли совпадений, возвращаем "Прочее"
-    return DEFAULT_CATEGORY
+    return _matcher.match(description) or DEFAULT_CATEGORY
 
 
 def get_all_categories() -> list:
@@ -2,76 +2,944 @@
 Модуль для работы с базой данных SQLite
 """
 
+import calendar
+import itertools
+import json
+import re
+import secrets
 import sqlite3
 import os
-from datetime import datetime
-from typing import List, Tuple, Optional
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Any, Callable, Iterator, List, Tuple, Optional
 
+from cache import DEFAULT_CACHE_SIZE, QueryCache, cached_query
+from metrics import DB_CONNECT_LATENCY, instrument_methods
+from salary_calendar import DEFAULT_PAY_DAY, epoch_day, from_epoch_day, recent_salary_periods
+
+# Сколько читающих соединений держим открытыми одновременно
+DEFAULT_READERS = 4
+
+# Размер кэша подготовленных выражений на соединение
+STATEMENT_CACHE_SIZE = 128
+
+# Настройки, которые применяются к каждому соединению
+CONNECTION_PRAGMAS = (
+    'PRAGMA synchronous = NORMAL',   # в режиме WAL безопасно и намного быстрее FULL
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -8000',     # ~8 МБ страничного кэша
+    'PRAGMA mmap_size = 67108864',   # 64 МБ
+    'PRAGMA foreign_keys = ON',
+)
+
+# Сколько строк заполняем за одну транзакцию при фоновом переносе данных
+BACKFILL_BATCH_SIZE = 5000
+
+# Длина суток в секундах - шаг агрегатов в expense_rollups
+DAY_SECONDS = 86400
+
+# Границы "бесконечного" периода для запросов по ts и дням
+MIN_TS = -(2 ** 62)
+MAX_TS = 2 ** 62
+
+# Сколько строк читать из курсора за раз при потоковой выгрузке
+EXPORT_CHUNK_SIZE = 1000
+
+# Максимальный размер страницы истории
+HISTORY_PAGE_MAX = 20
+
+# Сколько слов запроса учитывает поиск по описаниям
+SEARCH_TERMS_MAX = 8
+
+# Допустимое расхождение сумм при проверке агрегатов (ошибки округления REAL)
+ROLLUP_TOLERANCE = 0.005
+
+# Семья, в которую попали все записи, сделанные до появления семей
+DEFAULT_HOUSEHOLD_ID = 1
+
+# Код приглашения в семью: без похожих символов (0/O, 1/I)
+JOIN_CODE_ALPHABET = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'
+JOIN_CODE_LENGTH = 8
+
+# Пересчет агрегатов по сырым записям (используется в миграции и rebuild_rollups)
+ROLLUP_REBUILD_SQL = '''
+    INSERT INTO expense_rollups (household_id, day, user_id, username, category, amount, count)
+    SELECT household_id, ts / 86400, user_id, username, category, SUM(amount), COUNT(*)
+    FROM expenses
+    WHERE ts IS NOT NULL
+    GROUP BY household_id, ts / 86400, user_id, username, category
+'''
+
+# Позиции участников с нуля: оплачено расходов, переведено и получено в расчетах
+POSITIONS_REBUILD_SQL = '''
+    INSERT INTO member_positions (household_id, user_id, username, paid, sent, received)
+    SELECT household_id, user_id, MAX(username), SUM(paid), SUM(sent), SUM(received)
+    FROM (
+        SELECT household_id, user_id, username, amount AS paid, 0 AS sent, 0 AS received
+        FROM expenses
+        UNION ALL
+        SELECT household_id, from_user_id, from_username, 0, amount, 0 FROM settlements
+        UNION ALL
+        SELECT household_id, to_user_id, to_username, 0, 0, amount FROM settlements
+    )
+    GROUP BY household_id, user_id
+'''
+
+
+def to_timestamp(value: datetime) -> int:
+    """
+    Перевести дату в целое число секунд.
+    
+    Даты в БД хранятся в локальном времени без часового пояса, поэтому
+    считаем их "как UTC" - так же, как strftime('%s', date) в SQLite.
+    """
+    return calendar.timegm(value.timetuple())
+
+
+def search_terms(text: str) -> List[str]:
+    """Слова поискового запроса в нижнем регистре, без знаков препинания"""
+    return re.findall(r'\w+', text.lower())[:SEARCH_TERMS_MAX]
+
+
+def _match_expression(terms: List[str]) -> str:
+    """
+    Запрос FTS5: все слова сразу, каждое как префикс ("lid" найдет "Lidl").
+    Слова в кавычках, поэтому операторы FTS5 из текста пользователя не работают.
+    """
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def generate_join_code() -> str:
+    """Случайный код приглашения в семью"""
+    return ''.join(secrets.choice(JOIN_CODE_ALPHABET) for _ in range(JOIN_CODE_LENGTH))
+
+
+def _migration_create_expenses(conn: sqlite3.Connection):
+    """v1: исходная таблица расходов"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS expenses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            amount REAL NOT NULL,
+            category TEXT NOT NULL,
+            description TEXT NOT NULL,
+            date TEXT NOT NULL
+        )
+    ''')
+
+
+def _migration_add_timestamps(conn: sqlite3.Connection):
+    """v2: целочисленная метка времени и покрывающие индексы по периоду"""
+    conn.execute('ALTER TABLE expenses ADD COLUMN ts INTEGER')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_expenses_ts_category
+        ON expenses (ts, category, amount)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_expenses_ts_user
+        ON expenses (ts, user_id, username, amount)
+    ''')
+
+
+def _migration_add_snapshot_index(conn: sqlite3.Connection):
+    """v3: покрывающий индекс для среза статистики одним проходом"""
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_expenses_ts_user_category
+        ON expenses (ts, username, category, amount)
+    ''')
+
+
+def _migration_add_rollups(conn: sqlite3.Connection):
+    """
+    v4: агрегаты день x пользователь x категория.
+    
+    Триггеры обновляют их в той же транзакции, что и запись в expenses,
+    поэтому add_expense, update_expense и delete_expense (и любая другая
+    запись в таблицу) всегда оставляют агрегаты согласованными.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS expense_rollups (
+            day INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            category TEXT NOT NULL,
+            amount REAL NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id, username, category)
+        ) WITHOUT ROWID
+    ''')
+    
+    add_new = '''
+        INSERT INTO expense_rollups (day, user_id, username, category, amount, count)
+        VALUES (NEW.ts / 86400, NEW.user_id, NEW.username, NEW.category, NEW.amount, 1)
+        ON CONFLICT (day, user_id, username, category) DO UPDATE
+        SET amount = amount + excluded.amount, count = count + 1;
+    '''
+    remove_old = '''
+        UPDATE expense_rollups
+        SET amount = amount - OLD.amount, count = count - 1
+        WHERE day = OLD.ts / 86400 AND user_id = OLD.user_id
+          AND username = OLD.username AND category = OLD.category;
+        DELETE FROM expense_rollups
+        WHERE day = OLD.ts / 86400 AND user_id = OLD.user_id
+          AND username = OLD.username AND category = OLD.category
+          AND count <= 0;
+    '''
+    triggers = [
+        ('expenses_rollup_insert', 'AFTER INSERT ON expenses WHEN NEW.ts IS NOT NULL', add_new),
+        ('expenses_rollup_delete', 'AFTER DELETE ON expenses WHEN OLD.ts IS NOT NULL', remove_old),
+        ('expenses_rollup_update_old',
+         'AFTER UPDATE OF ts, user_id, username, category, amount ON expenses '
+         'WHEN OLD.ts IS NOT NULL', remove_old),
+        ('expenses_rollup_update_new',
+         'AFTER UPDATE OF ts, user_id, username, category, amount ON expenses '
+         'WHEN NEW.ts IS NOT NULL', add_new),
+    ]
+    # executescript() сам делает COMMIT, поэтому создаем триггеры по одному
+    for name, event, body in triggers:
+        conn.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END')
+    conn.execute('DELETE FROM expense_rollups')
+    conn.execute('''
+        INSERT INTO expense_rollups (day, user_id, username, category, amount, count)
+        SELECT ts / 86400, user_id, username, category, SUM(amount), COUNT(*)
+        FROM expenses
+        WHERE ts IS NOT NULL
+        GROUP BY ts / 86400, user_id, username, category
+    ''')
+
+
+def _migration_add_category_overrides(conn: sqlite3.Connection):
+    """v5: категории, которые пользователи выбрали для магазинов вручную"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS category_overrides (
+            merchant TEXT PRIMARY KEY,
+            category TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_category_overrides_updated
+        ON category_overrides (updated_at)
+    ''')
+
+
+def _migration_add_history_index(conn: sqlite3.Connection):
+    """v6: индекс для постраничной истории по (ts, id)"""
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_expenses_ts_id
+        ON expenses (ts, id)
+    ''')
+
+
+def _migration_add_import_hash(conn: sqlite3.Connection):
+    """v7: хэш импортированной из банка операции для защиты от дублей"""
+    conn.execute('ALTER TABLE expenses ADD COLUMN import_hash TEXT')
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_expenses_import_hash
+        ON expenses (import_hash) WHERE import_hash IS NOT NULL
+    ''')
+
+
+def _migration_add_households(conn: sqlite3.Connection):
+    """
+    v8: семьи. У каждой записи и агрегата есть household_id, и все индексы
+    начинаются с него, так что запросы одной семьи читают только ее
+    диапазон индекса, сколько бы семей ни было в базе.
+    
+    Существующие записи и их авторы попадают в семью DEFAULT_HOUSEHOLD_ID.
+    """
+    now = to_timestamp(datetime.now())
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS households (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            join_code TEXT NOT NULL UNIQUE,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    # Пользователь состоит ровно в одной семье
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS household_members (
+            user_id INTEGER PRIMARY KEY,
+            household_id INTEGER NOT NULL REFERENCES households (id),
+            username TEXT NOT NULL,
+            joined_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_household_members_household
+        ON household_members (household_id, user_id)
+    ''')
+    conn.execute(
+        'INSERT INTO households (id, name, join_code, created_at) VALUES (?, ?, ?, ?)',
+        (DEFAULT_HOUSEHOLD_ID, 'Семья', generate_join_code(), now)
+    )
+    conn.execute('''
+        INSERT OR IGNORE INTO household_members (user_id, household_id, username, joined_at)
+        SELECT user_id, ?, MAX(username), ? FROM expenses GROUP BY user_id
+    ''', (DEFAULT_HOUSEHOLD_ID, now))
+    
+    # REFERENCES с непустым значением по умолчанию SQLite добавить не дает
+    conn.execute(f'''
+        ALTER TABLE expenses
+        ADD COLUMN household_id INTEGER NOT NULL DEFAULT {DEFAULT_HOUSEHOLD_ID}
+    ''')
+    
+    # Старые индексы по ts заменяются индексами с household_id впереди
+    for name in ('idx_expenses_ts_category', 'idx_expenses_ts_user',
+                 'idx_expenses_ts_user_category', 'idx_expenses_ts_id',
+                 'idx_expenses_import_hash'):
+        conn.execute(f'DROP INDEX IF EXISTS {name}')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_expenses_household_ts_user_category
+        ON expenses (household_id, ts, username, category, amount)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_expenses_household_ts_id
+        ON expenses (household_id, ts, id)
+    ''')
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_expenses_household_import_hash
+        ON expenses (household_id, import_hash) WHERE import_hash IS NOT NULL
+    ''')
+    
+    # Агрегаты производные - пересоздаем их с семьей в ключе
+    for name in ('expenses_rollup_insert', 'expenses_rollup_delete',
+                 'expenses_rollup_update_old', 'expenses_rollup_update_new'):
+        conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+    conn.execute('DROP TABLE IF EXISTS expense_rollups')
+    conn.execute('''
+        CREATE TABLE expense_rollups (
+            household_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            category TEXT NOT NULL,
+            amount REAL NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (household_id, day, user_id, username, category)
+        ) WITHOUT ROWID
+    ''')
+    
+    key = '''household_id = OLD.household_id AND day = OLD.ts / 86400 AND user_id = OLD.user_id
+          AND username = OLD.username AND category = OLD.category'''
+    add_new = '''
+        INSERT INTO expense_rollups (household_id, day, user_id, username, category, amount, count)
+        VALUES (NEW.household_id, NEW.ts / 86400, NEW.user_id, NEW.username, NEW.category,
+                NEW.amount, 1)
+        ON CONFLICT (household_id, day, user_id, username, category) DO UPDATE
+        SET amount = amount + excluded.amount, count = count + 1;
+    '''
+    remove_old = f'''
+        UPDATE expense_rollups
+        SET amount = amount - OLD.amount, count = count - 1
+        WHERE {key};
+        DELETE FROM expense_rollups
+        WHERE {key} AND count <= 0;
+    '''
+    columns = 'household_id, ts, user_id, username, category, amount'
+    triggers = [
+        ('expenses_rollup_insert', 'AFTER INSERT ON expenses WHEN NEW.ts IS NOT NULL', add_new),
+        ('expenses_rollup_delete', 'AFTER DELETE ON expenses WHEN OLD.ts IS NOT NULL', remove_old),
+        ('expenses_rollup_update_old',
+         f'AFTER UPDATE OF {columns} ON expenses WHEN OLD.ts IS NOT NULL', remove_old),
+        ('expenses_rollup_update_new',
+         f'AFTER UPDATE OF {columns} ON expenses WHEN NEW.ts IS NOT NULL', add_new),
+    ]
+    for name, event, body in triggers:
+        conn.execute(f'CREATE TRIGGER {name} {event} BEGIN {body} END')
+    conn.execute(ROLLUP_REBUILD_SQL)
+
+
+def _migration_add_salary_calendar(conn: sqlite3.Connection):
+    """
+    v9: день зарплаты семьи и календарь зарплатных периодов.
+    
+    Таблица календаря больше не заполняется и удаляется в v13: периоды
+    считает salary_calendar, а запросы получают их параметром.
+    """
+    conn.execute(f'''
+        ALTER TABLE households ADD COLUMN pay_day INTEGER NOT NULL DEFAULT {DEFAULT_PAY_DAY}
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS salary_periods (
+            pay_day INTEGER NOT NULL,
+            start_day INTEGER NOT NULL,
+            end_day INTEGER NOT NULL,
+            PRIMARY KEY (pay_day, start_day)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _migration_add_settlements(conn: sqlite3.Connection):
+    """
+    v10: расчеты между участниками и их текущие позиции.
+    
+    member_positions хранит по каждому участнику, сколько он оплатил
+    расходов и сколько перевел и получил в расчетах. Триггеры обновляют
+    позиции при каждой записи, поэтому баланс семьи - это чтение одной
+    строки на участника, сколько бы ни было записей в истории.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS settlements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            household_id INTEGER NOT NULL,
+            from_user_id INTEGER NOT NULL,
+            from_username TEXT NOT NULL,
+            to_user_id INTEGER NOT NULL,
+            to_username TEXT NOT NULL,
+            amount REAL NOT NULL CHECK (amount > 0),
+            ts INTEGER NOT NULL,
+            created_by INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_settlements_household_ts
+        ON settlements (household_id, ts, id)
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS member_positions (
+            household_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            paid REAL NOT NULL DEFAULT 0,
+            sent REAL NOT NULL DEFAULT 0,
+            received REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (household_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+    
+    def change(prefix: str, user: str, column: str, amount: str) -> str:
+        return f'''
+            INSERT INTO member_positions (household_id, user_id, username, {column})
+            VALUES ({prefix}.household_id, {prefix}.{user}_id, {prefix}.{user}name, {amount})
+            ON CONFLICT (household_id, user_id) DO UPDATE
+            SET {column} = {column} + excluded.{column};
+        '''
+    
+    triggers = [
+        ('expenses_position_insert', 'AFTER INSERT ON expenses',
+         change('NEW', 'user', 'paid', 'NEW.amount')),
+        ('expenses_position_delete', 'AFTER DELETE ON expenses',
+         change('OLD', 'user', 'paid', '-OLD.amount')),
+        ('expenses_position_update',
+         'AFTER UPDATE OF household_id, user_id, amount ON expenses',
+         change('OLD', 'user', 'paid', '-OLD.amount') + change('NEW', 'user', 'paid', 'NEW.amount')),
+        ('settlements_position_insert', 'AFTER INSERT ON settlements',
+         change('NEW', 'from_user', 'sent', 'NEW.amount')
+         + change('NEW', 'to_user', 'received', 'NEW.amount')),
+        ('settlements_position_delete', 'AFTER DELETE ON settlements',
+         change('OLD', 'from_user', 'sent', '-OLD.amount')
+         + change('OLD', 'to_user', 'received', '-OLD.amount')),
+    ]
+    for name, event, body in triggers:
+        conn.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END')
+    
+    conn.execute('DELETE FROM member_positions')
+    conn.execute(POSITIONS_REBUILD_SQL)
+
+
+def _migration_add_expense_search(conn: sqlite3.Connection):
+    """
+    v11: полнотекстовый индекс FTS5 по описаниям расходов.
+    
+    Индекс внешнего содержимого: текст хранится только в expenses, а
+    expenses_fts - это инвертированный индекс слово -> id записи. Триггеры
+    обновляют его в той же транзакции, что и запись в expenses.
+    remove_diacritics 2 - "zabka" находит "żabka".
+    """
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS expenses_fts USING fts5(
+            description,
+            content='expenses',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    
+    add_new = '''
+        INSERT INTO expenses_fts (rowid, description) VALUES (NEW.id, NEW.description);
+    '''
+    remove_old = '''
+        INSERT INTO expenses_fts (expenses_fts, rowid, description)
+        VALUES ('delete', OLD.id, OLD.description);
+    '''
+    triggers = [
+        ('expenses_fts_insert', 'AFTER INSERT ON expenses', add_new),
+        ('expenses_fts_delete', 'AFTER DELETE ON expenses', remove_old),
+        ('expenses_fts_update', 'AFTER UPDATE OF description ON expenses', remove_old + add_new),
+    ]
+    for name, event, body in triggers:
+        conn.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END')
+    
+    conn.execute("INSERT INTO expenses_fts (expenses_fts) VALUES ('rebuild')")
+
+
+def _migration_add_override_households(conn: sqlite3.Connection):
+    """
+    v12: исправления категорий принадлежат семье - одна семья больше не
+    меняет автокатегории другим. Ключ таблицы меняется, поэтому она
+    пересоздается; прежние исправления достаются DEFAULT_HOUSEHOLD_ID.
+    """
+    conn.execute('''
+        CREATE TABLE category_overrides_new (
+            household_id INTEGER NOT NULL,
+            merchant TEXT NOT NULL,
+            category TEXT NOT NULL,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (household_id, merchant)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO category_overrides_new (household_id, merchant, category, updated_at)
+        SELECT ?, merchant, category, updated_at FROM category_overrides
+    ''', (DEFAULT_HOUSEHOLD_ID,))
+    conn.execute('DROP TABLE category_overrides')
+    conn.execute('ALTER TABLE category_overrides_new RENAME TO category_overrides')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_category_overrides_updated
+        ON category_overrides (updated_at)
+    ''')
+
+
+def _migration_drop_salary_periods(conn: sqlite3.Connection):
+    """
+    v13: календарь зарплатных периодов (около 22 тысяч строк на все дни
+    зарплаты) не хранится в каждой базе - нужные периоды считаются в Python
+    и передаются в запрос списком.
+    """
+    conn.execute('DROP TABLE IF EXISTS salary_periods')
+
+
+# Миграции схемы по порядку. Номер версии хранится в PRAGMA user_version.
+# Новые миграции добавляются только в конец списка.
+MIGRATIONS: List[Tuple[int, Callable[[sqlite3.Connection], None]]] = [
+    (1, _migration_create_expenses),
+    (2, _migration_add_timestamps),
+    (3, _migration_add_snapshot_index),
+    (4, _migration_add_rollups),
+    (5, _migration_add_category_overrides),
+    (6, _migration_add_history_index),
+    (7, _migration_add_import_hash),
+    (8, _migration_add_households),
+    (9, _migration_add_salary_calendar),
+    (10, _migration_add_settlements),
+    (11, _migration_add_expense_search),
+    (12, _migration_add_override_households),
+    (13, _migration_drop_salary_periods),
+]
+
+
+# Номера экземпляров Database: версия данных имеет смысл только вместе с ним
+_instance_ids = itertools.count(1)
+
+
+@dataclass(frozen=True)
+class StatsSnapshot:
+    """Согласованный срез статистики за период"""
+    total: float
+    by_category: List[Tuple[str, float]]            # по убыванию суммы
+    by_user: List[Tuple[str, float]]                # по убыванию суммы
+    by_user_category: List[Tuple[str, str, float]]  # по пользователю и категории
+
+
+@instrument_methods
 class Database:
-    def __init__(self, db_file='expenses.db'):
+    # Миграции схемы; у справочника семей (sharding.DirectoryDatabase) свой список
+    migrations = MIGRATIONS
+    
+    def __init__(self, db_file='expenses.db', readers: int = DEFAULT_READERS,
+                 cache_size: int = DEFAULT_CACHE_SIZE):
         # Используем абсолютный путь, чтобы Python всегда находил файл
         basedir = os.path.abspath(os.path.dirname(__file__))
         self.db_file = os.path.join(basedir, db_file)
+        
+        # Пул: одно пишущее соединение и несколько читающих.
+        # Читающие соединения создаются лениво, по мере необходимости.
+        self._max_readers = max(1, readers)
+        self._reader_count = 0
+        self._readers = queue.LifoQueue()
+        self._all_readers = []
+        self._pool_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        # Поток, который сейчас выполняет групповую транзакцию (run_batch)
+        self._batch = threading.local()
+        self._closed = False
+        
+        # Версия данных: увеличивается после каждой записи и сбрасывает кэш
+        self.data_version = 0
+        self.instance_id = next(_instance_ids)
+        self.cache = QueryCache(cache_size)
+        
+        self._writer = self._connect()
+        self._writer.execute('PRAGMA journal_mode = WAL')
         self.init_db()
     
+    def _connect(self, readonly: bool = False) -> sqlite3.Connection:
+        """Открыть новое соединение с настроенными PRAGMA"""
+        started = time.perf_counter()
+        
+        # isolation_level=None - транзакциями управляем сами через BEGIN/COMMIT
+        conn = sqlite3.connect(
+            self.db_file,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        if readonly:
+            conn.execute('PRAGMA query_only = ON')
+        
+        DB_CONNECT_LATENCY.observe(time.perf_counter() - started, 'reader' if readonly else 'writer')
+        return conn
+    
+    @contextmanager
+    def _write(self) -> Iterator[sqlite3.Connection]:
+        """Транзакция на пишущем соединении (писатель всегда один)"""
+        if self._closed:
+            raise sqlite3.ProgrammingError('Database is closed')
+        
+        if getattr(self._batch, 'active', False):
+            # Внутри run_batch: операция - точка сохранения в общей транзакции,
+            # ее ошибка откатывает только ее саму
+            conn = self._writer
+            conn.execute('SAVEPOINT operation')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK TO operation')
+                conn.execute('RELEASE operation')
+                raise
+            else:
+                conn.execute('RELEASE operation')
+            return
+        
+        with self._write_lock:
+            conn = self._writer
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            else:
+                conn.execute('COMMIT')
+                self.data_version += 1
+    
+    def run_batch(self, operations: List[Callable[[], Any]]) -> List[Tuple[bool, Any]]:
+        """
+        Выполнить операции записи (вызовы методов этой же Database) одной
+        транзакцией: один COMMIT и одна синхронизация диска на всех.
+        
+        Returns:
+            [(успех, результат или исключение)] в порядке операций. Если не
+            удался сам COMMIT, исключение поднимается для всей группы.
+        """
+        if self._closed:
+            raise sqlite3.ProgrammingError('Database is closed')
+        
+        with self._write_lock:
+            conn = self._writer
+            conn.execute('BEGIN IMMEDIATE')
+            self._batch.active = True
+            results = []
+            try:
+                for operation in operations:
+                    try:
+                        results.append((True, operation()))
+                    except Exception as error:
+                        results.append((False, error))
+                self._batch.active = False
+                conn.execute('COMMIT')
+            except BaseException:
+                self._batch.active = False
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+            self.data_version += 1
+        
+        return results
+    
+    @contextmanager
+    def _read(self) -> Iterator[sqlite3.Connection]:
+        """Взять читающее соединение из пула и вернуть его после использования"""
+        if self._closed:
+            raise sqlite3.ProgrammingError('Database is closed')
+        
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._pool_lock:
+                if self._reader_count < self._max_readers:
+                    self._reader_count += 1
+                    conn = self._connect(readonly=True)
+                    self._all_readers.append(conn)
+            if conn is None:
+                # Все читатели заняты - ждем, пока кто-то освободится
+                conn = self._readers.get()
+        
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            self._readers.put(conn)
+    
+    def close(self):
+        """Закрыть все соединения пула"""
+        if self._closed:
+            return
+        self._closed = True
+        
+        with self._write_lock:
+            self._writer.close()
+        with self._pool_lock:
+            for conn in self._all_readers:
+                conn.close()
+            self._all_readers.clear()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
     def init_db(self):
-        """Создание таблиц если их нет"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS expenses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                username TEXT NOT NULL,
-                amount REAL NOT NULL,
-                category TEXT NOT NULL,
-                description TEXT NOT NULL,
-                date TEXT NOT NULL
-            )
-        ''')
+        """Создание таблиц и применение миграций"""
+        self.migrate()
+        self.backfill_timestamps()
+    
+    def get_schema_version(self) -> int:
+        """Текущая версия схемы БД"""
+        return self._writer.execute('PRAGMA user_version').fetchone()[0]
+    
+    def migrate(self) -> int:
+        """Применить недостающие миграции, вернуть итоговую версию схемы"""
+        for version, migration in self.migrations:
+            # Каждая миграция - отдельная транзакция вместе с user_version
+            with self._write() as conn:
+                current = conn.execute('PRAGMA user_version').fetchone()[0]
+                if version <= current:
+                    continue
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {version}')
         
-        conn.commit()
-        conn.close()
+        return self.get_schema_version()
     
-    def add_expense(self, user_id: int, username: str, amount: float, 
-                   category: str, description: str) -> int:
-        """Добавить расход"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
+    def backfill_timestamps(self, batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+        """
+        Заполнить ts у старых записей небольшими порциями.
         
-        date = datetime.now().isoformat()
+        Каждая порция - короткая транзакция, так что запись в БД
+        не блокируется надолго даже на большой таблице.
+        """
+        total = 0
+        while True:
+            with self._write() as conn:
+                cursor = conn.execute('''
+                    UPDATE expenses
+                    SET ts = CAST(strftime('%s', date) AS INTEGER)
+                    WHERE id IN (
+                        SELECT id FROM expenses WHERE ts IS NULL LIMIT ?
+                    )
+                ''', (batch_size,))
+                updated = cursor.rowcount
+            
+            total += updated
+            if updated < batch_size:
+                return total
+    
+    def create_household(self, name: str, user_id: int, username: str) -> Tuple[int, str]:
+        """
+        Создать семью и перевести в нее пользователя.
+        Возвращает (ID семьи, код приглашения).
+        """
+        now = to_timestamp(datetime.now())
         
-        cursor.execute('''
-            INSERT INTO expenses (user_id, username, amount, category, description, date)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, username, amount, category, description, date))
+        with self._write() as conn:
+            while True:
+                join_code = generate_join_code()
+                try:
+                    cursor = conn.execute(
+                        'INSERT INTO households (name, join_code, created_at) VALUES (?, ?, ?)',
+                        (name, join_code, now)
+                    )
+                    break
+                except sqlite3.IntegrityError:
+                    continue  # такой код уже есть - берем другой
+            
+            household_id = cursor.lastrowid
+            self._set_membership(conn, household_id, user_id, username, now)
         
-        expense_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        return household_id, join_code
+    
+    def join_household(self, join_code: str, user_id: int, username: str) -> Optional[int]:
+        """Вступить в семью по коду. Возвращает ID семьи или None, если код неверный"""
+        with self._write() as conn:
+            row = conn.execute(
+                'SELECT id FROM households WHERE join_code = ?', (join_code.strip().upper(),)
+            ).fetchone()
+            if row is None:
+                return None
+            
+            self._set_membership(conn, row[0], user_id, username, to_timestamp(datetime.now()))
+            return row[0]
+    
+    def add_household_members(self, household_id: int, members: List[Tuple[int, str]]):
+        """Добавить пользователей (user_id, имя) в семью, если они еще ни в какой не состоят"""
+        now = to_timestamp(datetime.now())
         
-        return expense_id
+        with self._write() as conn:
+            conn.executemany('''
+                INSERT OR IGNORE INTO household_members (user_id, household_id, username, joined_at)
+                VALUES (?, ?, ?, ?)
+            ''', [(user_id, household_id, username, now) for user_id, username in members])
     
-    def delete_expense(self, expense_id: int) -> bool:
-        """Удалить расход"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
+    @staticmethod
+    def _set_membership(conn: sqlite3.Connection, household_id: int, user_id: int,
+                        username: str, now: int):
+        conn.execute('''
+            INSERT INTO household_members (user_id, household_id, username, joined_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE
+            SET household_id = excluded.household_id, username = excluded.username,
+                joined_at = excluded.joined_at
+        ''', (user_id, household_id, username, now))
+    
+    def get_household_id(self, user_id: int) -> Optional[int]:
+        """Семья пользователя или None"""
+        with self._read() as conn:
+            row = conn.execute(
+                'SELECT household_id FROM household_members WHERE user_id = ?', (user_id,)
+            ).fetchone()
+            
+            return row[0] if row else None
+    
+    def get_member_households(self) -> List[Tuple[int, int]]:
+        """Все участники семей (user_id, household_id) - список доступа бота"""
+        with self._read() as conn:
+            cursor = conn.execute('SELECT user_id, household_id FROM household_members')
+            
+            return cursor.fetchall()
+    
+    def get_household(self, household_id: int) -> Optional[Tuple[int, str, str, int]]:
+        """Семья (id, name, join_code, pay_day)"""
+        with self._read() as conn:
+            cursor = conn.execute(
+                'SELECT id, name, join_code, pay_day FROM households WHERE id = ?', (household_id,)
+            )
+            
+            return cursor.fetchone()
+    
+    def set_pay_day(self, household_id: int, pay_day: int) -> bool:
+        """Изменить день зарплаты семьи (1-31)"""
+        with self._write() as conn:
+            cursor = conn.execute(
+                'UPDATE households SET pay_day = ? WHERE id = ?', (pay_day, household_id)
+            )
+            
+            return cursor.rowcount > 0
+    
+    def get_household_members(self, household_id: int) -> List[Tuple[int, str]]:
+        """Участники семьи (user_id, username) в порядке вступления"""
+        with self._read() as conn:
+            cursor = conn.execute('''
+                SELECT user_id, username
+                FROM household_members
+                WHERE household_id = ?
+                ORDER BY joined_at, user_id
+            ''', (household_id,))
+            
+            return cursor.fetchall()
+    
+    def add_expense(self, household_id: int, user_id: int, username: str, amount: float,
+                    category: str, description: str) -> int:
+        """Добавить расход"""
+        now = datetime.now()
         
-        cursor.execute('DELETE FROM expenses WHERE id = ?', (expense_id,))
+        with self._write() as conn:
+            cursor = conn.execute('''
+                INSERT INTO expenses
+                    (household_id, user_id, username, amount, category, description, date, ts)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (household_id, user_id, username, amount, category, description,
+                  now.isoformat(), to_timestamp(now)))
+            
+            return cursor.lastrowid
+    
+    def add_expenses(self, household_id: int, user_id: int, username: str,
+                     expenses: List[Tuple[float, str, str]]) -> List[int]:
+        """
+        Добавить несколько расходов (сумма, категория, описание) одной транзакцией.
+        Возвращает ID добавленных записей в том же порядке.
+        """
+        if not expenses:
+            return []
+        
+        now = datetime.now()
+        date = now.isoformat()
+        ts = to_timestamp(now)
+        rows = [
+            (household_id, user_id, username, amount, category, description, date, ts)
+            for amount, category, description in expenses
+        ]
         
-        deleted = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
+        with self._write() as conn:
+            conn.executemany('''
+                INSERT INTO expenses
+                    (household_id, user_id, username, amount, category, description, date, ts)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            
+            # Писатель один, поэтому ID внутри транзакции идут подряд
+            last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
         
-        return deleted
+        return list(range(last_id - len(rows) + 1, last_id + 1))
     
-    def update_expense(self, expense_id: int, amount: float = None, 
+    def import_expenses(self, household_id: int, user_id: int, username: str,
+                        expenses: List[Tuple[datetime, float, str, str, str]]) -> int:
+        """
+        Добавить импортированные расходы (дата, сумма, категория, описание, хэш)
+        одной транзакцией. Записи с уже известным в этой семье хэшем пропускаются.
+        Возвращает количество добавленных записей.
+        """
+        rows = [
+            (household_id, user_id, username, amount, category, description,
+             date.isoformat(), to_timestamp(date), hash_)
+            for date, amount, category, description, hash_ in expenses
+        ]
+        
+        with self._write() as conn:
+            # rowcount не учитывает изменения, сделанные триггерами
+            cursor = conn.executemany('''
+                INSERT OR IGNORE INTO expenses
+                    (household_id, user_id, username, amount, category, description,
+                     date, ts, import_hash)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            
+            return cursor.rowcount
+    
+    def delete_expense(self, household_id: int, expense_id: int) -> bool:
+        """Удалить расход"""
+        with self._write() as conn:
+            cursor = conn.execute(
+                'DELETE FROM expenses WHERE id = ? AND household_id = ?', (expense_id, household_id)
+            )
+            
+            return cursor.rowcount > 0
+    
+    def update_expense(self, household_id: int, expense_id: int, amount: float = None,
                       category: str = None, description: str = None) -> bool:
         """Обновить расход"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
         updates = []
         params = []
         
@@ -88,142 +956,476 @@ class Database:
         if not updates:
             return False
         
-        params.append(expense_id)
-        query = f"UPDATE expenses SET {', '.join(updates)} WHERE id = ?"
+        params.extend([expense_id, household_id])
+        query = f"UPDATE expenses SET {', '.join(updates)} WHERE id = ? AND household_id = ?"
         
-        cursor.execute(query, params)
-        
-        updated = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
-        
-        return updated
+        with self._write() as conn:
+            cursor = conn.execute(query, params)
+            
+            return cursor.rowcount > 0
     
-    def get_recent_expenses(self, limit: int = 10) -> List[Tuple]:
+    def get_recent_expenses(self, household_id: int, limit: int = 10) -> List[Tuple]:
         """Получить последние расходы"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
+        with self._read() as conn:
+            cursor = conn.execute('''
+                SELECT id, user_id, username, amount, category, description, date
+                FROM expenses
+                WHERE household_id = ?
+                ORDER BY ts DESC, id DESC
+                LIMIT ?
+            ''', (household_id, limit))
+            
+            return cursor.fetchall()
+    
+    def get_history_page(self, household_id: int, limit: int, before: Tuple[int, int] = None,
+                         after: Tuple[int, int] = None) -> Tuple[List[Tuple], bool]:
+        """
+        Страница истории от новых к старым с курсором по (ts, id).
         
-        cursor.execute('''
-            SELECT id, user_id, username, amount, category, description, date
-            FROM expenses
-            ORDER BY date DESC
-            LIMIT ?
-        ''', (limit,))
+        before - вернуть записи старше этой позиции, after - новее;
+        без курсора - самые свежие. Каждая страница - один проход по индексу
+        от позиции курсора, сколько бы записей ни было до нее.
         
-        expenses = cursor.fetchall()
-        conn.close()
+        Returns:
+            (записи (id, user_id, username, amount, category, description, date, ts),
+             есть ли еще записи в направлении перехода)
+        """
+        limit = max(1, min(limit, HISTORY_PAGE_MAX))
         
-        return expenses
-    
-    def get_total(self, start_date: datetime = None) -> float:
-        """Получить общую сумму расходов"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        if start_date:
-            cursor.execute('''
-                SELECT SUM(amount) FROM expenses
-                WHERE date >= ?
-            ''', (start_date.isoformat(),))
+        if after is not None:
+            where, order, params = 'AND (ts, id) > (?, ?)', 'ASC', list(after)
+        elif before is not None:
+            where, order, params = 'AND (ts, id) < (?, ?)', 'DESC', list(before)
         else:
-            cursor.execute('SELECT SUM(amount) FROM expenses')
+            where, order, params = '', 'DESC', []
         
-        result = cursor.fetchone()[0]
-        conn.close()
+        with self._read() as conn:
+            # Берем на одну запись больше, чтобы узнать, есть ли следующая страница
+            cursor = conn.execute(f'''
+                SELECT id, user_id, username, amount, category, description, date, ts
+                FROM expenses
+                WHERE household_id = ? {where}
+                ORDER BY ts {order}, id {order}
+                LIMIT ?
+            ''', [household_id] + params + [limit + 1])
+            
+            rows = []
+            has_more = False
+            for row in cursor:
+                if len(rows) == limit:
+                    has_more = True
+                    break
+                rows.append(row)
         
-        return result or 0.0
+        if after is not None:
+            rows.reverse()
+        return rows, has_more
     
-    def get_by_category(self, start_date: datetime = None) -> List[Tuple[str, float]]:
-        """Получить сумму по категориям"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
+    def search_expenses(self, household_id: int, query: str, start_date: datetime = None,
+                        limit: int = HISTORY_PAGE_MAX, before: Tuple[int, int] = None,
+                        after: Tuple[int, int] = None) -> Tuple[List[Tuple], bool]:
+        """
+        Страница найденных по описанию расходов с курсором по (ts, id),
+        как у get_history_page.
         
-        if start_date:
-            cursor.execute('''
-                SELECT category, SUM(amount)
-                FROM expenses
-                WHERE date >= ?
-                GROUP BY category
-                ORDER BY SUM(amount) DESC
-            ''', (start_date.isoformat(),))
+        Записи находит индекс expenses_fts, а expenses читается только по id
+        найденных записей - время зависит от числа совпадений, а не от
+        длины истории.
+        """
+        terms = search_terms(query)
+        if not terms:
+            return [], False
+        limit = max(1, min(limit, HISTORY_PAGE_MAX))
+        start_ts = to_timestamp(start_date) if start_date else MIN_TS
+        
+        if after is not None:
+            where, order, params = 'AND (e.ts, e.id) > (?, ?)', 'ASC', list(after)
+        elif before is not None:
+            where, order, params = 'AND (e.ts, e.id) < (?, ?)', 'DESC', list(before)
         else:
-            cursor.execute('''
-                SELECT category, SUM(amount)
-                FROM expenses
-                GROUP BY category
-                ORDER BY SUM(amount) DESC
-            ''')
+            where, order, params = '', 'DESC', []
         
-        result = cursor.fetchall()
-        conn.close()
+        with self._read() as conn:
+            # CROSS JOIN закрепляет порядок: сначала индекс FTS, потом expenses по id
+            cursor = conn.execute(f'''
+                SELECT e.id, e.user_id, e.username, e.amount, e.category, e.description, e.date, e.ts
+                FROM expenses_fts CROSS JOIN expenses e ON e.id = expenses_fts.rowid
+                WHERE expenses_fts MATCH ? AND e.household_id = ? AND e.ts >= ? {where}
+                ORDER BY e.ts {order}, e.id {order}
+                LIMIT ?
+            ''', [_match_expression(terms), household_id, start_ts] + params + [limit + 1])
+            
+            rows = cursor.fetchall()
         
-        return result
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if after is not None:
+            rows.reverse()
+        return rows, has_more
     
-    def get_by_user(self, start_date: datetime = None) -> List[Tuple[str, float]]:
-        """Получить сумму по пользователям"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
+    @cached_query
+    def get_search_summary(self, household_id: int, query: str,
+                           start_date: datetime = None) -> Tuple[int, float]:
+        """Сколько расходов нашлось по описанию и на какую сумму (через индекс FTS)"""
+        terms = search_terms(query)
+        if not terms:
+            return 0, 0.0
+        start_ts = to_timestamp(start_date) if start_date else MIN_TS
         
-        if start_date:
-            cursor.execute('''
-                SELECT username, SUM(amount)
-                FROM expenses
-                WHERE date >= ?
-                GROUP BY username
-                ORDER BY SUM(amount) DESC
-            ''', (start_date.isoformat(),))
-        else:
-            cursor.execute('''
-                SELECT username, SUM(amount)
-                FROM expenses
-                GROUP BY username
-                ORDER BY SUM(amount) DESC
-            ''')
+        with self._read() as conn:
+            count, total = conn.execute('''
+                SELECT COUNT(*), COALESCE(SUM(e.amount), 0)
+                FROM expenses_fts CROSS JOIN expenses e ON e.id = expenses_fts.rowid
+                WHERE expenses_fts MATCH ? AND e.household_id = ? AND e.ts >= ?
+            ''', (_match_expression(terms), household_id, start_ts)).fetchone()
+            
+            return count, total
+    
+    def iter_expenses(self, household_id: int, start_date: datetime = None,
+                      end_date: datetime = None,
+                      chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[Tuple]:
+        """
+        Все расходы за период [start_date, end_date) по возрастанию даты.
         
-        result = cursor.fetchall()
-        conn.close()
+        Генератор читает курсор порциями через fetchmany(), поэтому память
+        не зависит от количества записей. Соединение занято, пока генератор
+        не дочитан или не закрыт.
+        """
+        start_ts = to_timestamp(start_date) if start_date else MIN_TS
+        end_ts = to_timestamp(end_date) if end_date else MAX_TS
         
-        return result
+        with self._read() as conn:
+            cursor = conn.execute('''
+                SELECT id, user_id, username, amount, category, description, date, ts
+                FROM expenses
+                WHERE household_id = ? AND ts >= ? AND ts < ?
+                ORDER BY ts, id
+            ''', (household_id, start_ts, end_ts))
+            
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+    
+    def get_total(self, household_id: int, start_date: datetime = None) -> float:
+        """Получить общую сумму расходов"""
+        return self.get_stats_snapshot(household_id, start_date).total
+    
+    def get_by_category(self, household_id: int, start_date: datetime = None) -> List[Tuple[str, float]]:
+        """Получить сумму по категориям"""
+        return self.get_stats_snapshot(household_id, start_date).by_category
     
-    def get_by_user_and_category(self, start_date: datetime = None) -> List[Tuple[str, str, float]]:
+    def get_by_user(self, household_id: int, start_date: datetime = None) -> List[Tuple[str, float]]:
+        """Получить сумму по пользователям"""
+        return self.get_stats_snapshot(household_id, start_date).by_user
+    
+    def get_by_user_and_category(self, household_id: int, start_date: datetime = None) -> List[Tuple[str, str, float]]:
         """Получить сумму по пользователям и категориям"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
+        return self.get_stats_snapshot(household_id, start_date).by_user_category
+    
+    @cached_query
+    def get_stats_snapshot(self, household_id: int, start_date: datetime = None,
+                           end_date: datetime = None) -> StatsSnapshot:
+        """
+        Получить всю статистику за период [start_date, end_date) одним запросом.
         
-        if start_date:
-            cursor.execute('''
-                SELECT username, category, SUM(amount)
-                FROM expenses
-                WHERE date >= ?
-                GROUP BY username, category
-                ORDER BY username, category
-            ''', (start_date.isoformat(),))
+        Целые дни периода берутся из expense_rollups, а неполные дни на краях
+        дочитываются из expenses по индексу. Итоги по категориям и
+        пользователям считаются из сумм по парам (пользователь, категория),
+        поэтому все цифры всегда согласованы. Результат кэшируется до
+        следующей записи в БД.
+        """
+        start_ts = to_timestamp(start_date) if start_date else MIN_TS
+        end_ts = to_timestamp(end_date) if end_date else MAX_TS
+        
+        # Целые дни внутри периода
+        first_day = -(-start_ts // DAY_SECONDS)
+        last_day = end_ts // DAY_SECONDS
+        if first_day < last_day:
+            days = (first_day, last_day)
+            head = (start_ts, first_day * DAY_SECONDS)
+            tail = (last_day * DAY_SECONDS, end_ts)
         else:
-            cursor.execute('''
+            # Период короче суток - считаем только по сырым записям
+            days = (0, 0)
+            head = (start_ts, end_ts)
+            tail = (0, 0)
+        
+        with self._read() as conn:
+            conn.execute('BEGIN')
+            cursor = conn.execute('''
                 SELECT username, category, SUM(amount)
-                FROM expenses
+                FROM (
+                    SELECT username, category, amount
+                    FROM expense_rollups
+                    WHERE household_id = ? AND day >= ? AND day < ?
+                    UNION ALL
+                    SELECT username, category, amount
+                    FROM expenses
+                    WHERE household_id = ? AND ts >= ? AND ts < ?
+                    UNION ALL
+                    SELECT username, category, amount
+                    FROM expenses
+                    WHERE household_id = ? AND ts >= ? AND ts < ?
+                )
                 GROUP BY username, category
                 ORDER BY username, category
-            ''')
+            ''', (household_id, *days, household_id, *head, household_id, *tail))
+            by_user_category = cursor.fetchall()
+            conn.execute('COMMIT')
         
-        result = cursor.fetchall()
-        conn.close()
+        category_totals = {}
+        user_totals = {}
+        for username, category, amount in by_user_category:
+            category_totals[category] = category_totals.get(category, 0.0) + amount
+            user_totals[username] = user_totals.get(username, 0.0) + amount
         
-        return result
+        def by_amount(totals):
+            return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+        
+        return StatsSnapshot(
+            total=sum(user_totals.values()),
+            by_category=by_amount(category_totals),
+            by_user=by_amount(user_totals),
+            by_user_category=by_user_category
+        )
     
-    def get_expense_by_id(self, expense_id: int) -> Optional[Tuple]:
-        """Получить расход по ID"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
+    @cached_query
+    def get_salary_period_totals(self, household_id: int, pay_day: int = DEFAULT_PAY_DAY,
+                                 periods: int = 24,
+                                 until: date = None) -> List[Tuple[date, date, float, int]]:
+        """
+        Траты по последним зарплатным периодам (до дня until, по умолчанию
+        сегодня), от нового к старому.
+        
+        Периоды начинаются в полночь, поэтому суммы целиком берутся из
+        expense_rollups: один GROUP BY по соединению со списком периодов
+        из salary_calendar, каждый период - поиск диапазона по первичному
+        ключу агрегатов.
         
-        cursor.execute('''
-            SELECT id, user_id, username, amount, category, description, date
-            FROM expenses
-            WHERE id = ?
-        ''', (expense_id,))
+        Returns:
+            [(начало, конец (не включая), сумма, количество записей)]
+        """
+        bounds = json.dumps([
+            (epoch_day(start), epoch_day(end))
+            for start, end in recent_salary_periods(until or date.today(), pay_day, periods)
+        ])
         
-        expense = cursor.fetchone()
-        conn.close()
+        with self._read() as conn:
+            # MATERIALIZED: JSON разбирается один раз, а не при каждом обращении
+            # к периодам внутри соединения (иначе запрос в 2-3 раза медленнее)
+            cursor = conn.execute('''
+                WITH periods (start_day, end_day) AS MATERIALIZED (
+                    SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]')
+                    FROM json_each(?)
+                )
+                SELECT p.start_day, p.end_day,
+                       COALESCE(SUM(r.amount), 0), COALESCE(SUM(r.count), 0)
+                FROM periods p
+                LEFT JOIN expense_rollups r
+                    ON r.household_id = ? AND r.day >= p.start_day AND r.day < p.end_day
+                GROUP BY p.start_day, p.end_day
+                ORDER BY p.start_day DESC
+            ''', (bounds, household_id))
+            
+            return [
+                (from_epoch_day(start), from_epoch_day(end), amount, count)
+                for start, end, amount, count in cursor
+            ]
+    
+    def get_daily_category_totals(self, household_id: int, start_day: int,
+                                  end_day: int) -> Tuple[List[int], List[str], List[float]]:
+        """
+        Суммы по дням и категориям за дни [start_day, end_day) (номера дней
+        от 1970-01-01) одним запросом к expense_rollups.
+        
+        Returns:
+            Столбцы (дни, категории, суммы) - их удобно сразу превратить в массивы
+        """
+        with self._read() as conn:
+            rows = conn.execute('''
+                SELECT day, category, SUM(amount)
+                FROM expense_rollups
+                WHERE household_id = ? AND day >= ? AND day < ?
+                GROUP BY day, category
+            ''', (household_id, start_day, end_day)).fetchall()
         
-        return expense
+        if not rows:
+            return [], [], []
+        days, categories, amounts = zip(*rows)
+        return list(days), list(categories), list(amounts)
+    
+    def get_data_version(self, household_id: int) -> Tuple[int, int]:
+        """
+        Версия данных семьи для кэшей вне Database: меняется после любой
+        записи в файл, где лежат расходы семьи.
+        """
+        return self.instance_id, self.data_version
+    
+    def add_settlement(self, household_id: int, from_user_id: int, from_username: str,
+                       to_user_id: int, to_username: str, amount: float,
+                       created_by: int) -> int:
+        """Записать перевод from -> to в счет долга, вернуть его ID"""
+        with self._write() as conn:
+            cursor = conn.execute('''
+                INSERT INTO settlements (household_id, from_user_id, from_username,
+                                         to_user_id, to_username, amount, ts, created_by)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (household_id, from_user_id, from_username, to_user_id, to_username,
+                  amount, to_timestamp(datetime.now()), created_by))
+            
+            return cursor.lastrowid
+    
+    def delete_settlement(self, household_id: int, settlement_id: int) -> bool:
+        """Отменить перевод"""
+        with self._write() as conn:
+            cursor = conn.execute(
+                'DELETE FROM settlements WHERE id = ? AND household_id = ?',
+                (settlement_id, household_id)
+            )
+            
+            return cursor.rowcount > 0
+    
+    def get_settlements(self, household_id: int, limit: int = 10) -> List[Tuple]:
+        """Последние переводы: (id, from_username, to_username, amount, ts)"""
+        with self._read() as conn:
+            cursor = conn.execute('''
+                SELECT id, from_username, to_username, amount, ts
+                FROM settlements
+                WHERE household_id = ?
+                ORDER BY ts DESC, id DESC
+                LIMIT ?
+            ''', (household_id, limit))
+            
+            return cursor.fetchall()
+    
+    def get_positions(self, household_id: int) -> List[Tuple[int, str, float, float, float]]:
+        """
+        Позиции участников: (user_id, имя, оплачено расходов, переведено, получено).
+        Поддерживаются триггерами - чтение не зависит от длины истории.
+        """
+        with self._read() as conn:
+            cursor = conn.execute('''
+                SELECT user_id, username, paid, sent, received
+                FROM member_positions
+                WHERE household_id = ?
+            ''', (household_id,))
+            
+            return cursor.fetchall()
+    
+    def rebuild_rollups(self) -> int:
+        """
+        Пересчитать агрегаты и позиции участников по сырым записям,
+        вернуть число строк агрегатов
+        """
+        with self._write() as conn:
+            conn.execute('DELETE FROM member_positions')
+            conn.execute(POSITIONS_REBUILD_SQL)
+            conn.execute('DELETE FROM expense_rollups')
+            return conn.execute(ROLLUP_REBUILD_SQL).rowcount
+    
+    def rebuild_positions(self, household_id: int):
+        """Пересчитать позиции участников одной семьи по расходам и переводам"""
+        with self._write() as conn:
+            conn.execute('DELETE FROM member_positions WHERE household_id = ?', (household_id,))
+            conn.execute('''
+                INSERT INTO member_positions (household_id, user_id, username, paid, sent, received)
+                SELECT household_id, user_id, MAX(username), SUM(paid), SUM(sent), SUM(received)
+                FROM (
+                    SELECT household_id, user_id, username, amount AS paid, 0 AS sent, 0 AS received
+                    FROM expenses WHERE household_id = :household
+                    UNION ALL
+                    SELECT household_id, from_user_id, from_username, 0, amount, 0
+                    FROM settlements WHERE household_id = :household
+                    UNION ALL
+                    SELECT household_id, to_user_id, to_username, 0, 0, amount
+                    FROM settlements WHERE household_id = :household
+                )
+                GROUP BY household_id, user_id
+            ''', {'household': household_id})
+    
+    def verify_rollups(self) -> List[Tuple]:
+        """
+        Сверить агрегаты с сырыми записями.
+        
+        Возвращает расхождения в виде (household_id, day, user_id, username,
+        category, сумма по expenses, сумма в агрегатах);
+        пустой список означает, что все сходится.
+        """
+        with self._read() as conn:
+            cursor = conn.execute('''
+                WITH raw AS (
+                    SELECT household_id, ts / 86400 AS day, user_id, username, category,
+                           SUM(amount) AS amount, COUNT(*) AS count
+                    FROM expenses
+                    WHERE ts IS NOT NULL
+                    GROUP BY household_id, ts / 86400, user_id, username, category
+                )
+                SELECT raw.household_id, raw.day, raw.user_id, raw.username, raw.category,
+                       raw.amount, r.amount
+                FROM raw
+                LEFT JOIN expense_rollups r
+                    ON r.household_id = raw.household_id AND r.day = raw.day
+                    AND r.user_id = raw.user_id AND r.username = raw.username
+                    AND r.category = raw.category
+                WHERE r.count IS NULL OR r.count != raw.count
+                   OR ABS(r.amount - raw.amount) > ?
+                UNION ALL
+                SELECT r.household_id, r.day, r.user_id, r.username, r.category, NULL, r.amount
+                FROM expense_rollups r
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM raw
+                    WHERE raw.household_id = r.household_id AND raw.day = r.day
+                      AND raw.user_id = r.user_id AND raw.username = r.username
+                      AND raw.category = r.category
+                )
+            ''', (ROLLUP_TOLERANCE,))
+            
+            return cursor.fetchall()
+    
+    def set_category_override(self, household_id: int, merchant: str, category: str):
+        """Запомнить категорию для магазина в семье"""
+        with self._write() as conn:
+            conn.execute('''
+                INSERT INTO category_overrides (household_id, merchant, category, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (household_id, merchant) DO UPDATE
+                SET category = excluded.category, updated_at = excluded.updated_at
+            ''', (household_id, merchant, category, to_timestamp(datetime.now())))
+    
+    def get_category_override(self, household_id: int, merchant: str) -> Optional[str]:
+        """Исправленная категория магазина в семье или None"""
+        with self._read() as conn:
+            row = conn.execute(
+                'SELECT category FROM category_overrides WHERE household_id = ? AND merchant = ?',
+                (household_id, merchant)
+            ).fetchone()
+            
+            return row[0] if row else None
+    
+    def get_category_overrides(self, limit: int) -> List[Tuple[int, str, str]]:
+        """
+        Последние исправления категорий всех семей
+        (household_id, merchant, category), свежие первыми
+        """
+        with self._read() as conn:
+            cursor = conn.execute('''
+                SELECT household_id, merchant, category
+                FROM category_overrides
+                ORDER BY updated_at DESC
+                LIMIT ?
+            ''', (limit,))
+            
+            return cursor.fetchall()
+    
+    def get_expense_by_id(self, household_id: int, expense_id: int) -> Optional[Tuple]:
+        """Получить расход по ID"""
+        with self._read() as conn:
+            cursor = conn.execute('''
+                SELECT id, user_id, username, amount, category, description, date
+                FROM expenses
+                WHERE id = ? AND household_id = ?
+            ''', (expense_id, household_id))
+            
+            return cursor.fetchone()
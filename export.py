@@ -0,0 +1,115 @@
+"""
+Выгрузка расходов в CSV и XLSX
+
+Строки читаются из БД порциями и сразу пишутся в SpooledTemporaryFile:
+небольшой файл остается в памяти, большой уходит на диск, и в Python
+никогда не собирается список всех записей.
+
+Отправка при этом не потоковая: python-telegram-bot читает загружаемый
+файл в память целиком (InputFile). Поэтому размер выгрузки ограничен
+EXPORT_MAX_SIZE - это и предел памяти на отправку, и лимит Telegram
+на документы от ботов.
+"""
+
+import codecs
+import csv
+import io
+import tempfile
+from datetime import datetime
+from typing import IO, Iterable, Tuple
+
+from database import Database
+
+# Сколько держать в памяти, прежде чем временный файл уйдет на диск
+SPOOL_MAX_SIZE = 1024 * 1024
+
+# Больше Telegram не примет от бота, а при отправке файл целиком в памяти
+EXPORT_MAX_SIZE = 50 * 1024 * 1024
+
+EXPORT_HEADER = ('ID', 'Дата', 'Пользователь', 'Сумма', 'Категория', 'Описание')
+
+EXPORT_FORMATS = ('csv', 'xlsx')
+
+
+def _export_rows(rows: Iterable[Tuple]) -> Iterable[Tuple]:
+    """(id, user_id, username, amount, category, description, date, ts) -> строка файла"""
+    for expense_id, _, username, amount, category, description, date, _ in rows:
+        yield expense_id, date[:19].replace('T', ' '), username, amount, category, description
+
+
+def write_csv(rows: Iterable[Tuple], fileobj: IO[bytes], flush_every: int = 1000) -> int:
+    """Записать строки в CSV (UTF-8 с BOM, чтобы Excel понял кодировку), вернуть их число"""
+    fileobj.write(codecs.BOM_UTF8)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';')
+    writer.writerow(EXPORT_HEADER)
+
+    count = 0
+    for row in _export_rows(rows):
+        writer.writerow(row)
+        count += 1
+        if count % flush_every == 0:
+            fileobj.write(buffer.getvalue().encode('utf-8'))
+            buffer.seek(0)
+            buffer.truncate()
+
+    fileobj.write(buffer.getvalue().encode('utf-8'))
+    return count
+
+
+def write_xlsx(rows: Iterable[Tuple], fileobj: IO[bytes]) -> int:
+    """Записать строки в XLSX (нужен openpyxl), вернуть их число"""
+    from openpyxl import Workbook
+
+    # write_only: строки сразу сбрасываются во временный файл, а не держатся в памяти
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Расходы')
+    sheet.append(EXPORT_HEADER)
+
+    count = 0
+    for row in _export_rows(rows):
+        sheet.append(row)
+        count += 1
+
+    workbook.save(fileobj)
+    return count
+
+
+def xlsx_available() -> bool:
+    try:
+        import openpyxl  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def file_size(fileobj: IO[bytes]) -> int:
+    """Размер файла; позиция остается прежней"""
+    position = fileobj.tell()
+    size = fileobj.seek(0, io.SEEK_END)
+    fileobj.seek(position)
+    return size
+
+
+def export_expenses(db: Database, household_id: int, fmt: str = 'csv',
+                    start_date: datetime = None,
+                    end_date: datetime = None) -> Tuple[IO[bytes], int]:
+    """
+    Выгрузить расходы семьи за период во временный файл.
+    Возвращает файл, перемотанный в начало, и количество записей.
+    """
+    fileobj = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    rows = db.iter_expenses(household_id, start_date, end_date)
+    try:
+        if fmt == 'xlsx':
+            count = write_xlsx(rows, fileobj)
+        else:
+            count = write_csv(rows, fileobj)
+    except BaseException:
+        fileobj.close()
+        raise
+    finally:
+        rows.close()
+
+    fileobj.seek(0)
+    return fileobj, count
@@ -0,0 +1,147 @@
+"""
+Групповой коммит для записей в SQLite
+
+Каждый COMMIT ждет синхронизации диска, поэтому при всплесках записей
+(импорт выписки, вся семья пишет траты одновременно) пропускная
+способность упирается в fsync, а не в сами INSERT.
+
+GroupCommitDatabase ставит записи в очередь. Один поток-писатель
+забирает из нее все, что накопилось, пока шел предыдущий COMMIT (но не
+больше max_batch), и выполняет одной транзакцией: каждая операция - в своей
+точке сохранения, COMMIT - один на всех. Вызывающий получает результат
+(например, ID записи) через Future только после COMMIT, поэтому
+подтверждение пользователю уходит, когда запись уже на диске.
+
+Включается переменной окружения GROUP_COMMIT=1 (только STORAGE_MODE=single).
+"""
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, Tuple
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Методы Database, которые идут через очередь
+QUEUED_METHODS = frozenset({
+    'add_expense', 'add_expenses', 'import_expenses', 'delete_expense', 'update_expense',
+    'add_settlement', 'delete_settlement',
+})
+
+# Сколько операций в одной транзакции и сколько ждать, пока группа наберется.
+# Без ожидания группа набирается сама, пока идет предыдущий COMMIT, а
+# одиночная запись не теряет время (см. benchmarks/bench_group_commit.py)
+DEFAULT_MAX_BATCH = 256
+DEFAULT_MAX_DELAY = 0.0
+
+_STOP = object()
+
+
+class GroupCommitDatabase:
+    """
+    Тот же API, что и у Database: записи из QUEUED_METHODS выполняются
+    потоком-писателем группами, остальные методы вызываются напрямую.
+
+        db = GroupCommitDatabase(Database())
+        expense_id = db.add_expense(household_id, user_id, username, amount, category, description)
+        future = db.submit('add_expense', household_id, user_id, username, amount, category, description)
+    """
+
+    queued_methods = QUEUED_METHODS
+
+    def __init__(self, db: Database, max_batch: int = DEFAULT_MAX_BATCH,
+                 max_delay: float = DEFAULT_MAX_DELAY):
+        self.db = db
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay
+        self._queue: 'queue.Queue[Tuple[Callable[[], Any], Future]]' = queue.Queue()
+        self._closed = False
+
+        # Один fsync теперь покрывает всю группу, поэтому можно синхронизировать
+        # диск на каждом COMMIT: подтвержденная запись переживет и отключение питания
+        with db._write_lock:
+            db._writer.execute('PRAGMA synchronous = FULL')
+
+        self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+        self._thread.start()
+
+    def submit(self, name: str, *args, **kwargs) -> Future:
+        """Поставить запись в очередь, результат придет в Future после COMMIT"""
+        if name not in QUEUED_METHODS:
+            raise ValueError(f"{name} не выполняется через групповой коммит")
+        if self._closed:
+            raise RuntimeError('GroupCommitDatabase is closed')
+
+        method = getattr(self.db, name)
+        future = Future()
+        self._queue.put((lambda: method(*args, **kwargs), future))
+        return future
+
+    def __getattr__(self, name: str):
+        if name in QUEUED_METHODS:
+            def method(*args, **kwargs):
+                return self.submit(name, *args, **kwargs).result()
+            return method
+        return getattr(self.db, name)
+
+    def _collect(self, first) -> List[Tuple[Callable[[], Any], Future]]:
+        """Группа: первая операция и все, что уже в очереди или придет за max_delay"""
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                # Остановка - после того, как запишем уже собранное
+                self._queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                return
+
+            batch = [
+                (operation, future) for operation, future in self._collect(first)
+                if future.set_running_or_notify_cancel()
+            ]
+            if not batch:
+                continue
+
+            try:
+                results = self.db.run_batch([operation for operation, _ in batch])
+            except Exception as error:
+                logger.error(f"Групповой коммит не удался ({len(batch)} операций): {error}")
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+
+            for (_, future), (ok, value) in zip(batch, results):
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def close(self):
+        """Дописать очередь и закрыть базу"""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(_STOP)
+            self._thread.join()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
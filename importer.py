@@ -0,0 +1,218 @@
+"""
+Импорт расходов из CSV-выписок польских банков (mBank, PKO BP, ING)
+
+Файл читается построчно, каждая операция списания классифицируется через
+determine_category, и записи вставляются пачками в отдельных транзакциях.
+Повторный импорт той же выписки не создает дублей: у каждой записи есть
+хэш (дата, сумма, описание) с уникальным индексом в БД.
+"""
+
+import codecs
+import csv
+import hashlib
+import re
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import IO, Callable, Iterator, List, Optional, Tuple
+
+from categories import determine_category, normalize_text
+from database import Database
+
+# Сколько записей вставляется одной транзакцией
+IMPORT_BATCH_SIZE = 1000
+
+# Сколько первых строк файла просматриваем в поисках заголовка таблицы
+HEADER_SEARCH_LINES = 60
+
+# Сколько байт смотрим, чтобы угадать кодировку
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+# Максимальная длина описания импортированной записи
+DESCRIPTION_MAX = 200
+
+# 2024-01-31, 2024.01.31 или 31.01.2024, 31-01-2024 (strptime на 100k строк заметно медленнее)
+DATE_RE = re.compile(r'^(?:(\d{4})[-.](\d{2})[-.](\d{2})|(\d{2})[-.](\d{2})[-.](\d{4}))$')
+
+# Подписи, которые PKO BP добавляет к частям описания
+PKO_PREFIX_RE = re.compile(r'^(?:(?:Tytuł|Lokalizacja|Adres|Miasto|Kraj|Nazwa odbiorcy|'
+                           r'Nazwa nadawcy):\s*)+', re.IGNORECASE)
+
+# Части описания PKO BP, которые ничего не говорят о покупке
+PKO_NOISE_RE = re.compile(r'^(?:Numer telefonu|Numer referencyjny|Operacja|'
+                          r'Oryginalna kwota operacji|Numer karty):', re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class BankFormat:
+    """Описание формата выписки: разделитель и названия колонок"""
+    name: str
+    delimiter: str
+    date_columns: Tuple[str, ...]
+    amount_columns: Tuple[str, ...]
+    description_columns: Tuple[str, ...]
+    # PKO BP продолжает описание в колонках без названия
+    extra_description: bool = False
+
+
+BANK_FORMATS = (
+    BankFormat('mBank', ';', ('#Data operacji',), ('#Kwota',),
+               ('#Opis operacji', '#Tytuł', '#Nadawca/Odbiorca')),
+    BankFormat('PKO BP', ',', ('Data operacji',), ('Kwota',),
+               ('Opis transakcji',), extra_description=True),
+    BankFormat('ING', ';', ('Data transakcji',), ('Kwota transakcji (waluta rachunku)', 'Kwota'),
+               ('Dane kontrahenta', 'Tytuł')),
+)
+
+
+class ImportFormatError(ValueError):
+    """Файл не похож ни на одну поддерживаемую выписку"""
+
+
+@dataclass
+class ImportResult:
+    bank: str = ''
+    rows: int = 0          # строк данных в выписке
+    expenses: int = 0      # из них списаний
+    inserted: int = 0      # добавлено новых записей
+    skipped: int = 0       # поступления и нераспознанные строки
+
+    @property
+    def duplicates(self) -> int:
+        return self.expenses - self.inserted
+
+
+def detect_encoding(fileobj: IO[bytes]) -> str:
+    """UTF-8, если начало файла корректно декодируется, иначе cp1250 (Windows, как у банков)"""
+    sample = fileobj.read(ENCODING_SAMPLE_SIZE)
+    fileobj.seek(0)
+    try:
+        # Инкрементальный декодер не ругается на символ, разрезанный концом выборки
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+    except UnicodeDecodeError:
+        return 'cp1250'
+    return 'utf-8-sig'
+
+
+def parse_amount(value: str) -> Optional[float]:
+    """'-1 234,56 PLN' -> -1234.56"""
+    value = re.sub(r'[^\d,.+-]', '', value.replace('\xa0', ''))
+    if not value:
+        return None
+    if ',' in value:
+        value = value.replace('.', '').replace(',', '.')
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def parse_date(value: str) -> Optional[datetime]:
+    match = DATE_RE.match(value.strip())
+    if not match:
+        return None
+    year, month, day, day2, month2, year2 = match.groups()
+    try:
+        if year:
+            return datetime(int(year), int(month), int(day))
+        return datetime(int(year2), int(month2), int(day2))
+    except ValueError:
+        return None
+
+
+def _clean_description(parts: List[str]) -> str:
+    parts = [PKO_PREFIX_RE.sub('', part.strip()) for part in parts
+             if not PKO_NOISE_RE.match(part.strip())]
+    description = ' '.join(part for part in parts if part)
+    return re.sub(r'\s+', ' ', description).strip()[:DESCRIPTION_MAX]
+
+
+def _find_header(lines: Iterator[str]) -> Tuple[BankFormat, List[str]]:
+    """Пропустить вступление выписки и найти строку заголовка таблицы"""
+    for _, line in zip(range(HEADER_SEARCH_LINES), lines):
+        for bank in BANK_FORMATS:
+            cells = [cell.strip() for cell in next(csv.reader([line], delimiter=bank.delimiter), [])]
+            if (any(column in cells for column in bank.date_columns)
+                    and any(column in cells for column in bank.amount_columns)):
+                return bank, cells
+    raise ImportFormatError("Не найден заголовок выписки mBank, PKO BP или ING")
+
+
+def _column(cells: List[str], names: Tuple[str, ...]) -> Optional[int]:
+    for name in names:
+        if name in cells:
+            return cells.index(name)
+    return None
+
+
+def parse_statement(fileobj: IO[bytes], result: ImportResult) -> Iterator[Tuple[datetime, float, str]]:
+    """
+    Построчно разобрать выписку и вернуть списания (дата, сумма > 0, описание).
+    Поступления и строки, которые не удалось разобрать, считаются в result.skipped.
+    """
+    lines = codecs.getreader(detect_encoding(fileobj))(fileobj, errors='replace')
+    bank, header = _find_header(iter(lines))
+    result.bank = bank.name
+
+    date_index = _column(header, bank.date_columns)
+    amount_index = _column(header, bank.amount_columns)
+    description_indexes = [header.index(name) for name in bank.description_columns if name in header]
+    if bank.extra_description:
+        description_indexes += [i for i, name in enumerate(header) if not name]
+    width = len(header)
+
+    for row in csv.reader(lines, delimiter=bank.delimiter):
+        if not any(cell.strip() for cell in row):
+            continue
+        result.rows += 1
+
+        date = parse_date(row[date_index]) if date_index < len(row) else None
+        amount = parse_amount(row[amount_index]) if amount_index < len(row) else None
+        if date is None or amount is None or amount >= 0:
+            result.skipped += 1
+            continue
+
+        parts = [row[i] for i in description_indexes if i < len(row)]
+        if bank.extra_description:
+            parts.extend(row[width:])
+        description = _clean_description(parts) or bank.name
+
+        result.expenses += 1
+        yield date, -amount, description
+
+
+def import_hash(date: datetime, amount: float, description: str) -> str:
+    """Ключ для поиска дублей: одна и та же операция дает один и тот же хэш"""
+    key = f"{date:%Y-%m-%d}|{amount:.2f}|{normalize_text(description)}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def run_import(db: Database, fileobj: IO[bytes], household_id: int, user_id: int, username: str,
+               progress: Callable[[ImportResult], None] = None,
+               batch_size: int = IMPORT_BATCH_SIZE,
+               progress_interval: float = 2.0) -> ImportResult:
+    """
+    Импортировать выписку в БД. Выполняется синхронно - вызывать из потока БД.
+    progress(result) вызывается не чаще раза в progress_interval секунд.
+    """
+    result = ImportResult()
+    batch = []
+    last_report = time.monotonic()
+
+    def flush():
+        result.inserted += db.import_expenses(household_id, user_id, username, batch)
+        batch.clear()
+
+    for date, amount, description in parse_statement(fileobj, result):
+        category = determine_category(description, household_id)
+        batch.append((date, amount, category, description, import_hash(date, amount, description)))
+
+        if len(batch) >= batch_size:
+            flush()
+            if progress and time.monotonic() - last_report >= progress_interval:
+                progress(result)
+                last_report = time.monotonic()
+
+    if batch:
+        flush()
+    return result
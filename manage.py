@@ -0,0 +1,106 @@
+"""
+Служебные команды для обслуживания базы данных
+
+Примеры:
+    python manage.py verify-rollups
+    python manage.py rebuild-rollups --db expenses.db
+    python manage.py migrate --shard-dir shards
+    python manage.py check --shard-dir shards
+    python manage.py split-shards --db expenses.db --shard-dir shards
+
+С --shard-dir команды обходят все файлы семей (STORAGE_MODE=sharded).
+"""
+
+import argparse
+import sys
+
+from database import Database
+from sharding import ShardedDatabase, split_into_shards
+
+
+def verify_rollups(db: Database) -> int:
+    """Сверить агрегаты с сырыми записями"""
+    mismatches = db.verify_rollups()
+    if not mismatches:
+        print("✅ Агрегаты совпадают с записями")
+        return 0
+
+    print(f"❌ Найдено расхождений: {len(mismatches)}")
+    for household_id, day, user_id, username, category, expected, actual in mismatches:
+        print(f"  семья {household_id}, день {day}, {username} ({user_id}), {category}: "
+              f"записи={expected}, агрегаты={actual}")
+    print("Исправить: python manage.py rebuild-rollups")
+    return 1
+
+
+def rebuild_rollups(db: Database) -> int:
+    """Пересчитать агрегаты с нуля"""
+    rows = db.rebuild_rollups()
+    print(f"✅ Агрегаты пересчитаны, строк: {rows}")
+    return 0
+
+
+def migrate(db: Database) -> int:
+    """Применить миграции схемы (в режиме файлов семей - к каждому файлу)"""
+    version = db.migrate()
+    print(f"✅ Версия схемы: {version}")
+    return 0
+
+
+def check(db: Database) -> int:
+    """Проверить целостность файлов и сверить агрегаты"""
+    if isinstance(db, ShardedDatabase):
+        problems = db.check_shards()
+        print(f"Файлов семей: {len(db.household_ids())}")
+    else:
+        with db._read() as conn:
+            result = conn.execute('PRAGMA quick_check').fetchone()[0]
+        problems = [] if result == 'ok' else [f"quick_check: {result}"]
+
+    for problem in problems:
+        print(f"  ❌ {problem}")
+    if problems:
+        return 1
+
+    print("✅ Файлы в порядке")
+    return verify_rollups(db)
+
+
+def split_shards(db_file: str, shard_dir: str) -> int:
+    """Разложить общую базу по файлам семей"""
+    with Database(db_file) as source, ShardedDatabase(shard_dir) as target:
+        copied = split_into_shards(source, target)
+
+    for household_id, count in copied:
+        print(f"  семья {household_id}: записей {count}")
+    print(f"✅ Семей: {len(copied)}. Дальше: STORAGE_MODE=sharded SHARD_DIR={shard_dir}")
+    return 0
+
+
+COMMANDS = {
+    'verify-rollups': verify_rollups,
+    'rebuild-rollups': rebuild_rollups,
+    'migrate': migrate,
+    'check': check,
+}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Обслуживание базы данных бота")
+    parser.add_argument('command', choices=sorted([*COMMANDS, 'split-shards']), help="команда")
+    parser.add_argument('--db', default='expenses.db', help="файл базы данных")
+    parser.add_argument('--shard-dir', help="папка с файлами семей (STORAGE_MODE=sharded)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'split-shards':
+        if not args.shard_dir:
+            parser.error("split-shards требует --shard-dir")
+        return split_shards(args.db, args.shard_dir)
+
+    storage = ShardedDatabase(args.shard_dir) if args.shard_dir else Database(args.db)
+    with storage as db:
+        return COMMANDS[args.command](db)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
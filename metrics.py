@@ -0,0 +1,246 @@
+"""
+Метрики в текстовом формате Prometheus
+
+Без внешних зависимостей: счетчики, гистограммы и вычисляемые значения,
+обертки для обработчиков бота и методов Database. Запись одного
+наблюдения - пара perf_counter() и бинарный поиск корзины, поэтому
+метрики можно держать включенными в продакшене.
+"""
+
+import bisect
+import functools
+import inspect
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Границы корзин гистограмм задержки, в секундах
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Границы корзин для количества строк в результате
+ROWS_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 10000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """Монотонно растущий счетчик"""
+
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount: float = 1.0):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+                for labels, value in items]
+
+
+class Histogram:
+    """Распределение значений по корзинам с суммой и количеством"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [счетчики по корзинам (последняя - +Inf), сумма, количество]
+        self._values: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                state = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._values[labelvalues] = state
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            items = sorted((labels, ([*state[0]], state[1], state[2]))
+                           for labels, state in self._values.items())
+
+        lines = []
+        names = self.labelnames + ('le',)
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket'
+                             f'{_format_labels(names, labels + (_format_value(bound),))} {cumulative}')
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_text} {_format_value(total)}')
+            lines.append(f'{self.name}_count{label_text} {count}')
+        return lines
+
+
+class GaugeFunction:
+    """Значение, которое вычисляется в момент чтения метрик"""
+
+    type_name = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str],
+                 func: Callable[[], Iterable[Tuple[Tuple, float]]]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.func = func
+
+    def collect(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+                for labels, value in self.func()]
+
+
+class Registry:
+    """Набор метрик, которые отдаются на /metrics"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type_name}')
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_LATENCY = REGISTRY.register(Histogram(
+    'bot_handler_duration_seconds', 'Время работы обработчика', ['handler']))
+HANDLER_ERRORS = REGISTRY.register(Counter(
+    'bot_handler_errors_total', 'Исключения в обработчиках', ['handler']))
+DB_LATENCY = REGISTRY.register(Histogram(
+    'db_query_duration_seconds', 'Время выполнения метода Database', ['method']))
+DB_ERRORS = REGISTRY.register(Counter(
+    'db_query_errors_total', 'Исключения в методах Database', ['method']))
+DB_ROWS = REGISTRY.register(Histogram(
+    'db_query_rows', 'Количество строк в результате метода Database', ['method'],
+    buckets=ROWS_BUCKETS))
+DB_CONNECT_LATENCY = REGISTRY.register(Histogram(
+    'db_connect_duration_seconds', 'Время открытия соединения с SQLite', ['role']))
+REJECTED_UPDATES = REGISTRY.register(Counter(
+    'bot_rejected_updates_total', 'Обновления, отсеченные проверкой доступа', ['reason']))
+
+
+def instrument_handler(callback: Callable) -> Callable:
+    """Обернуть async-обработчик бота: задержка, вызовы и ошибки"""
+    # Импорт здесь: database.py тоже использует метрики и не должен зависеть от telegram
+    from telegram.ext import ApplicationHandlerStop
+
+    name = getattr(callback, '__name__', 'handler')
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise  # штатная остановка обработки, не ошибка
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, name)
+
+    return wrapper
+
+
+def instrument_application(application):
+    """Обернуть все зарегистрированные обработчики приложения"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_handler(handler.callback)
+
+
+def _result_rows(result) -> Optional[int]:
+    """
+    Число строк результата: список строк или кортеж, первый элемент которого -
+    страница строк ((записи, есть ли еще) у get_history_page и search_expenses,
+    столбцы у get_daily_category_totals). Для остального - None.
+    """
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, tuple) and result and isinstance(result[0], list):
+        return len(result[0])
+    return None
+
+
+def _instrument_method(method: Callable) -> Callable:
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(name)
+            raise
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - started, name)
+
+        rows = _result_rows(result)
+        if rows is not None:
+            DB_ROWS.observe(rows, name)
+        return result
+
+    return wrapper
+
+
+def instrument_methods(cls):
+    """
+    Декоратор класса: все публичные методы пишут задержку,
+    количество вызовов, ошибок и строк результата.
+    Генераторы не оборачиваются - их время уходит на итерацию, а не на вызов.
+    """
+    for name, member in list(vars(cls).items()):
+        if name.startswith('_') or not inspect.isfunction(member):
+            continue
+        if inspect.isgeneratorfunction(inspect.unwrap(member)):
+            continue
+        setattr(cls, name, _instrument_method(member))
+    return cls
@@ -0,0 +1,198 @@
+"""
+Фоновая отправка уведомлений другим пользователям
+
+Обработчик только ставит уведомление в очередь и сразу отвечает пользователю.
+Записи одного отправителя, пришедшие в течение окна debounce_seconds,
+объединяются в одно сообщение; слишком длинное сообщение делится на части
+по MAX_MESSAGE_LENGTH символов. Отправка учитывает лимиты Telegram
+(примерно 1 сообщение в секунду в один чат и 30 в секунду всего)
+и повторяется после ответа 429 Too Many Requests.
+
+Каждый чат отправляется своей задачей: пока один чат ждет после 429 или
+ошибки сети, сообщения в остальные чаты уходят без задержки.
+"""
+
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from datetime import timedelta
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEBOUNCE_SECONDS = 5.0
+PER_CHAT_RATE = 1.0     # сообщений в секунду в один чат
+GLOBAL_RATE = 25.0      # сообщений в секунду всего (лимит Telegram - 30)
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 1.0
+MAX_MESSAGE_LENGTH = 4096   # лимит Telegram на длину текста сообщения
+MAX_TRACKED_CHATS = 10000   # сколько последних чатов помнить для лимитов
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """Разбить текст на части не длиннее limit, по возможности по строкам"""
+    chunks = []
+    current = ''
+    for line in text.split('\n'):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            chunks.append(current)
+            candidate = line
+        current = candidate
+    if current or not chunks:
+        chunks.append(current)
+    return chunks
+
+
+class NotificationDispatcher:
+    """
+    Очередь уведомлений с объединением записей и ограничением частоты.
+
+    formatter(sender_name, items) -> str собирает текст одного сообщения
+    из всех записей отправителя, накопленных за окно.
+    """
+
+    def __init__(self, formatter: Callable[[str, List[Any]], str],
+                 debounce_seconds: float = DEFAULT_DEBOUNCE_SECONDS,
+                 per_chat_rate: float = PER_CHAT_RATE,
+                 global_rate: float = GLOBAL_RATE,
+                 max_retries: int = MAX_RETRIES):
+        self.formatter = formatter
+        self.debounce_seconds = debounce_seconds
+        self.per_chat_rate = per_chat_rate
+        self.max_retries = max_retries
+
+        self._bot = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets: 'OrderedDict[int, TokenBucket]' = OrderedDict()
+        # Чат -> очередь его сообщений и задача, которая их отправляет;
+        # запись удаляется, как только очередь чата опустела
+        self._chats: Dict[int, Tuple[Deque[str], asyncio.Task]] = {}
+        # (отправитель, чат) -> (имя отправителя, записи, таймер)
+        self._pending: Dict[Tuple[int, int], Tuple[str, List[Any], asyncio.TimerHandle]] = {}
+
+    async def start(self, bot):
+        """Запустить фоновую отправку"""
+        self._bot = bot
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run(), name='notifications')
+
+    async def stop(self):
+        """Отправить все накопленное и остановить отправку"""
+        if self._worker is None:
+            return
+
+        for key in list(self._pending):
+            self._flush(key)
+        await self._queue.join()
+
+        tasks = [self._worker] + [task for _, task in self._chats.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._chats.clear()
+        self._worker = None
+
+    def notify(self, chat_id: int, sender_id: int, sender_name: str, items: List[Any]):
+        """Поставить записи в очередь уведомлений; не ждет отправки"""
+        if self._queue is None:
+            logger.warning("Уведомления не запущены, сообщение пропущено")
+            return
+
+        key = (sender_id, chat_id)
+        if key in self._pending:
+            _, pending_items, timer = self._pending[key]
+            pending_items.extend(items)
+            return
+
+        loop = asyncio.get_running_loop()
+        timer = loop.call_later(self.debounce_seconds, self._flush, key)
+        self._pending[key] = (sender_name, list(items), timer)
+
+    def _flush(self, key: Tuple[int, int]):
+        """Окно закрылось - собрать одно сообщение из накопленных записей"""
+        sender_name, items, timer = self._pending.pop(key)
+        timer.cancel()
+        _, chat_id = key
+        for text in split_message(self.formatter(sender_name, items)):
+            self._queue.put_nowait((chat_id, text))
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.per_chat_rate, 1)
+            self._chat_buckets[chat_id] = bucket
+            while len(self._chat_buckets) > MAX_TRACKED_CHATS:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _run(self):
+        """Раздать сообщения из общей очереди по задачам чатов"""
+        while True:
+            chat_id, text = await self._queue.get()
+            chat = self._chats.get(chat_id)
+            if chat is not None:
+                chat[0].append(text)
+                continue
+            messages = deque([text])
+            task = asyncio.create_task(self._run_chat(chat_id, messages),
+                                       name=f'notifications-{chat_id}')
+            self._chats[chat_id] = (messages, task)
+
+    async def _run_chat(self, chat_id: int, messages: Deque[str]):
+        """Отправить сообщения одного чата по порядку и завершиться"""
+        try:
+            while messages:
+                text = messages.popleft()
+                try:
+                    await self._send(chat_id, text)
+                except Exception as e:
+                    logger.error(f"Не удалось отправить уведомление в {chat_id}: {e}")
+                finally:
+                    self._queue.task_done()
+        finally:
+            self._chats.pop(chat_id, None)
+
+    async def _send(self, chat_id: int, text: str):
+        """Отправить с учетом лимитов и повторами при ошибках сети и 429"""
+        for attempt in range(self.max_retries + 1):
+            await self._chat_bucket(chat_id).acquire()
+            await self._global_bucket.acquire()
+            try:
+                await self._bot.send_message(chat_id=chat_id, text=text)
+                return
+            except RetryAfter as e:
+                delay = _retry_after_seconds(e)
+                logger.warning(f"Telegram просит подождать {delay:.0f} с перед отправкой в {chat_id}")
+            except (Forbidden, BadRequest):
+                # Пользователь заблокировал бота или чат не существует - повтор не поможет
+                raise
+            except NetworkError as e:
+                delay = BACKOFF_SECONDS * 2 ** attempt
+                logger.warning(f"Ошибка сети при отправке в {chat_id}: {e}, повтор через {delay:.0f} с")
+
+            if attempt < self.max_retries:
+                await asyncio.sleep(delay)
+
+        raise RuntimeError(f"превышено число попыток ({self.max_retries})")
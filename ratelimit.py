@@ -0,0 +1,44 @@
+"""
+Ограничение частоты запросов алгоритмом "ведро с токенами"
+"""
+
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Ведро на capacity токенов, которое пополняется со скоростью rate токенов в секунду.
+    Каждый запрос забирает токены; если их не хватает, запрос нужно отложить.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """Забрать токены, если они есть; не ждет"""
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    def delay(self, tokens: float = 1.0) -> float:
+        """Сколько секунд ждать, пока накопится нужное количество токенов"""
+        self._refill()
+        if self._tokens >= tokens:
+            return 0.0
+        return (tokens - self._tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1.0):
+        """Дождаться токенов и забрать их"""
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.delay(tokens))
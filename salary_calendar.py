@@ -0,0 +1,136 @@
+"""
+Календарь зарплатных периодов с учетом выходных и польских праздников
+
+Зарплата приходит в день pay_day каждого месяца, а если он выпадает на
+выходной или праздник - в ближайший рабочий день раньше. Зарплатный
+период длится от одного дня зарплаты до следующего.
+
+Даты выплат считаются один раз на pay_day и дальше ищутся бинарным
+поиском. Нужные периоды передаются в SQL списком, чтобы статистику по
+периодам можно было посчитать одним GROUP BY.
+"""
+
+import bisect
+import calendar
+import functools
+from datetime import date, datetime, timedelta
+from typing import FrozenSet, List, Tuple
+
+DEFAULT_PAY_DAY = 10
+
+# Годы, за которые календарь посчитан заранее
+CALENDAR_START_YEAR = 2000
+CALENDAR_END_YEAR = 2060
+
+EPOCH = date(1970, 1, 1)
+
+
+def epoch_day(day: date) -> int:
+    """Номер дня от 1970-01-01 - то же, что ts / 86400 в expense_rollups"""
+    return day.toordinal() - EPOCH.toordinal()
+
+
+def from_epoch_day(number: int) -> date:
+    return date.fromordinal(EPOCH.toordinal() + number)
+
+
+def easter_sunday(year: int) -> date:
+    """Пасха по григорианскому календарю (алгоритм Meeus/Jones/Butcher)"""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+@functools.lru_cache(maxsize=None)
+def polish_holidays(year: int) -> FrozenSet[date]:
+    """Нерабочие праздничные дни в Польше"""
+    easter = easter_sunday(year)
+    holidays = {
+        date(year, 1, 1),                # Nowy Rok
+        date(year, 1, 6),                # Trzech Króli
+        easter,                          # Wielkanoc
+        easter + timedelta(days=1),      # Poniedziałek Wielkanocny
+        date(year, 5, 1),                # Święto Pracy
+        date(year, 5, 3),                # Święto Konstytucji 3 Maja
+        easter + timedelta(days=49),     # Zielone Świątki
+        easter + timedelta(days=60),     # Boże Ciało
+        date(year, 8, 15),               # Wniebowzięcie NMP
+        date(year, 11, 1),               # Wszystkich Świętych
+        date(year, 11, 11),              # Święto Niepodległości
+        date(year, 12, 25),              # Boże Narodzenie
+        date(year, 12, 26),              # drugi dzień Bożego Narodzenia
+    }
+    if year >= 2025:
+        holidays.add(date(year, 12, 24))  # Wigilia - выходной с 2025 года
+    return frozenset(holidays)
+
+
+def is_working_day(day: date) -> bool:
+    return day.weekday() < 5 and day not in polish_holidays(day.year)
+
+
+def pay_date(year: int, month: int, pay_day: int = DEFAULT_PAY_DAY) -> date:
+    """День зарплаты в месяце: pay_day или ближайший рабочий день раньше"""
+    day = date(year, month, min(pay_day, calendar.monthrange(year, month)[1]))
+    while not is_working_day(day):
+        day -= timedelta(days=1)
+    return day
+
+
+@functools.lru_cache(maxsize=None)
+def pay_dates(pay_day: int = DEFAULT_PAY_DAY) -> Tuple[date, ...]:
+    """Все дни зарплаты календаря по возрастанию"""
+    return tuple(
+        pay_date(year, month, pay_day)
+        for year in range(CALENDAR_START_YEAR, CALENDAR_END_YEAR + 1)
+        for month in range(1, 13)
+    )
+
+
+def _previous_month(year: int, month: int) -> Tuple[int, int]:
+    return (year - 1, 12) if month == 1 else (year, month - 1)
+
+
+def _next_month(year: int, month: int) -> Tuple[int, int]:
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def salary_period(day: date, pay_day: int = DEFAULT_PAY_DAY) -> Tuple[date, date]:
+    """Зарплатный период [начало, конец), в который попадает день"""
+    dates = pay_dates(pay_day)
+    index = bisect.bisect_right(dates, day)
+    if 0 < index < len(dates):
+        return dates[index - 1], dates[index]
+
+    # За пределами календаря считаем напрямую
+    start = pay_date(day.year, day.month, pay_day)
+    if day < start:
+        return pay_date(*_previous_month(day.year, day.month), pay_day), start
+    return start, pay_date(*_next_month(day.year, day.month), pay_day)
+
+
+def get_salary_period(pay_day: int = DEFAULT_PAY_DAY) -> datetime:
+    """
+    Вычисляет начало текущего зарплатного периода.
+    ЗП pay_day числа (или раньше, если выходной/праздник в Польше)
+    Даты выплат берутся из заранее посчитанного календаря
+    """
+    start, _ = salary_period(datetime.now().date(), pay_day)
+    return datetime.combine(start, datetime.min.time())
+
+
+def recent_salary_periods(day: date, pay_day: int = DEFAULT_PAY_DAY,
+                          count: int = 24) -> List[Tuple[date, date]]:
+    """Последние count периодов [начало, конец), начавшихся не позже дня day, от нового к старому"""
+    dates = pay_dates(pay_day)
+    # Последний день календаря - только конец периода
+    latest = min(bisect.bisect_right(dates, day), len(dates) - 1) - 1
+    return [(dates[i], dates[i + 1]) for i in range(latest, max(latest - count, -1), -1)]
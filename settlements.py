@@ -0,0 +1,108 @@
+"""
+Кто кому сколько должен внутри семьи
+
+Расходы делятся поровну между участниками - текущими и теми, кто уже
+вышел из семьи, но успел что-то оплатить или перевести. Позиция участника -
+сколько он оплатил и перевел в расчетах минус его доля и полученные
+переводы: плюс - семья должна ему, минус - он должен семье.
+
+Долги гасятся жадно: самый крупный должник платит самому крупному
+кредитору, пока все позиции не обнулятся. Так получается не больше
+N-1 переводов, и обычно это минимально возможное число.
+"""
+
+import heapq
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Tuple
+
+# Долги меньше этой суммы считаем округлением
+SETTLE_EPSILON = 0.01
+
+
+@dataclass(frozen=True)
+class Position:
+    """Позиция участника в расчетах семьи"""
+    user_id: int
+    username: str
+    paid: float     # оплачено расходов
+    share: float    # доля в общих расходах
+    net: float      # плюс - ему должны, минус - должен он
+
+
+@dataclass(frozen=True)
+class Transfer:
+    """Перевод, который гасит долг"""
+    from_user_id: int
+    from_username: str
+    to_user_id: int
+    to_username: str
+    amount: float
+
+
+def compute_positions(positions: Iterable[Tuple[int, str, float, float, float]],
+                      members: Iterable[Tuple[int, str]]) -> List[Position]:
+    """
+    Позиции участников семьи.
+
+    positions - строки member_positions (user_id, имя, оплачено, переведено,
+    получено); members - текущие участники (user_id, имя). Вышедшие из
+    семьи остаются в расчете, пока у них есть оплаты или переводы: их
+    расходы входят в общую сумму, значит, и доля, и долг остаются за ними.
+    Поэтому позиции всегда в сумме дают ноль.
+    """
+    names = dict(members)
+    rows = {}
+    for user_id, username, paid, sent, received in positions:
+        rows[user_id] = (paid, sent, received)
+        if user_id not in names and max(abs(paid), abs(sent), abs(received)) > SETTLE_EPSILON:
+            names[user_id] = username
+    if not names:
+        return []
+
+    share = sum(paid for paid, _, _ in rows.values()) / len(names)
+    result = []
+    for user_id, username in names.items():
+        paid, sent, received = rows.get(user_id, (0.0, 0.0, 0.0))
+        result.append(Position(user_id, username, paid, share, paid + sent - received - share))
+
+    # Расчеты только перераспределяют деньги внутри семьи - сумма позиций ноль,
+    # иначе план переводов не погасит все долги
+    imbalance = sum(position.net for position in result)
+    if abs(imbalance) > SETTLE_EPSILON * len(result):
+        raise ValueError(f"Позиции участников не сходятся: {imbalance:+.2f}")
+    return sorted(result, key=lambda position: position.net, reverse=True)
+
+
+def minimal_transfers(positions: Iterable[Position],
+                      epsilon: float = SETTLE_EPSILON) -> List[Transfer]:
+    """Переводы, которые обнуляют все позиции"""
+    # heapq - куча минимумов, поэтому кредиторов кладем с минусом
+    creditors = [(-p.net, p.user_id, p.username) for p in positions if p.net > epsilon]
+    debtors = [(p.net, p.user_id, p.username) for p in positions if p.net < -epsilon]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    transfers = []
+    while creditors and debtors:
+        credit, creditor_id, creditor_name = heapq.heappop(creditors)
+        debt, debtor_id, debtor_name = heapq.heappop(debtors)
+        amount = min(-credit, -debt)
+        transfers.append(Transfer(debtor_id, debtor_name, creditor_id, creditor_name,
+                                  round(amount, 2)))
+
+        # Остаток крупнее погрешности возвращается в кучу
+        if -credit - amount > epsilon:
+            heapq.heappush(creditors, (credit + amount, creditor_id, creditor_name))
+        if -debt - amount > epsilon:
+            heapq.heappush(debtors, (debt + amount, debtor_id, debtor_name))
+    return transfers
+
+
+def find_transfer(transfers: Iterable[Transfer], from_user_id: int, to_user_id: int,
+                  amount: float, epsilon: float = SETTLE_EPSILON) -> Optional[Transfer]:
+    """Перевод из текущего плана или None, если план уже изменился"""
+    for transfer in transfers:
+        if (transfer.from_user_id == from_user_id and transfer.to_user_id == to_user_id
+                and abs(transfer.amount - amount) < epsilon):
+            return transfer
+    return None
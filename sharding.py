@@ -0,0 +1,483 @@
+"""
+Хранение по семьям: отдельный файл SQLite на каждую семью
+
+SQLite пропускает только одного писателя на файл, поэтому при общей базе
+семьи ждут друг друга. В режиме STORAGE_MODE=sharded у каждой семьи свой
+файл в SHARD_DIR, и записи разных семей не конкурируют за блокировку.
+
+Семьи, участники и выученные категории лежат в общем справочнике
+(directory.db) со своей небольшой схемой: по нему пользователь находит
+свою семью, а по семье - файл с ее расходами. Открытые файлы держатся в LRU ограниченного
+размера и закрываются после простоя.
+"""
+
+import functools
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Iterator, List, Tuple
+
+from cache import DEFAULT_CACHE_SIZE, QueryCache
+from database import (DEFAULT_HOUSEHOLD_ID, DEFAULT_READERS, EXPORT_CHUNK_SIZE, MIGRATIONS,
+                      Database, generate_join_code, to_timestamp)
+from group_commit import DEFAULT_MAX_BATCH, DEFAULT_MAX_DELAY, GroupCommitDatabase
+from salary_calendar import DEFAULT_PAY_DAY
+
+STORAGE_MODES = ('single', 'sharded')
+
+DEFAULT_SHARD_DIR = 'shards'
+DIRECTORY_FILE = 'directory.db'
+SHARD_FILE_TEMPLATE = 'household_{}.db'
+SHARD_FILE_RE = re.compile(r'^household_(\d+)\.db$')
+
+# Сколько файлов семей держим открытыми и через сколько секунд простоя закрываем
+DEFAULT_MAX_OPEN_SHARDS = 32
+DEFAULT_SHARD_IDLE_SECONDS = 600
+
+# Читающих соединений на один файл семьи: запросы одной семьи редко идут параллельно
+SHARD_READERS = 2
+
+# Потоков БД в AsyncDatabase: записи разных семей идут параллельно
+SHARD_WORKERS = 2 * DEFAULT_READERS
+
+# Методы Database, первый аргумент которых - household_id
+HOUSEHOLD_METHODS = frozenset({
+    'add_expense', 'add_expenses', 'import_expenses', 'delete_expense', 'update_expense',
+    'get_recent_expenses', 'get_history_page', 'get_total', 'get_by_category',
+    'get_by_user', 'get_by_user_and_category', 'get_stats_snapshot', 'get_expense_by_id',
+    'get_salary_period_totals', 'get_daily_category_totals', 'get_data_version',
+    'add_settlement', 'delete_settlement', 'get_settlements', 'get_positions',
+    'search_expenses', 'get_search_summary', 'rebuild_positions',
+})
+
+# Методы, которые работают со справочником
+DIRECTORY_METHODS = frozenset({
+    'create_household', 'join_household', 'add_household_members', 'get_household_id',
+    'get_member_households', 'get_household', 'get_household_members', 'set_pay_day', 'set_category_override',
+    'get_category_override', 'get_category_overrides', 'get_schema_version',
+})
+
+
+def _migration_create_directory(conn: sqlite3.Connection):
+    """
+    Таблицы справочника в том виде, какой они приняли к v12 схемы Database.
+    Справочники, которые раньше создавались полной Database, уже на v12
+    и эту миграцию пропускают; таблиц расходов в новом справочнике нет.
+    """
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS households (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            join_code TEXT NOT NULL UNIQUE,
+            created_at INTEGER NOT NULL,
+            pay_day INTEGER NOT NULL DEFAULT {DEFAULT_PAY_DAY}
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS household_members (
+            user_id INTEGER PRIMARY KEY,
+            household_id INTEGER NOT NULL REFERENCES households (id),
+            username TEXT NOT NULL,
+            joined_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_household_members_household
+        ON household_members (household_id, user_id)
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS category_overrides (
+            household_id INTEGER NOT NULL,
+            merchant TEXT NOT NULL,
+            category TEXT NOT NULL,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (household_id, merchant)
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_category_overrides_updated
+        ON category_overrides (updated_at)
+    ''')
+    conn.execute(
+        'INSERT OR IGNORE INTO households (id, name, join_code, created_at) VALUES (?, ?, ?, ?)',
+        (DEFAULT_HOUSEHOLD_ID, 'Семья', generate_join_code(), to_timestamp(datetime.now()))
+    )
+
+
+# Миграции справочника. Номера общие с MIGRATIONS: изменения таблиц
+# справочника добавляются в оба списка под одним номером.
+DIRECTORY_MIGRATIONS = [
+    (12, _migration_create_directory),
+]
+
+
+class DirectoryDatabase(Database):
+    """Справочник: методы Database для семей, участников и исправлений категорий"""
+    migrations = DIRECTORY_MIGRATIONS
+
+    def init_db(self):
+        # Расходов в справочнике нет - заполнять ts нечему
+        self.migrate()
+
+
+class _Shard:
+    """
+    Файл семьи и число вызовов, которые сейчас его используют.
+    opened завершается, когда Database открыта (миграции применены).
+    """
+    __slots__ = ('opened', 'users', 'last_used')
+
+    def __init__(self):
+        self.opened: Future = Future()
+        self.users = 0
+        self.last_used = time.monotonic()
+
+    @staticmethod
+    def close_when_open(shard: '_Shard'):
+        """Закрыть Database, как только она откроется (или сразу, если уже открыта)"""
+        def close(opened: Future):
+            if opened.exception() is None:
+                opened.result().close()
+        shard.opened.add_done_callback(close)
+
+
+class ShardedDatabase:
+    """
+    Тот же API, что и у Database: методы с household_id уходят в файл
+    семьи, остальные - в справочник.
+
+        db = ShardedDatabase('shards')
+        household_id = db.get_household_id(user_id)
+        db.add_expense(household_id, user_id, username, amount, category, description)
+    """
+
+    def __init__(self, shard_dir: str = DEFAULT_SHARD_DIR,
+                 max_open: int = DEFAULT_MAX_OPEN_SHARDS,
+                 idle_seconds: float = DEFAULT_SHARD_IDLE_SECONDS,
+                 cache_size: int = DEFAULT_CACHE_SIZE):
+        # Путь считается от папки бота, как и у Database
+        basedir = os.path.abspath(os.path.dirname(__file__))
+        self.shard_dir = os.path.join(basedir, shard_dir)
+        os.makedirs(self.shard_dir, exist_ok=True)
+
+        self.max_open = max(1, max_open)
+        self.idle_seconds = idle_seconds
+        # Для AsyncDatabase: сколько потоков БД держать
+        self._max_readers = SHARD_WORKERS - 1
+
+        # Общий кэш: в ключе есть household_id, поэтому семьи не пересекаются
+        self.cache = QueryCache(cache_size)
+        self.directory = DirectoryDatabase(os.path.join(self.shard_dir, DIRECTORY_FILE), cache_size=0)
+
+        self._shards: 'OrderedDict[int, _Shard]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._closed = False
+
+        # Простаивающие файлы закрываются и без новых запросов
+        self._stop_sweeper = threading.Event()
+        self._sweeper = threading.Thread(target=self._sweep, name='shard-sweeper', daemon=True)
+        self._sweeper.start()
+
+    def shard_path(self, household_id: int) -> str:
+        """Файл с расходами семьи"""
+        return os.path.join(self.shard_dir, SHARD_FILE_TEMPLATE.format(household_id))
+
+    def household_ids(self) -> List[int]:
+        """Семьи, для которых уже есть файл"""
+        ids = []
+        for name in os.listdir(self.shard_dir):
+            match = SHARD_FILE_RE.match(name)
+            if match:
+                ids.append(int(match.group(1)))
+        return sorted(ids)
+
+    def _acquire(self, household_id: int) -> Database:
+        """
+        Открыть (или взять из LRU) файл семьи и пометить его занятым.
+
+        Под общей блокировкой только обновляются LRU и счетчики: файл
+        открывается (миграции, календарь периодов) и вытесненные файлы
+        закрываются вне ее, поэтому остальные семьи в это время не ждут.
+        Одновременные вызовы для еще не открытой семьи ждут одного открытия.
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('ShardedDatabase is closed')
+
+            shard = self._shards.get(household_id)
+            opening = shard is None
+            if opening:
+                shard = _Shard()
+                self._shards[household_id] = shard
+
+            shard.users += 1
+            shard.last_used = time.monotonic()
+            self._shards.move_to_end(household_id)
+            evicted = self._evict_locked()
+
+        for old in evicted:
+            _Shard.close_when_open(old)
+
+        if opening:
+            try:
+                # Database сама применяет миграции при открытии
+                db = Database(self.shard_path(household_id), readers=SHARD_READERS, cache_size=0)
+                db.cache = self.cache
+            except BaseException as error:
+                with self._lock:
+                    if self._shards.get(household_id) is shard:
+                        del self._shards[household_id]
+                shard.opened.set_exception(error)
+                raise
+            shard.opened.set_result(db)
+
+        return shard.opened.result()
+
+    def _release(self, household_id: int):
+        with self._lock:
+            shard = self._shards.get(household_id)
+            if shard is None:
+                # Хранилище закрыли, пока вызов работал с файлом
+                return
+            shard.users -= 1
+            shard.last_used = time.monotonic()
+
+    def _evict_locked(self) -> List[_Shard]:
+        """
+        Убрать из LRU лишние и простаивающие файлы (самые давние - первыми).
+        Закрывает их вызывающий - уже без блокировки.
+        """
+        now = time.monotonic()
+        evicted = []
+        for household_id, shard in list(self._shards.items()):
+            if shard.users:
+                continue
+            if len(self._shards) > self.max_open or now - shard.last_used > self.idle_seconds:
+                del self._shards[household_id]
+                evicted.append(shard)
+                # Заново открытый файл начнет data_version с нуля - старые записи
+                # кэша этой семьи могли бы совпасть с новыми версиями
+                self.cache.discard(household_id)
+        return evicted
+
+    def evict_idle(self):
+        """Закрыть файлы, которые простаивают дольше idle_seconds"""
+        with self._lock:
+            evicted = [] if self._closed else self._evict_locked()
+        for shard in evicted:
+            _Shard.close_when_open(shard)
+
+    def _sweep(self):
+        interval = max(1.0, self.idle_seconds / 2)
+        while not self._stop_sweeper.wait(interval):
+            self.evict_idle()
+
+    def open_shards(self) -> int:
+        """Сколько файлов семей сейчас открыто"""
+        with self._lock:
+            return len(self._shards)
+
+    def __getattr__(self, name: str):
+        if name in DIRECTORY_METHODS:
+            return getattr(self.directory, name)
+        if name not in HOUSEHOLD_METHODS:
+            raise AttributeError(name)
+
+        @functools.wraps(getattr(Database, name))
+        def method(household_id: int, *args, **kwargs):
+            shard = self._acquire(household_id)
+            try:
+                return getattr(shard, name)(household_id, *args, **kwargs)
+            finally:
+                self._release(household_id)
+
+        # Кэшируем обертку, чтобы не создавать ее при каждом вызове
+        setattr(self, name, method)
+        return method
+
+    def iter_expenses(self, household_id: int, start_date=None, end_date=None,
+                      chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[Tuple]:
+        """Database.iter_expenses: файл семьи занят, пока генератор не дочитан"""
+        shard = self._acquire(household_id)
+        try:
+            yield from shard.iter_expenses(household_id, start_date, end_date, chunk_size)
+        finally:
+            self._release(household_id)
+
+    def each_shard(self) -> Iterator[Tuple[int, Database]]:
+        """Все файлы семей по очереди (для служебных команд)"""
+        for household_id in self.household_ids():
+            shard = self._acquire(household_id)
+            try:
+                yield household_id, shard
+            finally:
+                self._release(household_id)
+
+    def migrate(self) -> int:
+        """Применить миграции к справочнику и всем файлам семей, вернуть версию схемы файлов"""
+        self.directory.migrate()
+        version = MIGRATIONS[-1][0]
+        for _, shard in self.each_shard():
+            version = min(version, shard.migrate())
+        return version
+
+    def rebuild_rollups(self) -> int:
+        """Пересчитать агрегаты во всех файлах семей"""
+        return sum(shard.rebuild_rollups() for _, shard in self.each_shard())
+
+    def verify_rollups(self) -> List[Tuple]:
+        """Расхождения агрегатов во всех файлах семей"""
+        mismatches = []
+        for _, shard in self.each_shard():
+            mismatches.extend(shard.verify_rollups())
+        return mismatches
+
+    def check_shards(self) -> List[str]:
+        """
+        Проверить целостность: PRAGMA quick_check каждого файла, что в файле
+        только записи своей семьи и что семья есть в справочнике.
+        Возвращает список найденных проблем.
+        """
+        problems = []
+        for household_id, shard in self.each_shard():
+            name = os.path.basename(shard.db_file)
+            with shard._read() as conn:
+                result = conn.execute('PRAGMA quick_check').fetchone()[0]
+                if result != 'ok':
+                    problems.append(f"{name}: quick_check: {result}")
+
+                foreign = conn.execute(
+                    'SELECT DISTINCT household_id FROM expenses WHERE household_id != ?',
+                    (household_id,)
+                ).fetchall()
+                if foreign:
+                    problems.append(f"{name}: записи чужих семей {[row[0] for row in foreign]}")
+
+            if self.directory.get_household(household_id) is None:
+                problems.append(f"{name}: семьи {household_id} нет в справочнике")
+        return problems
+
+    def close(self):
+        """Закрыть все файлы семей и справочник"""
+        self._stop_sweeper.set()
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            shards = list(self._shards.values())
+            self._shards.clear()
+        # Файлы, которые еще открываются, закроются сразу после открытия
+        for shard in shards:
+            _Shard.close_when_open(shard)
+        self.directory.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def split_into_shards(source: Database, target: ShardedDatabase,
+                      chunk_size: int = EXPORT_CHUNK_SIZE) -> List[Tuple[int, int]]:
+    """
+    Разложить общую базу по файлам семей. ID записей сохраняются,
+    повторный запуск ничего не дублирует.
+    Возвращает (household_id, скопировано записей) по каждой семье.
+    """
+    with source._read() as conn:
+        households = conn.execute('SELECT id, name, join_code, created_at FROM households').fetchall()
+        members = conn.execute(
+            'SELECT user_id, household_id, username, joined_at FROM household_members'
+        ).fetchall()
+        overrides = conn.execute(
+            'SELECT household_id, merchant, category, updated_at FROM category_overrides'
+        ).fetchall()
+
+    with target.directory._write() as conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO households (id, name, join_code, created_at) VALUES (?, ?, ?, ?)',
+            households
+        )
+        conn.executemany('''
+            INSERT OR REPLACE INTO household_members (user_id, household_id, username, joined_at)
+            VALUES (?, ?, ?, ?)
+        ''', members)
+        conn.executemany('''
+            INSERT OR REPLACE INTO category_overrides (household_id, merchant, category, updated_at)
+            VALUES (?, ?, ?, ?)
+        ''', overrides)
+
+    copied = []
+    for household_id, *_ in households:
+        count = 0
+        shard = target._acquire(household_id)
+        try:
+            with source._read() as conn:
+                cursor = conn.execute('''
+                    SELECT id, household_id, user_id, username, amount, category,
+                           description, date, ts, import_hash
+                    FROM expenses
+                    WHERE household_id = ?
+                    ORDER BY id
+                ''', (household_id,))
+
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    with shard._write() as shard_conn:
+                        count += shard_conn.executemany('''
+                            INSERT OR IGNORE INTO expenses
+                                (id, household_id, user_id, username, amount, category,
+                                 description, date, ts, import_hash)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        ''', rows).rowcount
+
+            with source._read() as conn:
+                settlements = conn.execute('''
+                    SELECT id, household_id, from_user_id, from_username, to_user_id,
+                           to_username, amount, ts, created_by
+                    FROM settlements
+                    WHERE household_id = ?
+                ''', (household_id,)).fetchall()
+            with shard._write() as shard_conn:
+                shard_conn.executemany('''
+                    INSERT OR IGNORE INTO settlements
+                        (id, household_id, from_user_id, from_username, to_user_id,
+                         to_username, amount, ts, created_by)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', settlements)
+        finally:
+            target._release(household_id)
+        copied.append((household_id, count))
+
+    return copied
+
+
+def open_storage():
+    """
+    Database или ShardedDatabase в зависимости от STORAGE_MODE;
+    с GROUP_COMMIT=1 общая база пишет через групповой коммит
+    """
+    mode = os.getenv('STORAGE_MODE', 'single')
+    if mode == 'sharded':
+        return ShardedDatabase(
+            os.getenv('SHARD_DIR', DEFAULT_SHARD_DIR),
+            max_open=int(os.getenv('SHARD_MAX_OPEN', DEFAULT_MAX_OPEN_SHARDS)),
+            idle_seconds=float(os.getenv('SHARD_IDLE_SECONDS', DEFAULT_SHARD_IDLE_SECONDS))
+        )
+    if mode == 'single':
+        if os.getenv('GROUP_COMMIT', '0') == '1':
+            return GroupCommitDatabase(
+                Database(),
+                max_batch=int(os.getenv('GROUP_COMMIT_MAX_BATCH', DEFAULT_MAX_BATCH)),
+                max_delay=float(os.getenv('GROUP_COMMIT_DELAY_MS', DEFAULT_MAX_DELAY * 1000)) / 1000
+            )
+        return Database()
+    raise ValueError(f"STORAGE_MODE должен быть одним из {STORAGE_MODES}, а не {mode!r}")
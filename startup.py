@@ -0,0 +1,166 @@
+"""
+Быстрый холодный старт и замеры фаз запуска
+
+На бесплатном тарифе Render процесс засыпает, и после пробуждения бот
+заново импортирует telegram, aiohttp и открывает базу. Чтобы хостинг
+сразу видел живой сервис, порт открывается самым первым: пока грузится
+остальное, EarlyHealthServer в отдельном потоке отвечает на проверки
+здоровья. Когда все готово, тот же сокет передается aiohttp - без
+момента, когда порт закрыт.
+
+Модуль использует только стандартную библиотеку и импортируется первым.
+
+    python bot.py --startup-report    # время импортов и инициализации по фазам
+"""
+
+import select
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Tuple, TypeVar
+
+STARTUP_REPORT_FLAG = '--startup-report'
+
+# Сколько ждать запрос от клиента и сколько его читать
+EARLY_REQUEST_TIMEOUT = 1.0
+EARLY_REQUEST_MAX_SIZE = 64 * 1024
+
+EARLY_HEALTH_RESPONSE = (
+    b'HTTP/1.1 200 OK\r\n'
+    b'Content-Type: text/plain; charset=utf-8\r\n'
+    b'Content-Length: 15\r\n'
+    b'Connection: close\r\n'
+    b'\r\n'
+    b'Bot is starting'
+)
+# Обновления от Telegram, пришедшие до готовности бота: Telegram повторит их позже
+EARLY_UNAVAILABLE_RESPONSE = (
+    b'HTTP/1.1 503 Service Unavailable\r\n'
+    b'Retry-After: 5\r\n'
+    b'Content-Length: 0\r\n'
+    b'Connection: close\r\n'
+    b'\r\n'
+)
+
+T = TypeVar('T')
+
+
+def report_requested(argv: List[str] = None) -> bool:
+    return STARTUP_REPORT_FLAG in (sys.argv if argv is None else argv)
+
+
+class StartupTimer:
+    """Фазы запуска: начало от старта и длительность"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: List[Tuple[str, float, float]] = []
+        self._lock = threading.Lock()
+
+    def _record(self, name: str, started: float):
+        finished = time.perf_counter()
+        with self._lock:
+            self.phases.append((name, started - self.started, finished - started))
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, started)
+
+    def timed(self, name: str, func: Callable[..., T], *args, **kwargs) -> T:
+        """Вызвать func как отдельную фазу (удобно для функций в потоках)"""
+        with self.phase(name):
+            return func(*args, **kwargs)
+
+    def mark(self, name: str):
+        """Момент без длительности, например "бот готов" """
+        self._record(name, time.perf_counter())
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def report(self) -> str:
+        with self._lock:
+            phases = sorted(self.phases, key=lambda phase: phase[1])
+
+        width = max([len(name) for name, _, _ in phases] + [4])
+        lines = [f"{'фаза':<{width}} {'начало, мс':>11} {'длит., мс':>10}"]
+        for name, offset, duration in phases:
+            lines.append(f"{name:<{width}} {offset * 1000:>11.1f} {duration * 1000:>10.1f}")
+        lines.append(f"всего: {self.elapsed() * 1000:.0f} мс")
+        return '\n'.join(lines)
+
+
+# Один таймер на процесс: отсчет идет с первого импорта этого модуля
+startup_timer = StartupTimer()
+
+
+class EarlyHealthServer:
+    """
+    Минимальный HTTP-ответчик на уже открытом порту: GET - 200,
+    остальное - 503.
+
+    Отдельный поток здесь намеренный и временный: цикл событий бота еще не
+    запущен, а проверка здоровья должна получать ответ с первых
+    миллисекунд. Поток живет только до handover(), которая будит его,
+    дожидается завершения (join) и передает сокет серверу aiohttp - после
+    запуска в процессе не остается лишних потоков.
+    """
+
+    def __init__(self, port: int):
+        self.sock = socket.create_server(('0.0.0.0', port), backlog=128)
+        self.port = self.sock.getsockname()[1]
+        self._wakeup_read, self._wakeup_write = socket.socketpair()
+        self._thread = threading.Thread(target=self._serve, name='early-health', daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            readable, _, _ = select.select([self.sock, self._wakeup_read], [], [])
+            if self._wakeup_read in readable:
+                return
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                continue
+            with conn:
+                self._answer(conn)
+
+    @staticmethod
+    def _answer(conn: socket.socket):
+        conn.settimeout(EARLY_REQUEST_TIMEOUT)
+        try:
+            request = conn.recv(EARLY_REQUEST_MAX_SIZE)
+            if request.startswith((b'GET ', b'HEAD ')):
+                conn.sendall(EARLY_HEALTH_RESPONSE)
+            else:
+                conn.sendall(EARLY_UNAVAILABLE_RESPONSE)
+        except OSError:
+            pass
+
+    def handover(self) -> socket.socket:
+        """
+        Остановить поток и отдать слушающий сокет основному серверу.
+        Возвращается только после завершения потока: текущий ответ
+        дописывается, новые подключения ждут в очереди сокета.
+        """
+        self._wakeup_write.send(b'x')
+        self._thread.join()
+        self._wakeup_read.close()
+        self._wakeup_write.close()
+        return self.sock
+
+
+def start_early_health(port: int) -> Optional[EarlyHealthServer]:
+    """Открыть порт здоровья; если порт занят - запуск продолжится без него"""
+    with startup_timer.phase('health port'):
+        try:
+            return EarlyHealthServer(port)
+        except OSError as error:
+            print(f"Порт {port} не открыт заранее: {error}", file=sys.stderr)
+            return None
@@ -0,0 +1,256 @@
+"""
+Тренды трат по категориям: недели или зарплатные периоды за последний год
+
+Суммы по дням и категориям читаются из expense_rollups одним запросом и
+сразу превращаются в массивы NumPy. Раскладка по интервалам, суммы по
+категориям и скользящее среднее считаются векторно, без циклов по записям.
+
+График рисует matplotlib в отдельном процессе (ProcessPoolExecutor):
+отрисовка занимает сотни миллисекунд процессорного времени и не должна
+останавливать цикл событий бота. Процессы запускаются через spawn, а не
+fork: копия процесса бота с потоками БД и открытыми соединениями в
+рабочем процессе не нужна и небезопасна. Готовые PNG кэшируются по
+(семья, период, день зарплаты) и версии данных - пока в БД ничего не
+записали, повторный /trends отдает картинку из памяти.
+
+numpy и matplotlib импортируются только при первом построении тренда.
+"""
+
+import asyncio
+import bisect
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import date
+from typing import List, Optional, Tuple
+
+from cache import QueryCache
+from salary_calendar import DEFAULT_PAY_DAY, epoch_day, from_epoch_day, pay_dates
+
+# Период тренда: название и количество интервалов за год
+TREND_PERIODS = {
+    'salary': ('по зарплатным периодам', 12),
+    'week': ('по неделям', 52),
+}
+DEFAULT_TREND_PERIOD = 'salary'
+
+# Окно скользящего среднего в интервалах
+MOVING_AVERAGE_WINDOW = {
+    'salary': 3,
+    'week': 4,
+}
+
+# Сколько категорий показывать отдельно, остальные идут одним столбцом.
+# Название не совпадает с категорией "Прочее", которая может попасть в топ
+TOP_CATEGORIES = 6
+OTHER_CATEGORY = 'Остальное'
+
+# Процессов для отрисовки и сколько готовых картинок держать в памяти
+RENDER_WORKERS = 2
+CHART_CACHE_SIZE = 64
+
+# 1970-01-01 - четверг: сдвиг, чтобы недели начинались с понедельника
+WEEK_OFFSET = 3
+
+
+@dataclass(frozen=True)
+class Trend:
+    """Суммы по интервалам и категориям, готовые к отрисовке"""
+    title: str
+    labels: List[str]          # подпись интервала (дата начала)
+    categories: List[str]      # по убыванию суммы за год, OTHER_CATEGORY последним
+    amounts: 'np.ndarray'      # интервалы x категории
+    totals: 'np.ndarray'       # сумма по интервалу
+    moving_average: 'np.ndarray'  # по закончившимся интервалам, NaN - нет данных
+    window: int
+
+
+def trends_available() -> bool:
+    try:
+        import matplotlib  # noqa: F401
+        import numpy  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def bucket_edges(period: str, today: date, pay_day: int = DEFAULT_PAY_DAY) -> List[int]:
+    """
+    Границы интервалов в днях от 1970-01-01: n интервалов заканчиваются
+    текущим (неполным) интервалом, последняя граница - его конец.
+    """
+    count = TREND_PERIODS[period][1]
+    day = epoch_day(today)
+
+    if period == 'week':
+        current = day - (day + WEEK_OFFSET) % 7
+        return [current + 7 * offset for offset in range(1 - count, 2)]
+
+    starts = [epoch_day(start) for start in pay_dates(pay_day)]
+    index = bisect.bisect_right(starts, day)
+    if not 0 < index < len(starts) or index < count:
+        # За пределами заранее посчитанного календаря - месяцами по 30 дней
+        return [day - 30 * offset for offset in range(count - 1, -2, -1)]
+    return starts[index - count:index + 1]
+
+
+def moving_average(values: 'np.ndarray', window: int) -> 'np.ndarray':
+    """Скользящее среднее через накопленные суммы; первые window-1 точек - NaN"""
+    import numpy as np
+
+    result = np.full(values.shape, np.nan)
+    if window <= 0 or len(values) < window:
+        return result
+    cumulative = np.concatenate(([0.0], np.cumsum(values)))
+    result[window - 1:] = (cumulative[window:] - cumulative[:-window]) / window
+    return result
+
+
+def compute_trend(days: List[int], categories: List[str], amounts: List[float],
+                  edges: List[int], period: str) -> Trend:
+    """Разложить суммы по дням и категориям на интервалы между edges"""
+    import numpy as np
+
+    edges = np.asarray(edges, dtype=np.int64)
+    buckets = len(edges) - 1
+
+    days = np.asarray(days, dtype=np.int64)
+    amounts = np.asarray(amounts, dtype=np.float64)
+    names, codes = np.unique(np.asarray(categories, dtype=str), return_inverse=True)
+
+    # Номер интервала для каждого дня; дни вне границ отбрасываем
+    bucket = np.searchsorted(edges, days, side='right') - 1
+    inside = (bucket >= 0) & (bucket < buckets)
+    bucket, codes, amounts = bucket[inside], codes[inside], amounts[inside]
+
+    matrix = np.bincount(
+        bucket * len(names) + codes, weights=amounts, minlength=buckets * len(names)
+    ).reshape(buckets, len(names))
+
+    # Крупные категории отдельно, мелкие - одним столбцом
+    order = np.argsort(-matrix.sum(axis=0), kind='stable')
+    top, rest = order[:TOP_CATEGORIES], order[TOP_CATEGORIES:]
+    columns = [matrix[:, top]]
+    labels = [str(name) for name in names[top]]
+    if len(rest):
+        columns.append(matrix[:, rest].sum(axis=1, keepdims=True))
+        labels.append(OTHER_CATEGORY)
+    matrix = np.hstack(columns) if labels else np.zeros((buckets, 0))
+
+    totals = matrix.sum(axis=1)
+    window = MOVING_AVERAGE_WINDOW[period]
+
+    return Trend(
+        title=f"Траты {TREND_PERIODS[period][0]}",
+        labels=[from_epoch_day(int(start)).strftime('%d.%m.%y') for start in edges[:-1]],
+        categories=labels,
+        amounts=matrix,
+        totals=totals,
+        # Текущий интервал еще не закончился и занизил бы среднее
+        moving_average=np.append(moving_average(totals[:-1], window), np.nan),
+        window=window,
+    )
+
+
+def render_chart(trend: Trend) -> bytes:
+    """Нарисовать график в PNG. Выполняется в процессе отрисовки."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import numpy as np
+
+    positions = np.arange(len(trend.labels))
+    figure, axes = plt.subplots(figsize=(11, 5.5), dpi=100)
+    try:
+        bottom = np.zeros(len(positions))
+        for index, category in enumerate(trend.categories):
+            values = trend.amounts[:, index]
+            axes.bar(positions, values, bottom=bottom, label=category, width=0.8)
+            bottom += values
+
+        axes.plot(positions, trend.moving_average, color='black', linewidth=2,
+                  label=f"Среднее за {trend.window}")
+
+        # Подписей не больше ~13, иначе 52 недели слипаются
+        step = max(1, len(positions) // 12)
+        axes.set_xticks(positions[::step])
+        axes.set_xticklabels(trend.labels[::step], rotation=45, ha='right')
+        axes.set_ylabel('zł')
+        axes.set_title(trend.title)
+        axes.grid(axis='y', alpha=0.3)
+        axes.legend(loc='upper left', bbox_to_anchor=(1.01, 1), fontsize='small')
+        figure.tight_layout()
+
+        buffer = io.BytesIO()
+        figure.savefig(buffer, format='png')
+        return buffer.getvalue()
+    finally:
+        plt.close(figure)
+
+
+def summarize(trend: Trend) -> str:
+    """Короткая подпись к графику"""
+    import numpy as np
+
+    # Текущий интервал еще не закончился - сравниваем последний полный
+    closed = trend.totals[:-1]
+    response = f"📈 {trend.title}\n"
+    response += f"Всего за год: {trend.totals.sum():.2f} zł\n"
+    if len(closed):
+        response += f"В среднем за интервал: {closed.mean():.2f} zł\n"
+
+    average = trend.moving_average[-2] if len(trend.moving_average) > 1 else np.nan
+    if len(closed) and not np.isnan(average) and average > 0:
+        change = (closed[-1] / average - 1) * 100
+        response += (f"Последний полный интервал ({trend.labels[-2]}): {closed[-1]:.2f} zł, "
+                     f"{change:+.0f}% к среднему за {trend.window}")
+    return response
+
+
+class TrendCharts:
+    """Построение графиков трендов с кэшем и отрисовкой в отдельных процессах"""
+
+    def __init__(self, db, workers: int = RENDER_WORKERS, cache_size: int = CHART_CACHE_SIZE):
+        self.db = db
+        self.workers = workers
+        self.cache = QueryCache(cache_size)
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # Процессы запускаются при первом графике, а не при старте бота
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')
+            )
+        return self._executor
+
+    async def build(self, household_id: int, period: str = DEFAULT_TREND_PERIOD,
+                    pay_day: int = DEFAULT_PAY_DAY,
+                    today: date = None) -> Tuple[bytes, str]:
+        """PNG и подпись к нему"""
+        today = today or date.today()
+        key = (household_id, period, pay_day, today)
+        version = await self.db.get_data_version(household_id)
+
+        found, value = self.cache.get(key, version)
+        if found:
+            return value
+
+        edges = bucket_edges(period, today, pay_day)
+        days, categories, amounts = await self.db.get_daily_category_totals(
+            household_id, edges[0], edges[-1]
+        )
+        trend = compute_trend(days, categories, amounts, edges, period)
+
+        loop = asyncio.get_running_loop()
+        png = await loop.run_in_executor(self._pool(), render_chart, trend)
+
+        value = (png, summarize(trend))
+        self.cache.put(key, version, value)
+        return value
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,100 @@
+"""
+HTTP-сервер бота на aiohttp
+
+Один сервер в том же цикле событий, что и бот, отвечает на проверки
+здоровья от хостинга, отдает метрики на /metrics и принимает
+обновления Telegram в режиме webhook.
+"""
+
+import hashlib
+import hmac
+import logging
+import socket
+from typing import Optional
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+from metrics import CONTENT_TYPE, REGISTRY
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH = '/telegram'
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# Ключи, под которыми объекты лежат в web.Application
+APPLICATION_KEY = web.AppKey('application', Application)
+SECRET_KEY = web.AppKey('secret_token', str)
+
+
+def derive_secret_token(bot_token: str) -> str:
+    """
+    Секрет для webhook, если WEBHOOK_SECRET не задан.
+    Не меняется между перезапусками и не раскрывает сам токен.
+    """
+    return hashlib.sha256(f'webhook:{bot_token}'.encode()).hexdigest()
+
+
+async def health(request: web.Request) -> web.Response:
+    """Проверка, что бот жив (для Render)"""
+    return web.Response(text="Bot is running!")
+
+
+async def metrics(request: web.Request) -> web.Response:
+    """Метрики в текстовом формате Prometheus"""
+    return web.Response(body=REGISTRY.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def telegram_webhook(request: web.Request) -> web.Response:
+    """Принять обновление от Telegram и передать его боту"""
+    secret = request.app[SECRET_KEY]
+    received = request.headers.get(SECRET_HEADER, '')
+    if not hmac.compare_digest(received.encode(), secret.encode()):
+        logger.warning("Webhook: неверный секретный токен")
+        return web.Response(status=403)
+
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+
+    application = request.app[APPLICATION_KEY]
+    await application.update_queue.put(Update.de_json(data, application.bot))
+    return web.Response()
+
+
+def create_web_app(application: Application, secret_token: Optional[str] = None) -> web.Application:
+    """
+    Создать веб-приложение. Если передан secret_token,
+    дополнительно принимаются обновления Telegram на WEBHOOK_PATH.
+    """
+    app = web.Application()
+    app[APPLICATION_KEY] = application
+    app.router.add_get('/', health)
+    app.router.add_get('/health', health)
+    app.router.add_get('/metrics', metrics)
+
+    if secret_token:
+        app[SECRET_KEY] = secret_token
+        app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+
+    return app
+
+
+async def start_web_server(app: web.Application, port: int,
+                           sock: Optional[socket.socket] = None) -> web.AppRunner:
+    """
+    Запустить сервер на порту или на уже открытом слушающем сокете;
+    остановка - await runner.cleanup()
+    """
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    if sock is not None:
+        site = web.SockSite(runner, sock)
+        port = sock.getsockname()[1]
+    else:
+        site = web.TCPSite(runner, '0.0.0.0', port)
+    await site.start()
+    logger.info(f"✅ HTTP server started on port {port}")
+    return runner